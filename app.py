@@ -2,26 +2,69 @@
 import os
 import time
 import base64
+import gzip
+import hashlib
+import json
+import logging
+import queue
+import sys
+import uuid
 import sqlite3
 import re
+import signal
 import subprocess
+import threading
+import contextvars
+import atexit
+import csv
+import fcntl
+import io
+import tempfile
 import html as html_lib
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
 from datetime import datetime, timedelta
+from urllib.parse import urlencode
 from zoneinfo import ZoneInfo
 
+import numpy as np
 import pandas as pd
+import click
 import requests
-from flask import Flask, render_template_string, send_file, jsonify
+from flask import Flask, Response, g as g_peticion, render_template, send_file, send_from_directory, jsonify, request, redirect
 from apscheduler.schedulers.background import BackgroundScheduler
+from apscheduler.triggers.combining import OrTrigger
+from apscheduler.triggers.cron import CronTrigger
+from openpyxl import Workbook
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.styles import Font
+
+try:
+    import brotli  # opcional: variante Content-Encoding: br del panel
+except ImportError:
+    brotli = None
 
 from selenium import webdriver
-from selenium.webdriver.common.by import By
+from selenium.common.exceptions import TimeoutException
 from selenium.webdriver.chrome.options import Options
 from selenium.webdriver.support.ui import WebDriverWait
-from selenium.webdriver.support import expected_conditions as EC
 
 
 app = Flask(__name__)
+# Plantillas en templates/ (compiladas una vez y cacheadas por Jinja); sin líneas vacías de los bloques
+app.jinja_env.trim_blocks = True
+app.jinja_env.lstrip_blocks = True
+
+# Log de la captura: sale por stdout con el mismo aspecto que los print() y, en las capturas
+# forzadas, un handler por trabajo guarda además sus líneas (ver encolar_captura)
+log = logging.getLogger("niveles")
+log.setLevel(logging.INFO)
+log.propagate = False
+if not log.handlers:
+    _log_stdout = logging.StreamHandler(sys.stdout)
+    _log_stdout.setFormatter(logging.Formatter("%(message)s"))
+    log.addHandler(_log_stdout)
 
 # -------------------
 # CONFIGURACIÓN
@@ -37,65 +80,367 @@ DATA_DIR = os.getenv("DATA_DIR", "/app/data")
 os.makedirs(DATA_DIR, exist_ok=True)
 
 DB_NAME = os.path.join(DATA_DIR, "temp_niveles.db")
-SCREENSHOT_PATH = os.path.join(DATA_DIR, "debug_vps.png")
+
+# Capturas de pantalla de depuración: solo en fallo o bajo demanda, en un buffer circular
+DEBUG_DIR = os.path.join(DATA_DIR, "debug")
+os.makedirs(DEBUG_DIR, exist_ok=True)
+DEBUG_MAX_ARCHIVOS = int(os.getenv("DEBUG_MAX_ARCHIVOS", "30"))
+DEBUG_MAX_MB = float(os.getenv("DEBUG_MAX_MB", "20"))
+DEBUG_ESCALA = float(os.getenv("DEBUG_ESCALA", "0.5"))  # 0.5 -> 960x540
+DEBUG_FORMATO = os.getenv("DEBUG_FORMATO", "jpeg").strip().lower()  # jpeg | webp | png
+DEBUG_CALIDAD = int(os.getenv("DEBUG_CALIDAD", "60"))
+DEBUG_CAPTURA_SIEMPRE = os.getenv("DEBUG_CAPTURA_SIEMPRE", "0") == "1"
+
+# Ventanas de las sparklines del panel (?ventana=) y puntos máximos por sparkline (LTTB)
+VENTANAS = {"24h": 86400, "7d": 7 * 86400, "30d": 30 * 86400, "90d": 90 * 86400}
+SPARKLINE_PUNTOS = int(os.getenv("SPARKLINE_PUNTOS", "60"))
+
+# Fuente del panel: "google" (Google Fonts), "local" (static/fonts) o "none" (fuente del sistema)
+FUENTES = os.getenv("FUENTES", "google").strip().lower()
 
 WINDOW_W, WINDOW_H = 1920, 1080
 
-PI_BASE_URL = "https://eworkerbrrc.endesa.es/PIVision/"
-DISPLAY_ID = "88153"
-DISPLAY_HASH = f"#/Displays/{DISPLAY_ID}/Balance-Combustible-Bco?mode=kiosk&hidetoolbar&redirect=false"
+PI_BASE_URL = os.getenv("PI_BASE_URL", "https://eworkerbrrc.endesa.es/PIVision/")
+
+# Retención: lecturas crudas completas durante N días; después solo la última de cada día
+# (los agregados horarios/diarios se conservan). 0 = sin retención.
+RETENCION_RAW_DIAS = int(os.getenv("RETENCION_RAW_DIAS", "365"))
+RETENCION_LOTE = int(os.getenv("RETENCION_LOTE", "2000"))  # filas por transacción de borrado
+RETENCION_PAUSA_S = float(os.getenv("RETENCION_PAUSA_S", "0.05"))  # respiro entre lotes para los lectores
+
+# Email (Brevo): cola persistente en la BD con reintentos y resumen de alertas
+BREVO_API_URL = os.getenv("BREVO_API_URL", "https://api.brevo.com/v3/smtp/email")
+EMAIL_MAX_INTENTOS = int(os.getenv("EMAIL_MAX_INTENTOS", "8"))
+EMAIL_BACKOFF_S = int(os.getenv("EMAIL_BACKOFF_S", "30"))  # 30s, 60s, 120s... hasta EMAIL_BACKOFF_MAX_S
+EMAIL_BACKOFF_MAX_S = int(os.getenv("EMAIL_BACKOFF_MAX_S", "3600"))
+ALERTA_VENTANA_S = int(os.getenv("ALERTA_VENTANA_S", "600"))  # alertas agrupadas en un solo email
+
+# Backend de captura: "selenium" (render del display) o "webapi" (HTTP, Selenium como respaldo)
+CAPTURE_BACKEND = os.getenv("CAPTURE_BACKEND", "selenium").strip().lower()
+PI_WEBAPI_URL = os.getenv("PI_WEBAPI_URL", "https://eworkerbrrc.endesa.es/piwebapi/")
+PI_WEBAPI_SERVIDOR = os.getenv("PI_WEBAPI_SERVIDOR", "PI-BRRC-S1")  # servidor de los tags de agua
+
+# Pool de navegadores: sesiones Chromium reutilizables entre capturas
+DRIVER_POOL_SIZE = max(1, int(os.getenv("DRIVER_POOL_SIZE", "1")))
+DRIVER_MAX_CAPTURAS = int(os.getenv("DRIVER_MAX_CAPTURAS", "50"))  # reciclar tras N capturas
+DRIVER_MAX_RSS_MB = int(os.getenv("DRIVER_MAX_RSS_MB", "700"))  # reciclar si el árbol de procesos supera este RSS
+DRIVER_MAX_EDAD_H = float(os.getenv("DRIVER_MAX_EDAD_H", "24"))  # reciclar sesiones con más de N horas
+# Displays leídos a la vez (cada uno en una sesión del pool; más allá de DRIVER_POOL_SIZE esperan turno)
+CAPTURE_PARALELO = max(1, int(os.getenv("CAPTURE_PARALELO", str(DRIVER_POOL_SIZE))))
+
+# Espera del display: todos los tags con valor y sin cambios durante CAPTURE_ESTABLE_MS
+CAPTURE_READY_TIMEOUT_S = float(os.getenv("CAPTURE_READY_TIMEOUT_S", "60"))
+CAPTURE_ESTABLE_MS = int(os.getenv("CAPTURE_ESTABLE_MS", "1500"))
+
+# Desgloses por fase de las últimas N capturas, y siempre los de las últimas 24 h
+# (tabla capturas_desglose, /api/capturas)
+CAPTURAS_DESGLOSE_N = int(os.getenv("CAPTURAS_DESGLOSE_N", "200"))
+
+# Registro de tags (tags.json, o el fichero de TAGS_FILE): display de PI Vision donde aparece
+# cada tag, planta, grupo (combustible -> tabla lecturas, agua -> lecturas_agua), unidad y nivel
+# máximo; el cron de captura de cada grupo y, opcionalmente, la compresión del histórico
+# ("compresion": {"metodo": "deadband" | "swinging_door", "tolerancia": 0.05, "heartbeat_s": 21600}
+# en el grupo o en el tag, ver Compresor). Cada planta puede llevar "central" y "color" para su
+# sección del email. Un grupo con tags y sin cron se captura con
+# CAPTURA_CRON_DEFECTO (cada 2h en horas pares y a las 21:00, como antes del registro)
+TAGS_FILE = os.getenv("TAGS_FILE", os.path.join(os.path.dirname(os.path.abspath(__file__)), "tags.json"))
+GRUPOS = {"combustible": "lecturas", "agua": "lecturas_agua"}
+METODOS_COMPRESION = ("deadband", "swinging_door")
+COMPRESION_HEARTBEAT_S = int(os.getenv("COMPRESION_HEARTBEAT_S", str(6 * 3600)))
+CAPTURA_CRON_DEFECTO = os.getenv("CAPTURA_CRON_DEFECTO", "0 */2,21 * * *")
+
+
+def cargar_registro(ruta):
+    """Lee y valida el registro de tags; un error de configuración impide arrancar."""
+    with open(ruta, encoding="utf-8") as f:
+        reg = json.load(f)
+    displays, plantas, tags = reg.get("displays", {}), reg.get("plantas", {}), reg.get("tags", [])
+    grupos = reg.get("grupos") or {}
+    for grupo in GRUPOS:
+        if any(t.get("grupo") == grupo for t in tags):
+            grupos.setdefault(grupo, {})
+    for grupo, cfg in grupos.items():
+        if grupo not in GRUPOS:
+            raise ValueError(f"{ruta}: grupo desconocido {grupo!r} ({', '.join(GRUPOS)})")
+        cfg.setdefault("cron", CAPTURA_CRON_DEFECTO)
+        try:
+            CronTrigger.from_crontab(cfg["cron"], timezone=TZ)
+            if cfg.get("adaptativo", {}).get("cron_fijo"):
+                CronTrigger.from_crontab(cfg["adaptativo"]["cron_fijo"], timezone=TZ)
+        except ValueError as e:
+            raise ValueError(f"{ruta}: cron no válido en el grupo {grupo!r}: {e}")
+    vistos = set()
+    for t in tags:
+        falta = [c for c in ("tag", "descripcion", "display", "planta", "grupo") if not t.get(c)]
+        if falta:
+            raise ValueError(f"{ruta}: al tag {t.get('tag')!r} le falta {', '.join(falta)}")
+        if t["display"] not in displays:
+            raise ValueError(f"{ruta}: display desconocido {t['display']!r} en {t['tag']!r}")
+        if t["planta"] not in plantas:
+            raise ValueError(f"{ruta}: planta desconocida {t['planta']!r} en {t['tag']!r}")
+        if t["grupo"] not in GRUPOS:
+            raise ValueError(f"{ruta}: grupo {t['grupo']!r} en {t['tag']!r} ({', '.join(GRUPOS)})")
+        if t["grupo"] == "combustible" and not t.get("nivel_max"):
+            raise ValueError(f"{ruta}: falta nivel_max en {t['tag']!r}")
+        if t["tag"] in vistos:
+            raise ValueError(f"{ruta}: tag repetido {t['tag']!r}")
+        vistos.add(t["tag"])
+        t.setdefault("unidad", "")
+        # Compresión del histórico: la del tag o, si no tiene, la de su grupo
+        t["compresion"] = t.get("compresion", grupos.get(t["grupo"], {}).get("compresion"))
+        comp = t["compresion"]
+        if comp and (comp.get("metodo") not in METODOS_COMPRESION or float(comp.get("tolerancia", 0)) <= 0):
+            raise ValueError(
+                f"{ruta}: compresión no válida en {t['tag']!r} "
+                f"(metodo: {', '.join(METODOS_COMPRESION)}; tolerancia > 0)"
+            )
+    return {"displays": displays, "plantas": plantas, "grupos": grupos, "tags": tags}
+
+
+REGISTRO = cargar_registro(TAGS_FILE)
+REGISTRO_POR_TAG = {t["tag"]: t for t in REGISTRO["tags"]}
+
+
+def tags_de(grupo=None, planta=None, display=None):
+    """Tags del registro (en su orden) que cumplen los filtros."""
+    return [
+        t["tag"] for t in REGISTRO["tags"]
+        if (grupo is None or t["grupo"] == grupo)
+        and (planta is None or t["planta"] == planta)
+        and (display is None or t["display"] == display)
+    ]
+
 
 # Tupla con (tag, descripción, nivel_máximo_metros)
-DATOS_A_BUSCAR = (
-    (r"\PI-BRRC-S1\BRRC00-0LBL111A2", "TANQUE ALMACEN FO", 18),
-    (r"\PI-BRRC-S1\BRRC00-0LBL111B", "TANQUE ALMACEN GO A", 18),
-    (r"\PI-BRRC-S1\BRRC00-0LBL111C", "TANQUE ALMACEN GO B", 18),
-    (r"\PI-BRRC-S1\BRRC036EGD20CL001JT01A", "TANQUE DIARIO GO 1", 13),
-    (r"\PI-BRRC-S1\BRRC036EGD20CL002JT01A", "TANQUE DIARIO GO 2", 13),
-    (r"\PI-BRRC-S1\BRRC036EGD20CL003JT01A", "TANQUE DIARIO GO 3", 13),
-    (r"\PI-BRRC-S1\BRRC0210EGB30CL001JT01A", "TANQUE DIARIO GO 4", 13),
-    (r"\PI-BRRC-S1\BRRC00-0LTBM127", "TANQUE GO VAPORES 80MW", 7),
-    (r"\PI-JINA-S1\JINA00-145J045822", "NIVEL TANQUE TO2A", 16),
-    (r"\PI-JINA-S1\JINAGT-208J021809", "NIVEL TQ GO 2 LM TURBINAS GAS", 13),
-    (r"\PI-JINA-S1\JINA00-145J045826", "NIVEL GO DIESEL 4/5", 3),
+DATOS_A_BUSCAR = tuple(
+    (t["tag"], t["descripcion"], t["nivel_max"]) for t in REGISTRO["tags"] if t["grupo"] == "combustible"
 )
-
 ORDER_TAGS = [t[0] for t in DATOS_A_BUSCAR]
-BARRANCO_TAGS = set(ORDER_TAGS[:8])
-JINAMAR_TAGS = set(ORDER_TAGS[8:])
-
-# Nuevos puntos de Agua (Contadores y niveles)
-DATOS_AGUA = (
-    ("BRRC0210GCG41CF001QT", "Desaladora nº 2"),
-    ("BRRC0235GCG41CF001JT01AQT", "Desaladora nº 3"),
-    ("BRRC0235GCG81CF001JT01AQT", "Desaladora nº 4"),
-    ("BRRC01-1LTAQ101", "Desmineralizada A"),
-    ("BRRC02-2LTAQ101", "Desmineralizada B"),
-    ("BRRC0235GDK10CL001JT01A", "Desalada A"),
-    ("BRRC0235GDK20CL001JT01A", "Desalada B"),
-    ("BRRC0210GAD01CL901XQ01", "Desalada C"),
-    ("BRRC0-0LTKC001", "Contra incendio"),
-    ("BRRC01-1LTAF118", "Reserva Condensado TV01"),
-    ("BRRC02-2LTAF118", "Reserva Condensado TV02"),
-    ("BRRC0-0LTAQ100", "Agua Inyección TG01/TG02"),
-    ("BRRC033GCK30CL001JT01A", "Reserva Condensado TV03"),
-    ("BRRC033GCK30CL003JT01A", "Agua Inyección TG03/TG04"),
-    ("BRRC0210GCK01CL901XQ01", "Agua Inyección TG05/TG06"),
-    ("BRRC0210GCK41CL901XQ01", "Reserva Condensado TV04"),
-    ("BRRC0-0LTAP115", "Agua Potable y Riego"),
+
+# Puntos de Agua (Contadores y niveles): (tag, descripción)
+DATOS_AGUA = tuple((t["tag"], t["descripcion"]) for t in REGISTRO["tags"] if t["grupo"] == "agua")
+
+
+# -------------------
+# MÉTRICAS
+# -------------------
+# Contadores e histogramas en memoria del proceso, expuestos en /metrics con el formato de
+# texto de Prometheus. Cada captura lleva además su desglose por fases (ver medir_fase), que
+# se guarda en capturas_desglose (las últimas CAPTURAS_DESGLOSE_N).
+_METRICAS = []
+_BUCKETS_FASE = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120)
+_BUCKETS_HTTP = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def _num_prom(v):
+    if v == float("inf"):
+        return "+Inf"
+    return repr(float(v)) if isinstance(v, float) else str(v)
+
+
+def _escapar_prom(v):
+    """Valor de etiqueta con \\, " y saltos de línea escapados (formato de texto de Prometheus)."""
+    return str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _etiquetas_prom(nombres, valores, extra=()):
+    pares = list(zip(nombres, valores)) + list(extra)
+    if not pares:
+        return ""
+    return "{" + ",".join(f'{n}="{_escapar_prom(v)}"' for n, v in pares) + "}"
+
+
+class _Metrica:
+    tipo = "untyped"
+
+    def __init__(self, nombre, ayuda, etiquetas=()):
+        self.nombre = nombre
+        self.ayuda = ayuda
+        self.etiquetas = tuple(etiquetas)
+        self._series = {}
+        self._lock = threading.Lock()
+        _METRICAS.append(self)
+
+    def _clave(self, etiquetas):
+        return tuple(str(etiquetas.get(e, "")) for e in self.etiquetas)
+
+    def _lineas(self):
+        raise NotImplementedError
+
+    def exponer(self):
+        yield f"# HELP {self.nombre} {self.ayuda}"
+        yield f"# TYPE {self.nombre} {self.tipo}"
+        yield from self._lineas()
+
+
+class Contador(_Metrica):
+    """Contador monótono por combinación de etiquetas."""
+
+    tipo = "counter"
+
+    def inc(self, n=1, **etiquetas):
+        clave = self._clave(etiquetas)
+        with self._lock:
+            self._series[clave] = self._series.get(clave, 0) + n
+
+    def _lineas(self):
+        with self._lock:
+            series = sorted(self._series.items())
+        for clave, v in series:
+            yield f"{self.nombre}{_etiquetas_prom(self.etiquetas, clave)} {_num_prom(v)}"
+
+
+class Indicador(_Metrica):
+    """Valor instantáneo; con `funcion` se calcula al exponer (sin etiquetas)."""
+
+    tipo = "gauge"
+
+    def __init__(self, nombre, ayuda, etiquetas=(), funcion=None):
+        super().__init__(nombre, ayuda, etiquetas)
+        self.funcion = funcion
+
+    def fijar(self, v, **etiquetas):
+        with self._lock:
+            self._series[self._clave(etiquetas)] = v
+
+    def _lineas(self):
+        if self.funcion is not None:
+            try:
+                v = self.funcion()
+            except Exception as e:
+                log.warning(f"[metrics] {self.nombre}: {e}")
+                return
+            if v is not None:
+                yield f"{self.nombre} {_num_prom(v)}"
+            return
+        with self._lock:
+            series = sorted(self._series.items())
+        for clave, v in series:
+            yield f"{self.nombre}{_etiquetas_prom(self.etiquetas, clave)} {_num_prom(v)}"
+
+
+class Histograma(_Metrica):
+    """Histograma de buckets fijos (límites superiores, `le`), con _sum y _count."""
+
+    tipo = "histogram"
+
+    def __init__(self, nombre, ayuda, etiquetas=(), buckets=_BUCKETS_FASE):
+        super().__init__(nombre, ayuda, etiquetas)
+        self.buckets = tuple(sorted(buckets))
+
+    def observar(self, v, **etiquetas):
+        clave = self._clave(etiquetas)
+        with self._lock:
+            serie = self._series.get(clave)
+            if serie is None:
+                serie = self._series[clave] = [[0] * len(self.buckets), 0.0, 0]
+            for i, b in enumerate(self.buckets):
+                if v <= b:
+                    serie[0][i] += 1
+                    break
+            serie[1] += v
+            serie[2] += 1
+
+    def _lineas(self):
+        with self._lock:
+            series = sorted((k, (list(c), s, n)) for k, (c, s, n) in self._series.items())
+        for clave, (cuentas, suma, n) in series:
+            acumulado = 0
+            for b, c in zip(self.buckets, cuentas):
+                acumulado += c
+                etq = _etiquetas_prom(self.etiquetas, clave, [("le", _num_prom(float(b)))])
+                yield f"{self.nombre}_bucket{etq} {acumulado}"
+            yield f"{self.nombre}_bucket{_etiquetas_prom(self.etiquetas, clave, [('le', '+Inf')])} {n}"
+            yield f"{self.nombre}_sum{_etiquetas_prom(self.etiquetas, clave)} {_num_prom(suma)}"
+            yield f"{self.nombre}_count{_etiquetas_prom(self.etiquetas, clave)} {n}"
+
+
+def exponer_metricas():
+    return "\n".join(linea for m in _METRICAS for linea in m.exponer()) + "\n"
+
+
+M_CAPTURAS = Contador("niveles_capturas_total", "Capturas terminadas por resultado.", ("resultado",))
+M_CAPTURA_S = Histograma("niveles_captura_segundos", "Duración total de cada captura.", ("resultado",))
+M_FASE_S = Histograma("niveles_captura_fase_segundos", "Duración de cada fase de la captura.", ("fase",))
+M_ULTIMA_CAPTURA = Indicador(
+    "niveles_ultima_captura_timestamp_seconds", "Epoch de la última captura por resultado.", ("resultado",)
+)
+M_TAGS_ERROR = Contador(
+    "niveles_tags_error_total", "Tags guardados sin valor numérico (error o missing).", ("grupo", "estado")
+)
+M_FILAS = Contador("niveles_filas_insertadas_total", "Lecturas insertadas en el histórico.", ("tabla",))
+M_EMAILS = Contador(
+    "niveles_emails_total", "Intentos de envío de la cola de emails por resultado.", ("tipo", "resultado")
+)
+M_HTTP = Contador("niveles_http_peticiones_total", "Peticiones HTTP atendidas.", ("ruta", "metodo", "codigo"))
+M_HTTP_S = Histograma(
+    "niveles_http_segundos", "Latencia de las rutas (hasta el primer byte en las de streaming).",
+    ("ruta", "metodo"), buckets=_BUCKETS_HTTP,
 )
 
 
+class DesgloseCaptura:
+    """Tiempos por fase de una captura (sumados por fase y, si la hay, por display)."""
+
+    def __init__(self, grupos, backend):
+        self.inicio = time.time()
+        self.grupos = list(grupos)
+        self.backend = backend
+        self.fases = {}
+        self.tags = 0
+        self.tags_error = 0
+        self.filas = 0
+        self._lock = threading.Lock()
+
+    def sumar(self, fase, segundos, display=None):
+        clave = f"{fase}:{display}" if display else fase
+        with self._lock:
+            self.fases[clave] = round(self.fases.get(clave, 0.0) + segundos, 3)
+
+
+# Las capturas del proceso van de una en una (CoordinadorCapturas): basta un desglose global
+_desglose_actual = None
+
+
+def registrar_fase(fase, segundos, display=None):
+    M_FASE_S.observar(segundos, fase=fase)
+    desglose = _desglose_actual
+    if desglose is not None:
+        desglose.sumar(fase, segundos, display)
+
+
+@contextmanager
+def medir_fase(fase, display=None):
+    """Cronometra el bloque como fase de la captura (también si lanza excepción)."""
+    t0 = time.monotonic()
+    try:
+        yield
+    finally:
+        registrar_fase(fase, time.monotonic() - t0, display)
+
+
 # -------------------
 # DB
 # -------------------
 def _db_connect():
     conn = sqlite3.connect(DB_NAME, timeout=30)
+    # Solo tiene efecto en una BD nueva (antes de crear tablas y de pasar a WAL); en una existente
+    # el cambio lo hace `flask compactar-bd`
+    conn.execute("PRAGMA auto_vacuum = INCREMENTAL;")
     conn.execute("PRAGMA journal_mode=WAL;")
     conn.execute("PRAGMA synchronous=NORMAL;")
     return conn
 
 
+# Estado de cada lectura (columna estado)
+ESTADO_OK = 0  # valor numérico leído
+ESTADO_ERROR = 1  # 'Error' o texto no numérico
+ESTADO_MISSING = 2  # '---' (div vacío / sin valor)
+ESTADOS = {ESTADO_OK: "ok", ESTADO_ERROR: "error", ESTADO_MISSING: "missing"}
+
+_MIGRACION_LOTE = 5000
+
+
 def init_db():
     conn = _db_connect()
     conn.execute(
@@ -105,11 +450,13 @@ def init_db():
             descripcion TEXT NOT NULL,
             valor TEXT NOT NULL,
             ts TEXT NOT NULL,
-            nivel_max REAL NOT NULL
+            nivel_max REAL NOT NULL,
+            valor_num REAL,
+            ts_epoch INTEGER,
+            estado INTEGER
         )
         """
     )
-    conn.execute("CREATE INDEX IF NOT EXISTS idx_lecturas_tag_ts ON lecturas(tag, ts);")
 
     # Tabla para niveles de agua (Contadores y niveles)
     conn.execute(
@@ -118,14 +465,932 @@ def init_db():
             tag TEXT NOT NULL,
             descripcion TEXT NOT NULL,
             valor TEXT NOT NULL,
-            ts TEXT NOT NULL
+            ts TEXT NOT NULL,
+            valor_num REAL,
+            ts_epoch INTEGER,
+            estado INTEGER
         )
         """
     )
-    conn.execute("CREATE INDEX IF NOT EXISTS idx_lecturas_agua_tag_ts ON lecturas_agua(tag, ts);")
+    conn.commit()
+    _migrar_esquema(conn)
     conn.close()
 
 
+def clasificar_valor(valor_texto):
+    """Texto capturado -> (valor_num, estado)."""
+    num = parse_float(valor_texto)
+    if num is not None:
+        return num, ESTADO_OK
+    if not valor_texto or valor_texto.strip() in ("", "---"):
+        return None, ESTADO_MISSING
+    return None, ESTADO_ERROR
+
+
+def ts_a_epoch(ts):
+    """ISO con o sin offset (sin offset = hora de Canarias) -> epoch UTC en segundos."""
+    dt = datetime.fromisoformat(str(ts))
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=TZ)
+    return int(dt.timestamp())
+
+
+def epoch_a_dt(epoch):
+    return datetime.fromtimestamp(int(epoch), TZ)
+
+
+def _migracion_v1(conn):
+    """
+    Columnas tipadas (valor_num, ts_epoch, estado) rellenadas por lotes,
+    duplicados (tag, ts_epoch) eliminados e índice UNIQUE sobre (tag, ts_epoch).
+    """
+    for tabla in ("lecturas", "lecturas_agua"):
+        columnas = {r[1] for r in conn.execute(f"PRAGMA table_info({tabla})")}
+        for col, tipo in (("valor_num", "REAL"), ("ts_epoch", "INTEGER"), ("estado", "INTEGER")):
+            if col not in columnas:
+                conn.execute(f"ALTER TABLE {tabla} ADD COLUMN {col} {tipo}")
+        conn.commit()
+
+        total = 0
+        while True:
+            filas = conn.execute(
+                f"SELECT rowid, valor, ts FROM {tabla} WHERE ts_epoch IS NULL LIMIT ?",
+                (_MIGRACION_LOTE,),
+            ).fetchall()
+            if not filas:
+                break
+            lote = []
+            for rowid, valor, ts in filas:
+                num, estado = clasificar_valor(valor)
+                try:
+                    epoch = ts_a_epoch(ts)
+                except ValueError:
+                    epoch = 0  # ts ilegible: se conserva la fila pero queda fuera de cualquier rango
+                lote.append((num, epoch, estado, rowid))
+            conn.executemany(
+                f"UPDATE {tabla} SET valor_num = ?, ts_epoch = ?, estado = ? WHERE rowid = ?", lote
+            )
+            conn.commit()
+            total += len(lote)
+        if total:
+            log.info(f"[migración] {tabla}: {total} filas convertidas a valor_num/ts_epoch/estado")
+
+        borradas = conn.execute(
+            f"""
+            DELETE FROM {tabla}
+            WHERE rowid NOT IN (SELECT MIN(rowid) FROM {tabla} GROUP BY tag, ts_epoch)
+            """
+        ).rowcount
+        if borradas:
+            log.warning(f"[migración] {tabla}: {borradas} lecturas duplicadas eliminadas")
+
+        conn.execute(f"DROP INDEX IF EXISTS idx_{tabla}_tag_ts")
+        conn.execute(f"CREATE UNIQUE INDEX IF NOT EXISTS ux_{tabla}_tag_epoch ON {tabla}(tag, ts_epoch)")
+        conn.execute(f"CREATE INDEX IF NOT EXISTS idx_{tabla}_epoch ON {tabla}(ts_epoch)")
+        conn.commit()
+
+
+# Última lectura por tag, actualizada en la misma transacción que cada inserción
+_SQL_LATEST = {
+    "lecturas": """
+        CREATE TABLE IF NOT EXISTS lecturas_latest (
+            tag TEXT PRIMARY KEY,
+            descripcion TEXT NOT NULL,
+            valor TEXT NOT NULL,
+            ts TEXT NOT NULL,
+            nivel_max REAL NOT NULL,
+            valor_num REAL,
+            ts_epoch INTEGER NOT NULL,
+            estado INTEGER
+        )
+    """,
+    "lecturas_agua": """
+        CREATE TABLE IF NOT EXISTS lecturas_agua_latest (
+            tag TEXT PRIMARY KEY,
+            descripcion TEXT NOT NULL,
+            valor TEXT NOT NULL,
+            ts TEXT NOT NULL,
+            valor_num REAL,
+            ts_epoch INTEGER NOT NULL,
+            estado INTEGER
+        )
+    """,
+}
+_COLUMNAS = {
+    "lecturas": ("tag", "descripcion", "valor", "ts", "nivel_max", "valor_num", "ts_epoch", "estado"),
+    "lecturas_agua": ("tag", "descripcion", "valor", "ts", "valor_num", "ts_epoch", "estado"),
+}
+
+
+def reconstruir_latest(conn, tabla):
+    """Recalcula <tabla>_latest desde el histórico completo (una sola vez o tras reparar datos)."""
+    cols = ", ".join(_COLUMNAS[tabla])
+    cols_l = ", ".join(f"l.{c}" for c in _COLUMNAS[tabla])
+    conn.execute(f"DELETE FROM {tabla}_latest")
+    n = conn.execute(
+        f"""
+        INSERT INTO {tabla}_latest({cols})
+        SELECT {cols_l}
+        FROM {tabla} l
+        JOIN (
+            SELECT tag, MAX(ts_epoch) AS max_epoch
+            FROM {tabla}
+            GROUP BY tag
+        ) m ON l.tag = m.tag AND l.ts_epoch = m.max_epoch
+        """
+    ).rowcount
+    conn.commit()
+    return n
+
+
+def _migracion_v2(conn):
+    for tabla, ddl in _SQL_LATEST.items():
+        conn.execute(ddl)
+        n = reconstruir_latest(conn, tabla)
+        log.info(f"[migración] {tabla}_latest: {n} tags")
+
+
+# Agregados por tag e intervalo (hora / día local), mantenidos de forma incremental en cada
+# captura. bucket = epoch de inicio del intervalo; avg = suma / n_ok.
+ROLLUPS = {"rollup_hora": 3600, "rollup_dia": 86400}
+
+
+def _ddl_rollup(nombre):
+    return f"""
+        CREATE TABLE IF NOT EXISTS {nombre} (
+            tag TEXT NOT NULL,
+            bucket INTEGER NOT NULL,
+            n INTEGER NOT NULL,
+            n_error INTEGER NOT NULL,
+            n_ok INTEGER NOT NULL,
+            vmin REAL,
+            vmax REAL,
+            suma REAL,
+            first_ts INTEGER,
+            first_val REAL,
+            last_ts INTEGER,
+            last_val REAL,
+            PRIMARY KEY (tag, bucket)
+        ) WITHOUT ROWID
+    """
+
+
+def bucket_de(epoch, segundos):
+    """Inicio del intervalo: horas en UTC (Canarias tiene offset entero) y días en medianoche local."""
+    if segundos >= 86400:
+        return int(epoch_a_dt(epoch).replace(hour=0, minute=0, second=0).timestamp())
+    return int(epoch) - int(epoch) % segundos
+
+
+def _migracion_v3(conn):
+    for nombre in ROLLUPS:
+        conn.execute(_ddl_rollup(nombre))
+    conn.commit()
+    log.info(f"[migración] rollups: {reconstruir_rollups(conn)} filas")
+
+
+def _migracion_v4(conn):
+    # La retención conserva la última lectura de cada día: se busca por (tag, last_ts)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_rollup_dia_last ON rollup_dia(tag, last_ts)")
+    conn.commit()
+
+
+def _migracion_v5(conn):
+    # Cola de emails (ver encolar_email); `clave` es la clave de idempotencia
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS email_outbox (
+            id INTEGER PRIMARY KEY,
+            clave TEXT NOT NULL UNIQUE,
+            tipo TEXT NOT NULL,
+            asunto TEXT NOT NULL,
+            texto TEXT NOT NULL,
+            html TEXT NOT NULL,
+            destinatarios TEXT,
+            alertas TEXT,
+            estado TEXT NOT NULL DEFAULT 'pendiente',
+            intentos INTEGER NOT NULL DEFAULT 0,
+            proximo_intento INTEGER NOT NULL,
+            creado INTEGER NOT NULL,
+            enviado INTEGER,
+            ultimo_error TEXT
+        )
+        """
+    )
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_email_outbox_pendiente ON email_outbox(estado, proximo_intento)")
+    conn.commit()
+
+
+def _migracion_v6(conn):
+    # Último punto conservado (ancla) y puerta del swinging door de cada tag comprimido
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS compresion_estado (
+            tabla TEXT NOT NULL,
+            tag TEXT NOT NULL,
+            a_ts INTEGER NOT NULL,
+            a_val REAL,
+            a_estado INTEGER NOT NULL,
+            sup REAL,
+            inf REAL,
+            PRIMARY KEY (tabla, tag)
+        ) WITHOUT ROWID
+        """
+    )
+    conn.commit()
+
+
+def _migracion_v7(conn):
+    # Desglose por fases de las últimas capturas (ver guardar_desglose); fases en JSON
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS capturas_desglose (
+            id INTEGER PRIMARY KEY,
+            inicio INTEGER NOT NULL,
+            grupos TEXT NOT NULL,
+            backend TEXT NOT NULL,
+            ok INTEGER NOT NULL,
+            duracion_s REAL NOT NULL,
+            tags INTEGER NOT NULL,
+            tags_error INTEGER NOT NULL,
+            filas INTEGER NOT NULL,
+            fases TEXT NOT NULL,
+            error TEXT
+        )
+        """
+    )
+    conn.commit()
+
+
+_MIGRACIONES = (
+    (1, _migracion_v1),
+    (2, _migracion_v2),
+    (3, _migracion_v3),
+    (4, _migracion_v4),
+    (5, _migracion_v5),
+    (6, _migracion_v6),
+    (7, _migracion_v7),
+)
+
+
+def _migrar_esquema(conn):
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    for v, migracion in _MIGRACIONES:
+        if version < v:
+            migracion(conn)
+            conn.execute(f"PRAGMA user_version = {v}")
+            conn.commit()
+
+
+class Compresor:
+    """
+    Compresión por tag al insertar (deadband o swinging door) con heartbeat.
+
+    El histórico guarda siempre la lectura más reciente, de forma provisional. Al llegar la
+    siguiente se decide si la provisional hace falta para reconstruir la serie dentro de
+    `tolerancia` o se borra:
+      - deadband: cuando la nueva lectura se aleja más de `tolerancia`/2 del último punto
+        conservado (ancla) se conservan la provisional (última dentro de la banda) y la nueva,
+        que pasa a ser el ancla. Un escalón queda como dos puntos consecutivos.
+      - swinging_door: se conserva la provisional cuando la recta desde el ancla hasta la nueva
+        lectura se sale de la "puerta" que acotan las lecturas intermedias ± tolerancia.
+    En ambos casos la serie se reconstruye interpolando linealmente entre puntos conservados
+    (como la dibujan las sparklines, LTTB y /api/lecturas) con error máximo `tolerancia`.
+    Las lecturas no válidas y la primera válida tras ellas se conservan siempre, y se fija un
+    ancla como mínimo cada `heartbeat_s`. Los agregados (rollup_*) y <tabla>_latest ven todas
+    las lecturas, comprimidas o no.
+    """
+
+    def __init__(self, metodo, tolerancia, heartbeat_s=None):
+        self.metodo = metodo
+        self.tolerancia = float(tolerancia)
+        self.heartbeat_s = int(heartbeat_s or COMPRESION_HEARTBEAT_S)
+
+    @staticmethod
+    def _anclar(punto):
+        ts, val, estado = punto
+        return {"a_ts": ts, "a_val": val, "a_estado": estado, "sup": None, "inf": None}
+
+    def paso(self, ancla, previo, punto):
+        """
+        ancla: estado del último punto conservado (dict de _anclar) o None.
+        previo / punto: (ts_epoch, valor_num, estado) de la última lectura guardada y de la nueva.
+        Devuelve (conservar_previo, nueva_ancla).
+        """
+        if ancla is None or previo is None:
+            return True, self._anclar(punto)
+        ts, val, estado = punto
+        provisional = previo[0] != ancla["a_ts"]
+        if estado != ESTADO_OK or ancla["a_estado"] != ESTADO_OK or previo[2] != ESTADO_OK:
+            return True, self._anclar(punto)
+
+        tol = self.tolerancia
+        conservar = not provisional
+        if self.metodo == "deadband":
+            # Banda de ±tol/2: la recta del ancla a cualquier lectura de la banda queda a menos
+            # de tol de las intermedias
+            if abs(val - ancla["a_val"]) > tol / 2:
+                conservar = True
+                nueva = self._anclar(punto)
+            else:
+                nueva = ancla
+        else:
+            dt = ts - ancla["a_ts"]
+            sup = (val + tol - ancla["a_val"]) / dt
+            inf = (val - tol - ancla["a_val"]) / dt
+            if ancla["sup"] is not None:
+                sup, inf = min(sup, ancla["sup"]), max(inf, ancla["inf"])
+            if inf <= (val - ancla["a_val"]) / dt <= sup:
+                nueva = dict(ancla, sup=sup, inf=inf)
+            else:
+                # La puerta se ha cerrado: la provisional pasa a ser el ancla
+                conservar = True
+                p_ts, p_val, _ = previo
+                nueva = dict(
+                    self._anclar(previo),
+                    sup=(val + tol - p_val) / (ts - p_ts),
+                    inf=(val - tol - p_val) / (ts - p_ts),
+                )
+
+        if ts - nueva["a_ts"] >= self.heartbeat_s:
+            nueva = self._anclar(punto)
+        return conservar, nueva
+
+
+def _compresor_de(tag):
+    comp = REGISTRO_POR_TAG.get(tag, {}).get("compresion")
+    return Compresor(comp["metodo"], comp["tolerancia"], comp.get("heartbeat_s")) if comp else None
+
+
+def _insertar_comprimida(cur, tabla, compresor, fila, sql_insert, valores):
+    """Inserta `fila` y borra la lectura provisional anterior si el compresor no la necesita."""
+    tag = fila["tag"]
+    previo = cur.execute(
+        f"SELECT ts_epoch, valor_num, estado FROM {tabla} WHERE tag = ? ORDER BY ts_epoch DESC LIMIT 1",
+        (tag,),
+    ).fetchone()
+    if previo is not None and fila["ts_epoch"] <= previo[0]:
+        # Duplicado o relleno de huecos antiguos: sin compresión
+        cur.execute(sql_insert, valores)
+        return cur.rowcount == 1
+
+    r = cur.execute(
+        "SELECT a_ts, a_val, a_estado, sup, inf FROM compresion_estado WHERE tabla = ? AND tag = ?",
+        (tabla, tag),
+    ).fetchone()
+    ancla = dict(zip(("a_ts", "a_val", "a_estado", "sup", "inf"), r)) if r else None
+
+    cur.execute(sql_insert, valores)
+    conservar, ancla = compresor.paso(ancla, previo, (fila["ts_epoch"], fila["valor_num"], fila["estado"]))
+    if not conservar:
+        cur.execute(f"DELETE FROM {tabla} WHERE tag = ? AND ts_epoch = ?", (tag, previo[0]))
+    cur.execute(
+        """
+        INSERT OR REPLACE INTO compresion_estado(tabla, tag, a_ts, a_val, a_estado, sup, inf)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+        """,
+        (tabla, tag, ancla["a_ts"], ancla["a_val"], ancla["a_estado"], ancla["sup"], ancla["inf"]),
+    )
+    return True
+
+
+def _insertar_lecturas(cur, tabla, filas):
+    """
+    Inserta filas (dicts con _COLUMNAS[tabla]) en el histórico y actualiza <tabla>_latest
+    en la misma transacción. OR IGNORE: UNIQUE(tag, ts_epoch) evita duplicados si dos
+    capturas coinciden en el segundo. Los tags con compresión pasan por su Compresor.
+    Devuelve el número de filas insertadas en el histórico.
+    """
+    columnas = _COLUMNAS[tabla]
+    cols = ", ".join(columnas)
+    marcas = ", ".join("?" for _ in columnas)
+    sql_insert = f"INSERT OR IGNORE INTO {tabla}({cols}) VALUES ({marcas})"
+    valores = [tuple(f[c] for c in columnas) for f in filas]
+    insertadas = []
+    for f, v in zip(filas, valores):
+        compresor = _compresor_de(f["tag"])
+        if compresor is not None:
+            if _insertar_comprimida(cur, tabla, compresor, f, sql_insert, v):
+                insertadas.append(f)
+            continue
+        cur.execute(sql_insert, v)
+        if cur.rowcount == 1:
+            insertadas.append(f)
+    # Solo las filas realmente insertadas suman en los agregados
+    _actualizar_rollups(cur, insertadas)
+    actualizar = ", ".join(f"{c} = excluded.{c}" for c in columnas if c != "tag")
+    cur.executemany(
+        f"""
+        INSERT INTO {tabla}_latest({cols}) VALUES ({marcas})
+        ON CONFLICT(tag) DO UPDATE SET {actualizar}
+        WHERE excluded.ts_epoch >= {tabla}_latest.ts_epoch
+        """,
+        valores,
+    )
+    return len(insertadas)
+
+
+_SQL_UPSERT_ROLLUP = """
+    INSERT INTO {t}(tag, bucket, n, n_error, n_ok, vmin, vmax, suma, first_ts, first_val, last_ts, last_val)
+    VALUES (?, ?, 1, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ON CONFLICT(tag, bucket) DO UPDATE SET
+        n = n + 1,
+        n_error = n_error + excluded.n_error,
+        n_ok = n_ok + excluded.n_ok,
+        vmin = CASE WHEN vmin IS NULL OR excluded.vmin < vmin THEN excluded.vmin ELSE vmin END,
+        vmax = CASE WHEN vmax IS NULL OR excluded.vmax > vmax THEN excluded.vmax ELSE vmax END,
+        suma = COALESCE(suma, 0) + COALESCE(excluded.suma, 0),
+        first_val = CASE WHEN excluded.first_ts < COALESCE(first_ts, excluded.first_ts + 1)
+                         THEN excluded.first_val ELSE first_val END,
+        first_ts = CASE WHEN excluded.first_ts < COALESCE(first_ts, excluded.first_ts + 1)
+                        THEN excluded.first_ts ELSE first_ts END,
+        last_val = CASE WHEN excluded.last_ts >= COALESCE(last_ts, excluded.last_ts)
+                        THEN excluded.last_val ELSE last_val END,
+        last_ts = CASE WHEN excluded.last_ts >= COALESCE(last_ts, excluded.last_ts)
+                       THEN excluded.last_ts ELSE last_ts END
+"""
+
+
+def _actualizar_rollups(cur, filas):
+    for nombre, segundos in ROLLUPS.items():
+        lote = []
+        for f in filas:
+            num = f["valor_num"]
+            ok = num is not None
+            ts_ok = f["ts_epoch"] if ok else None
+            lote.append((
+                f["tag"], bucket_de(f["ts_epoch"], segundos),
+                int(f["estado"] != ESTADO_OK), int(ok),
+                num, num, num, ts_ok, num, ts_ok, num,
+            ))
+        cur.executemany(_SQL_UPSERT_ROLLUP.format(t=nombre), lote)
+
+
+def rollups_sin_cobertura(conn):
+    """
+    {tabla: (lecturas contadas en rollup_dia, filas en el histórico)} de las tablas cuyo histórico
+    ya no cubre lo que cuentan los agregados: la retención y la compresión borran lecturas que
+    los rollups siguen contando, y reconstruirlos desde el histórico las perdería.
+    """
+    res = {}
+    for tabla in ("lecturas", "lecturas_agua"):
+        filas = conn.execute(f"SELECT COUNT(*) FROM {tabla}").fetchone()[0]
+        contadas = conn.execute(
+            f"SELECT COALESCE(SUM(n), 0) FROM rollup_dia WHERE tag IN (SELECT tag FROM {tabla}_latest)"
+        ).fetchone()[0]
+        if contadas > filas:
+            res[tabla] = (contadas, filas)
+    return res
+
+
+def reconstruir_rollups(conn, forzar=False):
+    """
+    Recalcula rollup_hora y rollup_dia desde el histórico completo, tag a tag. Si el histórico ya
+    no cubre lo que cuentan los agregados (rollups_sin_cobertura) lanza ValueError, salvo con
+    `forzar`, que los deja como salgan del histórico que queda.
+    """
+    sin_cobertura = rollups_sin_cobertura(conn)
+    if sin_cobertura and not forzar:
+        raise ValueError(
+            "El histórico ya no cubre los agregados (retención o compresión): "
+            + ", ".join(f"{t} {n:,} lecturas agregadas y {f:,} filas" for t, (n, f) in sin_cobertura.items())
+        )
+    for nombre in ROLLUPS:
+        conn.execute(f"DELETE FROM {nombre}")
+    total = 0
+    for tabla in ("lecturas", "lecturas_agua"):
+        tags = [r[0] for r in conn.execute(f"SELECT DISTINCT tag FROM {tabla}")]
+        for tag in tags:
+            df = pd.read_sql_query(
+                f"SELECT ts_epoch, valor_num, estado FROM {tabla} WHERE tag = ? ORDER BY ts_epoch",
+                conn,
+                params=(tag,),
+            )
+            for nombre, segundos in ROLLUPS.items():
+                filas = _agregar_df(df, segundos)
+                filas.insert(0, "tag", tag)
+                conn.executemany(
+                    f"INSERT INTO {nombre} VALUES ({', '.join('?' for _ in filas.columns)})",
+                    filas.astype(object).where(filas.notna(), None).itertuples(index=False, name=None),
+                )
+                total += len(filas)
+            conn.commit()
+    return total
+
+
+def _agregar_df(df, segundos):
+    """Agrega lecturas (ts_epoch, valor_num, estado) ordenadas por ts en buckets de `segundos`."""
+    if segundos >= 86400:
+        locales = pd.to_datetime(df["ts_epoch"], unit="s", utc=True).dt.tz_convert(TZ).dt.normalize()
+        bucket = (locales - pd.Timestamp(0, tz="UTC")) // pd.Timedelta(seconds=1)
+    else:
+        bucket = df["ts_epoch"] - df["ts_epoch"] % segundos
+    ok = df[df["valor_num"].notna()]
+    res = pd.DataFrame({
+        "n": df.groupby(bucket).size(),
+        "n_error": (df["estado"] != ESTADO_OK).groupby(bucket).sum(),
+    })
+    res["bucket"] = res.index.astype("int64")
+    agg = ok.groupby(bucket[ok.index]).agg(
+        n_ok=("valor_num", "size"),
+        vmin=("valor_num", "min"),
+        vmax=("valor_num", "max"),
+        suma=("valor_num", "sum"),
+        first_ts=("ts_epoch", "first"),
+        first_val=("valor_num", "first"),
+        last_ts=("ts_epoch", "last"),
+        last_val=("valor_num", "last"),
+    )
+    res = res.join(agg)
+    res["n_ok"] = res["n_ok"].fillna(0).astype("int64")
+    cols = ["bucket", "n", "n_error", "n_ok", "vmin", "vmax", "suma", "first_ts", "first_val", "last_ts", "last_val"]
+    return res[cols].reset_index(drop=True)
+
+
+def consultar_serie(conn, tabla, tags, desde, hasta, paso=None):
+    """
+    Serie de lecturas de `tabla` para `tags` (None = todos) en [desde, hasta) (epoch).
+
+    Usa la resolución más gruesa que sigue cumpliendo `paso` (segundos): datos crudos si no
+    hay paso o es menor de una hora, rollup_hora o rollup_dia en otro caso. Con rollups el
+    resultado se reagrupa a `paso` y trae, además de valor_num (último valor del intervalo),
+    vmin, vmax, avg, n y n_error.
+    """
+    filtro_tags = ""
+    params = [desde, hasta]
+    if tags:
+        filtro_tags = f" AND tag IN ({', '.join('?' for _ in tags)})"
+        params += list(tags)
+
+    fuente = None
+    for nombre, segundos in sorted(ROLLUPS.items(), key=lambda x: -x[1]):
+        if paso and paso >= segundos:
+            fuente = nombre
+            break
+
+    if fuente is None:
+        return pd.read_sql_query(
+            f"""
+            SELECT tag, ts_epoch, valor_num, estado FROM {tabla}
+            WHERE ts_epoch >= ? AND ts_epoch < ?{filtro_tags}
+            ORDER BY tag, ts_epoch
+            """,
+            conn,
+            params=params,
+        )
+
+    # Los tags de combustible y agua no se solapan: se filtran a los de la tabla pedida
+    df = pd.read_sql_query(
+        f"""
+        SELECT * FROM {fuente}
+        WHERE bucket >= ? AND bucket < ?{filtro_tags}
+          AND tag IN (SELECT tag FROM {tabla}_latest)
+        ORDER BY tag, bucket
+        """,
+        conn,
+        params=params,
+    )
+    if df.empty:
+        return df.assign(ts_epoch=[], valor_num=[], avg=[])
+
+    base = ROLLUPS[fuente]
+    if paso > base:
+        # Reagrupar a `paso`, alineado con `desde`
+        df["grupo"] = desde + (df["bucket"] - desde) // paso * paso
+        df = df.groupby(["tag", "grupo"], sort=True).agg(
+            n=("n", "sum"), n_error=("n_error", "sum"), n_ok=("n_ok", "sum"),
+            vmin=("vmin", "min"), vmax=("vmax", "max"), suma=("suma", "sum"),
+            first_ts=("first_ts", "min"), last_ts=("last_ts", "max"),
+            first_val=("first_val", "first"), last_val=("last_val", "last"),
+        ).reset_index().rename(columns={"grupo": "bucket"})
+
+    df["avg"] = df["suma"] / df["n_ok"].where(df["n_ok"] > 0)
+    df["ts_epoch"] = df["bucket"]
+    df["valor_num"] = df["last_val"]
+    return df
+
+
+_SERIE_BLOQUE = 5000  # filas por consulta keyset al recorrer una serie
+
+
+def iterar_serie(conn, tabla, tags, desde, hasta, paso=None, cursor=None):
+    """
+    Igual que consultar_serie pero en streaming: genera dicts en orden (tag, ts_epoch) leyendo
+    por bloques keyset sobre (tag, ts), sin OFFSET ni cargar la serie entera en memoria.
+    Cada bloque es una consulta corta, así que no se mantiene abierta una lectura larga sobre el WAL.
+
+    `cursor` = (tag, ts_epoch) de la última fila ya entregada; se continúa justo después. Con
+    `paso` cada fila es el agregado del intervalo [ts_epoch, ts_epoch + paso) alineado con `desde`.
+    """
+    filtro_tags = ""
+    params_tags = []
+    if tags:
+        filtro_tags = f" AND tag IN ({', '.join('?' for _ in tags)})"
+        params_tags = list(tags)
+
+    fuente = None
+    for nombre, segundos in sorted(ROLLUPS.items(), key=lambda x: -x[1]):
+        if paso and paso >= segundos:
+            fuente = nombre
+            break
+
+    if fuente is None:
+        sql = f"""
+            SELECT tag, ts_epoch, valor_num, estado FROM {tabla}
+            WHERE ts_epoch >= ? AND ts_epoch < ?{filtro_tags} AND (tag, ts_epoch) >= (?, ?)
+            ORDER BY tag, ts_epoch LIMIT ?
+        """
+    else:
+        sql = f"""
+            SELECT tag, bucket, n, n_error, n_ok, vmin, vmax, suma, last_ts, last_val FROM {fuente}
+            WHERE bucket >= ? AND bucket < ?{filtro_tags} AND (tag, bucket) >= (?, ?)
+              AND tag IN (SELECT tag FROM {tabla}_latest)
+            ORDER BY tag, bucket LIMIT ?
+        """
+
+    # Con paso igual al del rollup se respeta su bucket (el diario va a medianoche local)
+    reagrupar = bool(paso) and not (fuente and paso == ROLLUPS[fuente])
+
+    def filas():
+        tag, ts = cursor or ("", 0)
+        if cursor:
+            ts += paso if reagrupar else 1
+        while True:
+            bloque = conn.execute(sql, [desde, hasta] + params_tags + [tag, ts, _SERIE_BLOQUE]).fetchall()
+            yield from bloque
+            if len(bloque) < _SERIE_BLOQUE:
+                return
+            tag, ts = bloque[-1][0], bloque[-1][1] + 1
+
+    if not paso:
+        for tag, ts, valor_num, estado in filas():
+            yield {"tag": tag, "ts_epoch": ts, "valor_num": valor_num, "estado": ESTADOS.get(estado, "error")}
+        return
+
+    # Agregación en línea: las filas llegan ordenadas, basta con cerrar el grupo al cambiar de clave
+    actual = None
+    for fila in filas():
+        if fuente is None:
+            tag, ts, valor_num, estado = fila
+            ok = estado == ESTADO_OK and valor_num is not None
+            n, n_error, n_ok = 1, int(estado != ESTADO_OK), int(ok)
+            vmin = vmax = suma = last_val = valor_num if ok else None
+            last_ts = ts
+        else:
+            tag, ts, n, n_error, n_ok, vmin, vmax, suma, last_ts, last_val = fila
+        grupo = desde + (ts - desde) // paso * paso if reagrupar else ts
+        if actual is None or actual["tag"] != tag or actual["ts_epoch"] != grupo:
+            if actual is not None:
+                yield _cerrar_grupo(actual)
+            actual = {"tag": tag, "ts_epoch": grupo, "n": 0, "n_error": 0, "n_ok": 0,
+                      "vmin": None, "vmax": None, "suma": 0.0, "last_ts": None, "valor_num": None}
+        actual["n"] += n
+        actual["n_error"] += n_error
+        actual["n_ok"] += n_ok
+        if vmin is not None:
+            actual["vmin"] = vmin if actual["vmin"] is None else min(actual["vmin"], vmin)
+            actual["vmax"] = vmax if actual["vmax"] is None else max(actual["vmax"], vmax)
+            actual["suma"] += suma
+        if last_val is not None and (actual["last_ts"] is None or last_ts >= actual["last_ts"]):
+            actual["last_ts"], actual["valor_num"] = last_ts, last_val
+    if actual is not None:
+        yield _cerrar_grupo(actual)
+
+
+def _cerrar_grupo(fila):
+    fila["avg"] = fila.pop("suma") / fila["n_ok"] if fila["n_ok"] else None
+    del fila["last_ts"]
+    return fila
+
+
+def simular_compresion(compresor, puntos):
+    """Puntos (ts_epoch, valor_num, estado) que quedarían en el histórico con `compresor`."""
+    guardados = []
+    ancla = None
+    for p in puntos:
+        previo = guardados[-1] if guardados else None
+        conservar, ancla = compresor.paso(ancla, previo, p)
+        if previo is not None and not conservar:
+            guardados.pop()
+        guardados.append(p)
+    return guardados
+
+
+def error_reconstruccion(compresor, puntos, guardados):
+    """Máximo |original - reconstruida| en las lecturas válidas (interpolación lineal entre guardados)."""
+    ok = [(t, v) for t, v, e in puntos if e == ESTADO_OK]
+    base = [(t, v) for t, v, e in guardados if e == ESTADO_OK]
+    if not ok or not base:
+        return 0.0
+    x, y = np.array(ok, dtype=float).T
+    bx, by = np.array(base, dtype=float).T
+    return float(np.max(np.abs(np.interp(x, bx, by) - y)))
+
+
+@app.cli.command("compresion-informe")
+@click.option("--metodo", type=click.Choice(METODOS_COMPRESION), help="Probar este método en todos los tags.")
+@click.option("--tolerancia", type=float, default=0.05, show_default=True, help="Con --metodo.")
+@click.option("--heartbeat", type=int, default=COMPRESION_HEARTBEAT_S, show_default=True, help="Con --metodo (s).")
+def cli_compresion_informe(metodo, tolerancia, heartbeat):
+    """
+    Ratio de compresión y error máximo de reconstrucción sobre el histórico actual, con la
+    compresión del registro o la indicada en --metodo. Útil para elegir tolerancias antes de activarla
+    (sobre datos ya comprimidos el ratio es el adicional).
+    """
+    init_db()
+    conn = _db_connect()
+    total_n = total_g = 0
+    for grupo, tabla in GRUPOS.items():
+        print(f"== {grupo} ({tabla})")
+        for tag in tags_de(grupo):
+            compresor = Compresor(metodo, tolerancia, heartbeat) if metodo else _compresor_de(tag)
+            if compresor is None:
+                print(f"  {tag}: sin compresión configurada")
+                continue
+            puntos = conn.execute(
+                f"SELECT ts_epoch, valor_num, estado FROM {tabla} WHERE tag = ? ORDER BY ts_epoch", (tag,)
+            ).fetchall()
+            if not puntos:
+                continue
+            guardados = simular_compresion(compresor, puntos)
+            error = error_reconstruccion(compresor, puntos, guardados)
+            total_n += len(puntos)
+            total_g += len(guardados)
+            print(
+                f"  {tag}: {len(puntos)} -> {len(guardados)} ({len(puntos) / len(guardados):.1f}x), "
+                f"error máx {error:.4g} (tolerancia {compresor.tolerancia:g}, {compresor.metodo})"
+            )
+    conn.close()
+    if total_g:
+        print(f"Total: {total_n} -> {total_g} lecturas ({total_n / total_g:.1f}x)")
+
+
+@app.cli.command("rebuild-rollups")
+@click.option("--forzar", is_flag=True, help="Reconstruir aunque el histórico ya no cubra los agregados.")
+def cli_rebuild_rollups(forzar):
+    """Reconstruye rollup_hora y rollup_dia desde el histórico."""
+    init_db()
+    conn = _db_connect()
+    try:
+        print(f"{reconstruir_rollups(conn, forzar=forzar)} filas de agregados")
+    except ValueError as e:
+        raise click.ClickException(f"{e}. Se perderían: usa --forzar para reconstruir igualmente")
+    finally:
+        conn.close()
+
+
+@app.cli.command("rebuild-latest")
+def cli_rebuild_latest():
+    """Reconstruye lecturas_latest y lecturas_agua_latest desde el histórico."""
+    init_db()
+    conn = _db_connect()
+    for tabla in _SQL_LATEST:
+        print(f"{tabla}_latest: {reconstruir_latest(conn, tabla)} tags")
+    conn.close()
+
+
+# -------------------
+# RETENCIÓN
+# -------------------
+def _tamano_bd():
+    return sum(os.path.getsize(p) for p in (DB_NAME, DB_NAME + "-wal") if os.path.exists(p))
+
+
+def _retener_tag(conn, tabla, tag, corte, lote):
+    """
+    Borra las lecturas de `tag` anteriores a `corte` cuya siguiente lectura es del mismo día
+    local: queda la última que exista de cada día (la de rollup_dia puede haberla quitado la
+    compresión). Recorre el tag una vez, por bloques keyset sobre (tag, ts_epoch): lo ya
+    decidido no se vuelve a leer. Devuelve las filas borradas.
+    """
+    # Siguiente de la última lectura antigua: la primera que se conserva entera
+    primera_reciente = conn.execute(
+        f"SELECT MIN(ts_epoch) FROM {tabla} WHERE tag = ? AND ts_epoch >= ?", (tag, corte)
+    ).fetchone()[0]
+    borradas, desde = 0, None
+    while True:
+        filas = conn.execute(
+            f"""
+            SELECT rowid, ts_epoch FROM {tabla}
+            WHERE tag = ? AND ts_epoch > ? AND ts_epoch < ?
+            ORDER BY ts_epoch LIMIT ?
+            """,
+            (tag, -1 if desde is None else desde, corte, lote),
+        ).fetchall()
+        if not filas:
+            return borradas
+        ultimo = len(filas) < lote
+        dias = [bucket_de(ts, 86400) for _, ts in filas]
+        if ultimo:
+            dias.append(None if primera_reciente is None else bucket_de(primera_reciente, 86400))
+        # Sin la última fila del bloque si no es el final: su siguiente llega en el bloque que viene
+        rowids = [filas[i][0] for i in range(len(dias) - 1) if dias[i] == dias[i + 1]]
+        if rowids:
+            conn.execute(f"DELETE FROM {tabla} WHERE rowid IN ({', '.join('?' for _ in rowids)})", rowids)
+            conn.commit()
+            borradas += len(rowids)
+            time.sleep(RETENCION_PAUSA_S)
+        if ultimo:
+            return borradas
+        desde = filas[-2][1]
+
+
+def aplicar_retencion(dias=None, lote=None):
+    """
+    Reduce las lecturas crudas con más de `dias` días a la última lectura que quede de cada tag
+    y día local (los agregados rollup_* se conservan íntegros), borrando en transacciones pequeñas para
+    no bloquear a los lectores (ver _retener_tag). Después libera páginas (incremental_vacuum, si la
+    BD ya tiene auto_vacuum=INCREMENTAL; ver compactar_bd) y trunca el WAL.
+    Devuelve un resumen con filas borradas y bytes recuperados.
+    """
+    dias = RETENCION_RAW_DIAS if dias is None else dias
+    lote = max(2, RETENCION_LOTE if lote is None else lote)
+    t0 = time.monotonic()
+    bytes_antes = _tamano_bd()
+    resumen = {"dias": dias, "borradas": {}}
+
+    conn = _db_connect()
+    try:
+        if dias > 0:
+            corte = int(datetime.now(TZ).timestamp()) - dias * 86400
+            for tabla in ("lecturas", "lecturas_agua"):
+                tags = [r[0] for r in conn.execute(f"SELECT DISTINCT tag FROM {tabla}")]
+                resumen["borradas"][tabla] = sum(_retener_tag(conn, tabla, tag, corte, lote) for tag in tags)
+
+        # Sin auto_vacuum=INCREMENTAL las páginas libres se reutilizan pero el fichero no encoge;
+        # el VACUUM completo que hace falta para cambiarlo bloquea las capturas y no se hace aquí
+        if conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 2:
+            libres = conn.execute("PRAGMA freelist_count").fetchone()[0]
+            conn.execute(f"PRAGMA incremental_vacuum({libres})").fetchall()
+        else:
+            log.warning(
+                "[retención] La BD no tiene auto_vacuum=INCREMENTAL: ejecuta `flask compactar-bd` para liberar espacio"
+            )
+        conn.execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchall()
+    finally:
+        conn.close()
+
+    resumen["bytes_antes"] = bytes_antes
+    resumen["bytes_despues"] = _tamano_bd()
+    resumen["bytes_recuperados"] = bytes_antes - resumen["bytes_despues"]
+    resumen["segundos"] = round(time.monotonic() - t0, 1)
+    log.info(
+        f"[retención] borradas={resumen['borradas']} "
+        f"recuperados={resumen['bytes_recuperados'] / 1024 / 1024:.1f} MB "
+        f"({bytes_antes / 1024 / 1024:.1f} -> {resumen['bytes_despues'] / 1024 / 1024:.1f} MB) "
+        f"en {resumen['segundos']}s"
+    )
+    return resumen
+
+
+def job_retencion():
+    try:
+        aplicar_retencion()
+    except Exception as e:
+        log.error(f"[retención] Error: {e}")
+
+
+@app.cli.command("retencion")
+def cli_retencion():
+    """Aplica la política de retención ahora y muestra los bytes recuperados."""
+    init_db()
+    aplicar_retencion()
+
+
+def compactar_bd():
+    """
+    VACUUM completo, pasando la BD a auto_vacuum=INCREMENTAL si aún no lo está (después la
+    retención ya libera espacio sola). Reescribe la BD entera y la bloquea mientras tanto, así
+    que toma el lock de capturas: una captura que llegue espera a que termine.
+    Devuelve (bytes antes, bytes después).
+    """
+    bytes_antes = _tamano_bd()
+    os.makedirs(os.path.dirname(CAPTURA_LOCK_FILE), exist_ok=True)
+    with open(CAPTURA_LOCK_FILE, "a") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        conn = _db_connect()
+        try:
+            conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+            conn.execute("VACUUM")
+            conn.execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchall()
+        finally:
+            conn.close()
+            fcntl.flock(f, fcntl.LOCK_UN)
+    return bytes_antes, _tamano_bd()
+
+
+@app.cli.command("compactar-bd")
+def cli_compactar_bd():
+    """VACUUM completo (y auto_vacuum=INCREMENTAL). Bloquea la BD: mejor fuera de horas de captura."""
+    init_db()
+    t0 = time.monotonic()
+    antes, despues = compactar_bd()
+    print(
+        f"BD compactada en {time.monotonic() - t0:.1f}s: "
+        f"{antes / 1024 / 1024:.1f} -> {despues / 1024 / 1024:.1f} MB"
+    )
+
+
 # -------------------
 # SCRAPING
 # -------------------
@@ -145,12 +1410,10 @@ def _kill_orphan_chrome():
         subprocess.run(["pkill", "-f", "chromedriver"], capture_output=True)
         time.sleep(1)
     except Exception as e:
-        print(f"[build_driver] No se pudo limpiar procesos huérfanos: {e}")
+        log.warning(f"[build_driver] No se pudo limpiar procesos huérfanos: {e}")
 
 
 def build_driver():
-    _kill_orphan_chrome()
-
     options = Options()
     options.add_argument("--headless=new")
     options.add_argument(f"--window-size={WINDOW_W},{WINDOW_H}")
@@ -182,106 +1445,1175 @@ def build_driver():
     return driver
 
 
-def ejecutar_scrapping(incluir_agua=False):
-    ts_now = datetime.now(TZ).isoformat(timespec="seconds")
-    print(f"[{ts_now}] Iniciando captura (agua={incluir_agua})...")
-
-    driver = build_driver()
+def _rss_arbol_mb(pid):
+    """RSS total (MB) de un proceso y todos sus descendientes, leído de /proc."""
+    hijos = {}
     try:
-        set_basic_auth_header(driver, USERNAME, PASSWORD1)
+        for entrada in os.listdir("/proc"):
+            if not entrada.isdigit():
+                continue
+            try:
+                with open(f"/proc/{entrada}/stat") as fh:
+                    ppid = int(fh.read().rsplit(")", 1)[1].split()[1])
+            except Exception:
+                continue
+            hijos.setdefault(ppid, []).append(int(entrada))
+    except FileNotFoundError:
+        return None
 
-        driver.get(PI_BASE_URL)
-        time.sleep(5)
+    total_kb = 0
+    pendientes = [pid]
+    while pendientes:
+        p = pendientes.pop()
+        pendientes.extend(hijos.get(p, []))
+        try:
+            with open(f"/proc/{p}/status") as fh:
+                for linea in fh:
+                    if linea.startswith("VmRSS:"):
+                        total_kb += int(linea.split()[1])
+                        break
+        except Exception:
+            continue
+    return total_kb / 1024.0
 
-        target_url = PI_BASE_URL + DISPLAY_HASH
-        print(f"Navegando a: {target_url}")
-        driver.get(target_url)
 
-        primer_tag = DATOS_A_BUSCAR[0][0]
-        print(f"Esperando tag: {primer_tag}...")
+def _cerrar_driver(driver):
+    """Cierra un driver; si quit() falla, mata solo su chromedriver (no todo chrome)."""
+    try:
+        driver.quit()
+    except Exception as e:
+        log.warning(f"[pool] quit() falló ({e}), matando proceso del driver")
+        try:
+            os.kill(driver.service.process.pid, signal.SIGKILL)
+        except Exception:
+            pass
+
 
+class _SesionDriver:
+    def __init__(self, driver):
+        self.driver = driver
+        self.creada = time.monotonic()
+        self.capturas = 0
+
+    @property
+    def pid(self):
         try:
-            WebDriverWait(driver, 60).until(
-                EC.presence_of_element_located((By.XPATH, f"//div[contains(@title, '{primer_tag}')]"))
-            )
-        except Exception as te:
-            print(f"Timeout esperando elementos. URL actual: {driver.current_url}")
-            driver.save_screenshot(SCREENSHOT_PATH)
-            raise te
+            return self.driver.service.process.pid
+        except Exception:
+            return None
 
-        time.sleep(5)
-        driver.save_screenshot(SCREENSHOT_PATH)
 
-        conn = _db_connect()
-        cur = conn.cursor()
+class DriverPool:
+    """
+    Pool de sesiones Chromium ya autenticadas y reutilizables entre capturas.
 
-        # 1. Scrapping de Combustible (Comportamiento habitual)
-        for tag, descripcion, nivel_max in DATOS_A_BUSCAR:
-            try:
-                elemento = driver.find_element(By.XPATH, f"//div[contains(@title, '{tag}')]")
-                valor = (elemento.text or "").strip()
-                if not valor:
-                    valor = driver.execute_script("return arguments[0].innerText;", elemento).strip()
-
-                cur.execute(
-                    "INSERT INTO lecturas(tag, descripcion, valor, ts, nivel_max) VALUES (?, ?, ?, ?, ?)",
-                    (tag, descripcion, valor or "---", ts_now, float(nivel_max)),
-                )
-            except Exception:
-                cur.execute(
-                    "INSERT INTO lecturas(tag, descripcion, valor, ts, nivel_max) VALUES (?, ?, ?, ?, ?)",
-                    (tag, descripcion, "Error", ts_now, float(nivel_max)),
+    Cada sesión se comprueba (current_url) antes de entregarla y se recicla tras
+    DRIVER_MAX_CAPTURAS usos, al superar DRIVER_MAX_RSS_MB o DRIVER_MAX_EDAD_H.
+    Una sesión cuyo uso termina con excepción se descarta.
+    """
+
+    def __init__(self, tamano, max_capturas, max_rss_mb, max_edad_h):
+        self.tamano = tamano
+        self.max_capturas = max_capturas
+        self.max_rss_mb = max_rss_mb
+        self.max_edad_s = max_edad_h * 3600
+        self._libres = []
+        self._total = 0
+        self._cond = threading.Condition()
+        self._limpieza_hecha = False
+
+    @contextmanager
+    def sesion(self):
+        ses = self._adquirir()
+        ok = False
+        try:
+            yield ses.driver
+            ok = True
+        finally:
+            self._liberar(ses, descartar=not ok)
+
+    def _abrir(self):
+        # Solo se matan procesos huérfanos la primera vez (al arrancar), nunca
+        # mientras haya sesiones vivas del pool. Con el lock del pool: si dos displays
+        # abren sesión a la vez, el segundo espera a que termine la limpieza.
+        with self._cond:
+            if not self._limpieza_hecha:
+                _kill_orphan_chrome()
+                self._limpieza_hecha = True
+
+        t0 = time.monotonic()
+        with medir_fase("arranque_driver"):
+            driver = build_driver()
+        try:
+            with medir_fase("login"):
+                set_basic_auth_header(driver, USERNAME, PASSWORD1)
+                driver.get(PI_BASE_URL)
+            with medir_fase("espera_login"):
+                WebDriverWait(driver, CAPTURE_READY_TIMEOUT_S).until(
+                    lambda d: d.execute_script("return document.readyState") == "complete"
                 )
+        except Exception:
+            _cerrar_driver(driver)
+            raise
+        log.info(f"[pool] Nueva sesión Chromium lista en {time.monotonic() - t0:.1f}s")
+        return _SesionDriver(driver)
+
+    def _sana(self, ses):
+        try:
+            ses.driver.current_url
+            return True
+        except Exception as e:
+            log.warning(f"[pool] Sesión no responde, se descarta: {e}")
+            return False
+
+    def _motivo_reciclado(self, ses):
+        if self.max_capturas and ses.capturas >= self.max_capturas:
+            return f"{ses.capturas} capturas"
+        if self.max_edad_s and time.monotonic() - ses.creada >= self.max_edad_s:
+            return "edad máxima"
+        if self.max_rss_mb and ses.pid:
+            rss = _rss_arbol_mb(ses.pid)
+            if rss is not None and rss >= self.max_rss_mb:
+                return f"RSS {rss:.0f} MB"
+        return None
 
-        # 2. Scrapping de Agua (Solo si incluir_agua es True)
-        if incluir_agua:
-            print("Capturando datos de agua...")
-            for tag, descripcion in DATOS_AGUA:
+    def _adquirir(self):
+        while True:
+            with self._cond:
+                while not self._libres and self._total >= self.tamano:
+                    self._cond.wait()
+                if self._libres:
+                    ses = self._libres.pop()
+                else:
+                    ses = None
+                    self._total += 1
+
+            if ses is None:
                 try:
-                    elemento = driver.find_element(By.XPATH, f"//div[contains(@title, '{tag}')]")
-                    valor = (elemento.text or "").strip()
-                    if not valor:
-                        valor = driver.execute_script("return arguments[0].innerText;", elemento).strip()
-
-                    cur.execute(
-                        "INSERT INTO lecturas_agua(tag, descripcion, valor, ts) VALUES (?, ?, ?, ?)",
-                        (tag, descripcion, valor or "---", ts_now),
-                    )
+                    return self._abrir()
                 except Exception:
-                    cur.execute(
-                        "INSERT INTO lecturas_agua(tag, descripcion, valor, ts) VALUES (?, ?, ?, ?)",
-                        (tag, descripcion, "Error", ts_now),
-                    )
+                    with self._cond:
+                        self._total -= 1
+                        self._cond.notify()
+                    raise
+
+            if self._sana(ses):
+                return ses
+            self._descartar(ses)
+
+    def _descartar(self, ses):
+        _cerrar_driver(ses.driver)
+        with self._cond:
+            self._total -= 1
+            self._cond.notify()
+
+    def _liberar(self, ses, descartar=False):
+        ses.capturas += 1
+        motivo = "error durante la captura" if descartar else self._motivo_reciclado(ses)
+        if motivo:
+            log.info(f"[pool] Reciclando sesión ({motivo})")
+            self._descartar(ses)
+            return
+        with self._cond:
+            self._libres.append(ses)
+            self._cond.notify()
+
+    def cerrar(self):
+        with self._cond:
+            libres, self._libres = self._libres, []
+            self._total -= len(libres)
+            self._cond.notify_all()
+        for ses in libres:
+            _cerrar_driver(ses.driver)
+
+
+DRIVER_POOL = DriverPool(DRIVER_POOL_SIZE, DRIVER_MAX_CAPTURAS, DRIVER_MAX_RSS_MB, DRIVER_MAX_EDAD_H)
+atexit.register(DRIVER_POOL.cerrar)
+
+
+# Recorre el DOM una sola vez y construye title -> innerText para los tags pedidos.
+# Como el XPath original (//div[contains(@title, tag)]), gana el primer div en orden de documento.
+_JS_FN_EXTRAER = r"""
+function extraer(tags) {
+    var res = {};
+    var pendientes = tags.length;
+    var divs = document.querySelectorAll('div[title]');
+    for (var i = 0; i < divs.length && pendientes > 0; i++) {
+        var title = divs[i].getAttribute('title');
+        for (var j = 0; j < tags.length; j++) {
+            var tag = tags[j];
+            if (res[tag] === undefined && title.indexOf(tag) !== -1) {
+                var txt = (divs[i].innerText || divs[i].textContent || '').trim();
+                res[tag] = {estado: txt ? 'ok' : 'vacio', valor: txt};
+                pendientes--;
+            }
+        }
+    }
+    for (var k = 0; k < tags.length; k++) {
+        if (res[tags[k]] === undefined) {
+            res[tags[k]] = {estado: 'no_encontrado', valor: ''};
+        }
+    }
+    return res;
+}
+"""
+
+_JS_EXTRAER_TAGS = _JS_FN_EXTRAER + "return JSON.stringify(extraer(arguments[0]));"
+
+# Script asíncrono: un MutationObserver re-extrae (agrupando ráfagas de mutaciones) y
+# responde en cuanto todos los tags tienen valor y no han cambiado durante estable_ms,
+# o al llegar a limite_ms con lo que haya.
+_JS_ESPERAR_LISTO = _JS_FN_EXTRAER + r"""
+var tags = arguments[0], estableMs = arguments[1], limiteMs = arguments[2];
+var done = arguments[arguments.length - 1];
+var inicio = Date.now(), desde = inicio, firma = null, fin = false, programado = false;
+var obs = null, timer = null, extMs = 0;
+
+function terminar(listo, valores) {
+    fin = true;
+    if (obs) obs.disconnect();
+    clearInterval(timer);
+    done(JSON.stringify({listo: listo, ms: Date.now() - inicio, ext_ms: extMs, valores: valores}));
+}
+
+function comprobar() {
+    programado = false;
+    if (fin) return;
+    var t = Date.now();
+    var valores = extraer(tags);
+    extMs += Date.now() - t;
+    var f = JSON.stringify(valores);
+    var ahora = Date.now();
+    if (f !== firma) { firma = f; desde = ahora; }
+    var completo = true;
+    for (var i = 0; i < tags.length; i++) {
+        if (valores[tags[i]].estado !== 'ok') { completo = false; break; }
+    }
+    if (completo && ahora - desde >= estableMs) return terminar(true, valores);
+    if (ahora - inicio >= limiteMs) return terminar(false, valores);
+}
+
+obs = new MutationObserver(function () {
+    if (!programado) { programado = true; setTimeout(comprobar, 50); }
+});
+obs.observe(document.documentElement, {subtree: true, childList: true, characterData: true});
+// Sin mutaciones no hay callbacks: el intervalo cierra la ventana de estabilidad y el límite.
+timer = setInterval(comprobar, Math.max(100, Math.floor(estableMs / 4)));
+comprobar();
+"""
+
+
+def extraer_valores(driver, tags):
+    """
+    Extrae todos los tags en un único execute_script.
+    Devuelve dict: tag -> {estado: ok|vacio|no_encontrado, valor: str}
+    """
+    return json.loads(driver.execute_script(_JS_EXTRAER_TAGS, list(tags)))
+
+
+def esperar_display_listo(driver, tags, timeout_s=None, estable_ms=None, display=None):
+    """
+    Espera a que todos los tags tengan valor estable y devuelve lo extraído
+    (mismo formato que extraer_valores). Lanza TimeoutException si, agotado el
+    límite, no ha aparecido ninguno; si solo faltan algunos, se devuelven tal cual.
+    El tiempo se reparte en las fases espera_display y extraccion (el script mide lo
+    que dedica a extraer).
+    """
+    timeout_s = CAPTURE_READY_TIMEOUT_S if timeout_s is None else timeout_s
+    estable_ms = CAPTURE_ESTABLE_MS if estable_ms is None else estable_ms
+
+    driver.set_script_timeout(timeout_s + 10)
+    t0 = time.monotonic()
+    try:
+        r = json.loads(
+            driver.execute_async_script(_JS_ESPERAR_LISTO, list(tags), int(estable_ms), int(timeout_s * 1000))
+        )
+        total = time.monotonic() - t0
+        extraccion = min(total, r.get("ext_ms", 0) / 1000)
+        registrar_fase("espera_display", total - extraccion, display)
+        registrar_fase("extraccion", extraccion, display)
+    except Exception as e:
+        registrar_fase("espera_display", time.monotonic() - t0, display)
+        # Sin observer (p.ej. timeout del propio script): último intento directo
+        log.warning(f"Espera por MutationObserver fallida ({e}), extrayendo directamente")
+        with medir_fase("extraccion", display):
+            r = {"listo": False, "ms": None, "valores": extraer_valores(driver, tags)}
+
+    valores = r["valores"]
+    if r["listo"]:
+        log.info(f"Display listo en {r['ms'] / 1000:.1f}s")
+        return valores
+
+    if all(valores.get(t, {}).get("estado") == "no_encontrado" for t in tags):
+        log.warning(f"Timeout esperando elementos. URL actual: {driver.current_url}")
+        raise TimeoutException(f"Ningún tag apareció en {timeout_s}s")
+    no_listos = [t for t in tags if valores.get(t, {}).get("estado") != "ok"]
+    log.warning(f"Display no estable tras {timeout_s}s; sin valor: {no_listos}")
+    return valores
+
+
+def _valor_a_guardar(resultado):
+    """Texto a persistir: el valor leído, '---' si el div estaba vacío o 'Error' si no apareció."""
+    if not resultado or resultado.get("estado") == "no_encontrado":
+        return "Error"
+    return resultado.get("valor") or "---"
+
+
+_DEBUG_EXT = {"jpeg": "jpg", "webp": "webp", "png": "png"}
+_DEBUG_MIME = {"jpg": "image/jpeg", "webp": "image/webp", "png": "image/png"}
+_debug_lock = threading.Lock()
+
+
+def guardar_captura_debug(driver, motivo):
+    """
+    Guarda una captura comprimida (y reducida a DEBUG_ESCALA) del navegador en DEBUG_DIR,
+    con nombre <timestamp>_<motivo>.<ext>, y poda el buffer circular.
+    """
+    formato = DEBUG_FORMATO if DEBUG_FORMATO in _DEBUG_EXT else "jpeg"
+    ts = datetime.now(TZ).strftime("%Y%m%dT%H%M%S")
+    try:
+        params = {
+            "format": formato,
+            "clip": {"x": 0, "y": 0, "width": WINDOW_W, "height": WINDOW_H, "scale": DEBUG_ESCALA},
+        }
+        if formato != "png":
+            params["quality"] = DEBUG_CALIDAD
+        datos = base64.b64decode(driver.execute_cdp_cmd("Page.captureScreenshot", params)["data"])
+        ext = _DEBUG_EXT[formato]
+    except Exception as e:
+        log.warning(f"[debug] CDP captureScreenshot falló ({e}), guardando PNG")
+        datos = driver.get_screenshot_as_png()
+        ext = "png"
+
+    nombre = f"{ts}_{re.sub(r'[^a-z0-9-]+', '-', motivo.lower()).strip('-')}.{ext}"
+    with _debug_lock:
+        with open(os.path.join(DEBUG_DIR, nombre), "wb") as fh:
+            fh.write(datos)
+        _podar_capturas_debug()
+    log.info(f"[debug] Captura guardada: {nombre} ({len(datos) / 1024:.0f} KB)")
+    return nombre
+
+
+def listar_capturas_debug():
+    """Lista [(nombre, bytes, mtime)] de la más reciente a la más antigua."""
+    res = []
+    for nombre in os.listdir(DEBUG_DIR):
+        if nombre.rsplit(".", 1)[-1] not in _DEBUG_MIME:
+            continue
+        st = os.stat(os.path.join(DEBUG_DIR, nombre))
+        res.append((nombre, st.st_size, st.st_mtime))
+    res.sort(reverse=True)
+    return res
+
+
+def _podar_capturas_debug():
+    capturas = listar_capturas_debug()
+    max_bytes = DEBUG_MAX_MB * 1024 * 1024
+    total = sum(c[1] for c in capturas)
+    # Se conserva siempre la más reciente aunque supere el límite de bytes
+    while len(capturas) > 1 and (len(capturas) > DEBUG_MAX_ARCHIVOS or total > max_bytes):
+        nombre, tam, _ = capturas.pop()
+        try:
+            os.remove(os.path.join(DEBUG_DIR, nombre))
+        except FileNotFoundError:
+            pass
+        total -= tam
+
+
+def _leer_display(driver, display, tags):
+    """Navega al display (clave del registro) con una sesión ya autenticada y devuelve los valores de los tags."""
+    target_url = PI_BASE_URL + REGISTRO["displays"][display]["hash"]
+    log.info(f"Navegando a: {target_url}")
+    with medir_fase("navegacion", display):
+        if driver.current_url == target_url:
+            # Mismo hash: driver.get() no recargaría la SPA y leeríamos valores viejos
+            driver.refresh()
+        else:
+            driver.get(target_url)
+
+    log.info(f"Esperando {len(tags)} tags (estables {CAPTURE_ESTABLE_MS} ms, máx {CAPTURE_READY_TIMEOUT_S} s)...")
+    return esperar_display_listo(driver, tags, display=display)
+
+
+# -------------------
+# BACKENDS DE CAPTURA
+# -------------------
+class CaptureBackend:
+    """
+    Interfaz: leer(tags) -> dict tag -> {estado: ok|vacio|no_encontrado, valor: str}.
+    captura_debug pide una captura de pantalla aunque la lectura vaya bien (si el backend puede).
+    """
+
+    nombre = "base"
+
+    def leer(self, tags, captura_debug=False):
+        raise NotImplementedError
+
+
+class SeleniumBackend(CaptureBackend):
+    """
+    Renderiza los displays de PI Vision en Chromium (sesiones del DRIVER_POOL).
+
+    Los tags se agrupan por display según el registro y los displays se leen en paralelo
+    (hasta `paralelo` a la vez), así que la captura dura lo que el display más lento.
+    Si falla un display sus tags quedan sin valor; solo si fallan todos se propaga el error.
+    """
+
+    nombre = "selenium"
+
+    def __init__(self, pool, paralelo=1):
+        self.pool = pool
+        self.paralelo = paralelo
+
+    def leer(self, tags, captura_debug=False):
+        por_display = {}
+        for tag in tags:
+            por_display.setdefault(REGISTRO_POR_TAG[tag]["display"], []).append(tag)
+
+        if len(por_display) == 1:
+            (display, tags_display), = por_display.items()
+            return self._leer_uno(display, tags_display, captura_debug)
+
+        t0 = time.monotonic()
+        valores, errores = {}, []
+        hilos = min(self.paralelo, len(por_display))
+        with ThreadPoolExecutor(max_workers=hilos, thread_name_prefix="display") as ex:
+            # Cada hilo con una copia del contexto: el log sigue yendo al trabajo que lo lanzó
+            futuros = {
+                ex.submit(contextvars.copy_context().run, self._leer_uno, d, t, captura_debug): d
+                for d, t in por_display.items()
+            }
+            for fut in as_completed(futuros):
+                try:
+                    valores.update(fut.result())
+                except Exception as e:
+                    log.warning(f"[{futuros[fut]}] Display sin leer: {e}")
+                    errores.append(e)
+        if len(errores) == len(por_display):
+            raise errores[0]
+        log.info(f"{len(por_display)} displays leídos en {time.monotonic() - t0:.1f}s ({hilos} en paralelo)")
+        return valores
+
+    def _leer_uno(self, display, tags, captura_debug):
+        t0 = time.monotonic()
+        with self.pool.sesion() as driver:
+            try:
+                valores = _leer_display(driver, display, tags)
+            except Exception:
+                try:
+                    guardar_captura_debug(driver, f"fallo-{display}")
+                except Exception as e:
+                    log.warning(f"[debug] No se pudo guardar la captura: {e}")
+                raise
+            if captura_debug or DEBUG_CAPTURA_SIEMPRE:
+                try:
+                    guardar_captura_debug(driver, f"ok-{display}")
+                except Exception as e:
+                    log.warning(f"[debug] No se pudo guardar la captura: {e}")
+        log.info(f"[{display}] {len(tags)} tags en {time.monotonic() - t0:.1f}s")
+        return valores
+
+
+class PiWebApiBackend(CaptureBackend):
+    """
+    Lee el valor actual de los tags por HTTP (PI Web API), sin navegador.
+
+    Los WebId se resuelven una vez con una petición /batch y se cachean; cada
+    lectura es un único GET a /streamsets/value con todos los WebId.
+    """
+
+    nombre = "webapi"
+
+    def __init__(self, base_url, user, password, servidor_defecto, timeout=15):
+        self.base_url = base_url.rstrip("/") + "/"
+        self.servidor_defecto = servidor_defecto
+        self.timeout = timeout
+        self.session = requests.Session()
+        self.session.auth = (user, password)
+        self.session.headers.update({"Accept": "application/json"})
+        adapter = requests.adapters.HTTPAdapter(pool_connections=2, pool_maxsize=4, max_retries=2)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self._webids = {}
+
+    def _ruta(self, tag):
+        # Tags de combustible: \PI-XXX\TAG ; tags de agua sin servidor -> servidor por defecto
+        if tag.startswith("\\"):
+            return "\\" + tag
+        return f"\\\\{self.servidor_defecto}\\{tag}"
+
+    def _resolver(self, tags):
+        pendientes = [t for t in tags if t not in self._webids]
+        if not pendientes:
+            return
+        lote = {
+            str(i): {
+                "Method": "GET",
+                "Resource": self.base_url + "points?" + urlencode({"path": self._ruta(t), "selectedFields": "WebId"}),
+            }
+            for i, t in enumerate(pendientes)
+        }
+        r = self.session.post(self.base_url + "batch", json=lote, timeout=self.timeout)
+        r.raise_for_status()
+        respuestas = r.json()
+        for i, t in enumerate(pendientes):
+            sub = respuestas.get(str(i)) or {}
+            if sub.get("Status") == 200 and (sub.get("Content") or {}).get("WebId"):
+                self._webids[t] = sub["Content"]["WebId"]
+
+    @staticmethod
+    def _formatear(item):
+        v = (item or {}).get("Value") or {}
+        valor = v.get("Value")
+        if isinstance(valor, dict):  # estado digital: {"Name": ..., "Value": ...}
+            valor = valor.get("Name")
+        if valor is None or v.get("Good") is False:
+            return {"estado": "vacio", "valor": ""}
+        if isinstance(valor, (int, float)):
+            txt = f"{valor:.2f} {v.get('UnitsAbbreviation') or ''}".strip()
+        else:
+            txt = str(valor).strip()
+        return {"estado": "ok" if txt else "vacio", "valor": txt}
+
+    def leer(self, tags, captura_debug=False):
+        with medir_fase("webapi_resolver"):
+            self._resolver(tags)
+        res = {t: {"estado": "no_encontrado", "valor": ""} for t in tags}
+        por_webid = {self._webids[t]: t for t in tags if t in self._webids}
+        if not por_webid:
+            return res
+
+        with medir_fase("webapi_lectura"):
+            r = self.session.get(
+                self.base_url + "streamsets/value",
+                params=[("webId", w) for w in por_webid] + [("selectedFields", "Items.WebId;Items.Value")],
+                timeout=self.timeout,
+            )
+            r.raise_for_status()
+        for item in r.json().get("Items", []):
+            tag = por_webid.get(item.get("WebId"))
+            if tag:
+                res[tag] = self._formatear(item)
+        return res
+
+
+SELENIUM_BACKEND = SeleniumBackend(DRIVER_POOL, CAPTURE_PARALELO)
+_backend_webapi = None
+
+
+def _get_backend_webapi():
+    global _backend_webapi
+    if _backend_webapi is None:
+        _backend_webapi = PiWebApiBackend(PI_WEBAPI_URL, USERNAME, PASSWORD1, PI_WEBAPI_SERVIDOR)
+    return _backend_webapi
+
+
+def capturar_valores(tags, backend=None, captura_debug=False):
+    """
+    Lee los tags con el backend configurado (CAPTURE_BACKEND). Si es 'webapi' y
+    falla, o deja tags sin valor, esos tags se leen con Selenium como respaldo.
+    """
+    backend = backend or CAPTURE_BACKEND
+    if backend != "webapi":
+        return SELENIUM_BACKEND.leer(tags, captura_debug=captura_debug)
+
+    try:
+        valores = _get_backend_webapi().leer(tags)
+    except Exception as e:
+        log.warning(f"[webapi] Error ({e}), usando Selenium")
+        return SELENIUM_BACKEND.leer(tags, captura_debug=captura_debug)
+
+    faltan = [t for t in tags if valores.get(t, {}).get("estado") != "ok"]
+    if faltan:
+        log.warning(f"[webapi] {len(faltan)} tags sin valor, completando con Selenium")
+        valores.update(SELENIUM_BACKEND.leer(faltan, captura_debug=captura_debug))
+    return valores
+
+
+def _guardar_lecturas(ahora, valores, grupos):
+    ts_now = ahora.isoformat(timespec="seconds")
+    ts_epoch = int(ahora.timestamp())
+
+    def fila(tag, descripcion, **extra):
+        valor = _valor_a_guardar(valores.get(tag))
+        num, estado = clasificar_valor(valor)
+        return {
+            "tag": tag, "descripcion": descripcion, "valor": valor, "ts": ts_now,
+            "valor_num": num, "ts_epoch": ts_epoch, "estado": estado, **extra,
+        }
+
+    conn = _db_connect()
+    cur = conn.cursor()
+    desglose = _desglose_actual
 
+    # Una tabla por grupo capturado (combustible -> lecturas, agua -> lecturas_agua)
+    with medir_fase("insercion"):
+        for grupo, tabla in GRUPOS.items():
+            if grupo not in grupos:
+                continue
+            filas = []
+            for t in REGISTRO["tags"]:
+                if t["grupo"] == grupo:
+                    extra = {"nivel_max": float(t["nivel_max"])} if tabla == "lecturas" else {}
+                    filas.append(fila(t["tag"], t["descripcion"], **extra))
+            n = _insertar_lecturas(cur, tabla, filas)
+            M_FILAS.inc(n, tabla=tabla)
+            errores = [f for f in filas if f["estado"] != ESTADO_OK]
+            for f in errores:
+                M_TAGS_ERROR.inc(grupo=grupo, estado=ESTADOS[f["estado"]])
+            if desglose is not None:
+                desglose.tags += len(filas)
+                desglose.tags_error += len(errores)
+                desglose.filas += n
+
+    with medir_fase("commit"):
+        conn.commit()
+    conn.close()
+    invalidar_cache_dashboard()
+
+
+def guardar_desglose(desglose, ok, duracion_s, error=None):
+    """
+    Guarda el desglose de una captura y poda la tabla a las últimas CAPTURAS_DESGLOSE_N,
+    conservando siempre las de las últimas 24 h (estado_planificacion las cuenta).
+    """
+    conn = _db_connect()
+    try:
+        conn.execute(
+            """
+            INSERT INTO capturas_desglose(inicio, grupos, backend, ok, duracion_s, tags, tags_error, filas, fases, error)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            """,
+            (
+                int(desglose.inicio), ",".join(desglose.grupos), desglose.backend, int(ok), round(duracion_s, 3),
+                desglose.tags, desglose.tags_error, desglose.filas, json.dumps(desglose.fases),
+                str(error)[:500] if error else None,
+            ),
+        )
+        conn.execute(
+            """
+            DELETE FROM capturas_desglose
+            WHERE id <= (SELECT MAX(id) FROM capturas_desglose) - ? AND inicio < ?
+            """,
+            (CAPTURAS_DESGLOSE_N, int(time.time()) - 86400),
+        )
         conn.commit()
+    finally:
         conn.close()
-        print("Captura finalizada con éxito.")
+
+
+def _ejecutar_captura(grupos=("combustible",), captura_debug=False):
+    global _desglose_actual
+    ahora = datetime.now(TZ).replace(microsecond=0)
+    ts_now = ahora.isoformat()
+    grupos = [g for g in GRUPOS if g in grupos]
+    log.info(f"[{ts_now}] Iniciando captura (grupos={','.join(grupos)}, backend={CAPTURE_BACKEND})...")
+
+    tags = [t for g in grupos for t in tags_de(g)]
+    desglose = _desglose_actual = DesgloseCaptura(grupos, CAPTURE_BACKEND)
+    t0 = time.monotonic()
+    error = None
+
+    try:
+        valores = capturar_valores(tags, captura_debug=captura_debug)
+        _guardar_lecturas(ahora, valores, grupos)
+        log.info("Captura finalizada con éxito.")
 
     except Exception as e:
-        print(f"Error detectado: {e}")
-        # Enviar alerta de fallo a todos los de MAIL_ALERT
+        error = e
+        log.error(f"Error detectado: {e}")
+        # Alerta de fallo a MAIL_ALERT: se encola (agrupada con las de los próximos minutos)
         try:
-            alert_mails = [x.strip() for x in os.getenv("MAIL_ALERT", "").split(",") if x.strip()]
-            if alert_mails:
-                error_html = f"<h3>Error en el Scrapping</h3><p>Se ha detectado un error al intentar capturar los datos:</p><pre>{e}</pre>"
-                enviar_email_brevo_api(
-                    subject="\u26a0\ufe0f ALERTA: Fallo Scrapping Niveles",
-                    text_content=f"Error Scrapping: {e}",
-                    html_content=error_html,
-                    recipients=alert_mails
-                )
-            else:
-                print("ALERTA FALLIDA: No hay MAIL_ALERT configurado para enviar el aviso de error.")
+            encolar_alerta(f"Error Scrapping: {e}")
         except Exception as ex_mail:
-            print(f"No se pudo enviar email de alerta: {ex_mail}")
+            log.error(f"No se pudo encolar el email de alerta: {ex_mail}")
+
+    finally:
+        _desglose_actual = None
+        duracion = time.monotonic() - t0
+        resultado = "error" if error else "ok"
+        M_CAPTURAS.inc(resultado=resultado)
+        M_CAPTURA_S.observar(duracion, resultado=resultado)
+        M_ULTIMA_CAPTURA.fijar(int(time.time()), resultado=resultado)
+        try:
+            guardar_desglose(desglose, error is None, duracion, error)
+        except Exception as e:
+            log.warning(f"[metrics] No se pudo guardar el desglose de la captura: {e}")
+    return error is None
+
+
+# -------------------
+# COORDINADOR DE CAPTURAS (single-flight)
+# -------------------
+CAPTURA_LOCK_FILE = os.path.join(DATA_DIR, "captura.lock")
+
+
+class _Vuelo:
+    """Una captura concreta y las peticiones que esperan su resultado."""
+
+    def __init__(self, grupos, captura_debug, origen):
+        self.grupos = set(grupos)
+        self.captura_debug = captura_debug
+        self.llegadas = [(origen, time.monotonic())]
+        self.hecho = threading.Event()
+        self.resultado = None
+        self.inicio = self.fin = None
+        # Log de la captura: a los trabajos de todas sus peticiones y a `log` (para los que se
+        # unen con la captura ya en marcha)
+        self.log = {"id": f"vuelo-{uuid.uuid4().hex[:12]}", "logs": [], "progreso": None}
+        self.log_trabajos = {self.log["id"], *_log_trabajos.get()}
+
+    def unir(self, grupos, captura_debug, origen):
+        self.grupos |= set(grupos)
+        self.captura_debug |= captura_debug
+        self.llegadas.append((origen, time.monotonic()))
+        self.log_trabajos |= _log_trabajos.get()
+
+    def unir_en_curso(self, origen):
+        """Petición que llega con la captura ya en marcha: recibe el log desde el principio."""
+        self.llegadas.append((origen, time.monotonic()))
+        _anexar_log_trabajos(self.log_trabajos, _log_trabajos.get(), self.log)
+
+    def esperas(self):
+        """
+        (origen, segundos) de cada petición: hasta que empezó la captura o, si llegó con la
+        captura ya en marcha, hasta que terminó.
+        """
+        return [
+            (origen, round(max(0.0, (self.inicio if t <= self.inicio else self.fin) - t), 1))
+            for origen, t in self.llegadas
+        ]
+
+
+class CoordinadorCapturas:
+    """
+    Serializa todas las capturas (cron, arranque, forzadas) para que nunca haya dos a la vez.
+
+    Una petición que llega con una captura en curso que ya cubre los grupos que pide
+    espera y recibe su resultado. Si no la cubre, se une a la siguiente captura pendiente,
+    que acumula lo pedido por todas sus peticiones. Entre procesos (p. ej. un `flask` CLI
+    o varios workers) se excluyen con un flock sobre CAPTURA_LOCK_FILE.
 
+    De cada captura se guarda en `historial` la espera de cada petición (ver _Vuelo.esperas),
+    la espera del lock de fichero y la duración.
+    """
 
+    def __init__(self, ruta_lock, historial=50):
+        self.ruta_lock = ruta_lock
+        self.historial = deque(maxlen=historial)
+        self._lock = threading.Lock()
+        self._en_curso = None
+        self._pendiente = None
+
+    def ejecutar(self, grupos=("combustible",), captura_debug=False, origen=""):
+        with self._lock:
+            vuelo = self._en_curso
+            if vuelo is not None and set(grupos) <= vuelo.grupos:
+                vuelo.unir_en_curso(origen)
+                lider = False
+            elif self._pendiente is not None:
+                vuelo = self._pendiente
+                vuelo.unir(grupos, captura_debug, origen)
+                lider = False
+            else:
+                vuelo = self._pendiente = _Vuelo(grupos, captura_debug, origen)
+                lider = True
+
+        if not lider:
+            log.info(f"[captura] Petición '{origen}' unida a una captura en curso o pendiente")
+            vuelo.hecho.wait()
+            return vuelo.resultado
+
+        # Líder: espera a que termine la captura en curso y toma el relevo
+        while True:
+            with self._lock:
+                actual = self._en_curso
+                if actual is None:
+                    self._en_curso, self._pendiente = vuelo, None
+                    break
+            actual.hecho.wait()
+
+        handler = _LogTrabajo(vuelo.log)
+        log.addHandler(handler)
+        token = _log_trabajos.set(vuelo.log_trabajos)
+        medidas = None
         try:
-            driver.save_screenshot(SCREENSHOT_PATH)
-        except Exception:
-            pass
+            vuelo.resultado, medidas = self._volar(vuelo)
+        finally:
+            with self._lock:
+                self._en_curso = None
+                vuelo.fin = time.monotonic()
+            # Ya sin captura en curso no se une nadie más: las esperas están completas
+            if medidas is not None:
+                self._registrar(vuelo, *medidas)
+            vuelo.hecho.set()
+            _log_trabajos.reset(token)
+            log.removeHandler(handler)
+        return vuelo.resultado
+
+    def _volar(self, vuelo):
+        inicio_epoch = time.time()
+        vuelo.inicio = time.monotonic()
+        os.makedirs(os.path.dirname(self.ruta_lock), exist_ok=True)
+        with open(self.ruta_lock, "a") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                espera_lock = time.monotonic() - vuelo.inicio
+                t0 = time.monotonic()
+                resultado = _ejecutar_captura(grupos=vuelo.grupos, captura_debug=vuelo.captura_debug)
+                duracion = time.monotonic() - t0
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+        return resultado, (inicio_epoch, espera_lock, duracion)
+
+    def _registrar(self, vuelo, inicio_epoch, espera_lock, duracion):
+        esperas = vuelo.esperas()
+        registro = {
+            "inicio": inicio_epoch,
+            "ok": bool(vuelo.resultado),
+            "grupos": [g for g in GRUPOS if g in vuelo.grupos],
+            "peticiones": esperas,
+            "espera_max_s": max(e for _, e in esperas),
+            "espera_lock_s": round(espera_lock, 1),
+            "duracion_s": round(duracion, 1),
+        }
+        self.historial.append(registro)
+        log.info(
+            f"[captura] {len(esperas)} petición(es) {[o for o, _ in esperas]}: "
+            f"espera máx {registro['espera_max_s']}s, lock {registro['espera_lock_s']}s, "
+            f"captura {registro['duracion_s']}s"
+        )
+
+
+COORDINADOR_CAPTURAS = CoordinadorCapturas(CAPTURA_LOCK_FILE)
+
+
+def ejecutar_scrapping(grupos=("combustible",), captura_debug=False, origen="manual"):
+    """Punto de entrada de cualquier captura: pasa siempre por el coordinador. True si fue bien."""
+    return COORDINADOR_CAPTURAS.ejecutar(grupos=grupos, captura_debug=captura_debug, origen=origen)
+
+
+# -------------------
+# PLANIFICACIÓN POR GRUPOS
+# -------------------
+# Cada grupo del registro tiene su cron ("grupos" en tags.json). Un único job se dispara en la
+# unión de todos y en cada ejecución captura, en una sola visita, los grupos que tocan: los que
+# tienen una hora programada dentro de la ventana de gracia aún no cubierta por una captura.
+#
+# Modo adaptativo (CAPTURA_ADAPTATIVA=1, grupos con bloque "adaptativo"): el intervalo del grupo
+# sale de la pendiente reciente de sus tags (% del nivel máximo por hora). Con algún tag por encima
+# de umbral_pct_h se captura cada min_s; cuanto más plano, más largo, hasta max_s. Las horas de
+# "cron_fijo" (p. ej. las previas a los emails) se siguen capturando siempre.
+CAPTURA_GRACIA_S = int(os.getenv("CAPTURA_GRACIA_S", "300"))
+CAPTURA_ADAPTATIVA = os.getenv("CAPTURA_ADAPTATIVA", "0") == "1"
+
+_decisiones = {}  # grupo -> última evaluación adaptativa
+_historial_decisiones = deque(maxlen=200)  # evaluaciones que lanzaron captura
+
+
+def _adaptativo(grupo):
+    """Configuración adaptativa del grupo, o None si el grupo va por cron."""
+    if not CAPTURA_ADAPTATIVA:
+        return None
+    return REGISTRO["grupos"][grupo].get("adaptativo")
+
+
+def _disparadores_grupos():
+    """{grupo: (trigger de horas fijas o None, gracia_s)}."""
+    res = {}
+    for grupo, cfg in REGISTRO["grupos"].items():
+        adapt = _adaptativo(grupo)
+        cron = adapt.get("cron_fijo") if adapt else cfg["cron"]
+        res[grupo] = (CronTrigger.from_crontab(cron, timezone=TZ) if cron else None, int(cfg.get("gracia_s", CAPTURA_GRACIA_S)))
+    return res
+
+
+def _ultima_hora_programada(trigger, desde, hasta):
+    """Última ejecución programada del trigger en [desde, hasta] (None si no hay)."""
+    ultima = None
+    t = trigger.get_next_fire_time(None, desde)
+    while t is not None and t <= hasta:
+        ultima = t
+        t = trigger.get_next_fire_time(t, t + timedelta(seconds=1))
+    return ultima
+
+
+def _ultima_captura(conn, grupo, tags):
+    return conn.execute(
+        f"SELECT MAX(ts_epoch) FROM {GRUPOS[grupo]}_latest WHERE tag IN ({', '.join('?' for _ in tags)})",
+        tags,
+    ).fetchone()[0]
+
+
+def velocidades_tags(conn, grupo, ventana_s, ahora_ts, retroceso_s=None):
+    """
+    {tag: velocidad} con la pendiente de la recta de mínimos cuadrados de las lecturas válidas de los
+    últimos `ventana_s` (o de las dos últimas si hay menos), en % del nivel máximo por hora
+    (en unidades/hora si el tag no tiene nivel máximo). `retroceso_s` limita hasta dónde se busca.
+    """
+    tags = tags_de(grupo)
+    df = pd.read_sql_query(
+        f"""
+        SELECT tag, ts_epoch, valor_num FROM {GRUPOS[grupo]}
+        WHERE ts_epoch >= ? AND estado = ? AND tag IN ({', '.join('?' for _ in tags)})
+        ORDER BY tag, ts_epoch
+        """,
+        conn,
+        params=[ahora_ts - (retroceso_s or ventana_s), ESTADO_OK, *tags],
+    )
+    res = {}
+    for tag, lecturas in df.groupby("tag", sort=False):
+        reciente = lecturas[lecturas["ts_epoch"] >= ahora_ts - ventana_s]
+        if len(reciente) < 2:
+            reciente = lecturas.tail(2)
+        if len(reciente) < 2:
+            continue
+        x = reciente["ts_epoch"].to_numpy(float)
+        pendiente_h = np.polyfit(x - x[0], reciente["valor_num"].to_numpy(float), 1)[0] * 3600
+        nivel_max = REGISTRO_POR_TAG[tag].get("nivel_max")
+        res[tag] = abs(pendiente_h) / float(nivel_max) * 100 if nivel_max else abs(pendiente_h)
+    return res
+
+
+def _evaluar_adaptativo(conn, grupo, adapt, ultima, ahora):
+    """Intervalo que toca según la velocidad más alta del grupo; guarda la decisión en _decisiones."""
+    min_s, max_s = int(adapt.get("min_s", 900)), int(adapt.get("max_s", 14400))
+    umbral = float(adapt.get("umbral_pct_h", 2.0))
+    ventana_s = int(adapt.get("ventana_s", 3 * 3600))
+    ahora_ts = int(ahora.timestamp())
+
+    velocidades = velocidades_tags(conn, grupo, ventana_s, ahora_ts, retroceso_s=max(ventana_s, 3 * max_s))
+    tag, vel = max(velocidades.items(), key=lambda kv: kv[1], default=(None, 0.0))
+    if vel <= 0:
+        tag = None
+    # A la velocidad umbral se captura cada min_s; a la mitad, cada 2*min_s... (acotado a [min_s, max_s])
+    intervalo = max_s if vel <= 0 else int(min(max_s, max(min_s, min_s * umbral / vel)))
+    proxima = (ultima + intervalo) if ultima is not None else ahora_ts
+
+    decision = {
+        "grupo": grupo,
+        "evaluado": ahora.isoformat(timespec="seconds"),
+        "tag_mas_rapido": tag,
+        "velocidad_pct_h": round(vel, 3),
+        "umbral_pct_h": umbral,
+        "intervalo_s": intervalo,
+        "ultima_captura": epoch_a_dt(ultima).isoformat() if ultima is not None else None,
+        "proxima_captura": epoch_a_dt(proxima).isoformat(),
+        "toca": proxima <= ahora_ts,
+    }
+    _decisiones[grupo] = decision
+    return decision
+
+
+def grupos_pendientes(ahora=None):
+    """{grupo: hora programada} de los grupos que tocan ahora y aún no se han capturado."""
+    ahora = ahora or datetime.now(TZ)
+    pendientes = {}
+    conn = _db_connect()
+    try:
+        for grupo, (trigger, gracia) in _disparadores_grupos().items():
+            tags = tags_de(grupo)
+            if not tags:
+                continue
+            ultima = _ultima_captura(conn, grupo, tags)
+            hora = trigger and _ultima_hora_programada(trigger, ahora - timedelta(seconds=gracia), ahora)
+            if hora is not None and (ultima is None or ultima < hora.timestamp()):
+                pendientes[grupo] = hora
+                continue
+
+            adapt = _adaptativo(grupo)
+            if adapt:
+                decision = _evaluar_adaptativo(conn, grupo, adapt, ultima, ahora)
+                if decision["toca"]:
+                    pendientes[grupo] = datetime.fromisoformat(decision["proxima_captura"])
+                    _historial_decisiones.append(decision)
     finally:
-        driver.quit()
+        conn.close()
+    return pendientes
+
+
+def trigger_capturas():
+    """
+    Trigger del job de captura: la unión de los crons de todos los grupos o, si algún grupo
+    es adaptativo, cada minuto (grupos_pendientes decide si toca algo). None si no hay grupos.
+    """
+    if any(_adaptativo(g) for g in REGISTRO["grupos"]):
+        return CronTrigger(minute="*", timezone=TZ)
+    triggers = [trigger for trigger, _ in _disparadores_grupos().values() if trigger is not None]
+    return OrTrigger(triggers) if triggers else None
+
+
+def job_captura_programada():
+    pendientes = grupos_pendientes()
+    if not pendientes:
+        return
+    log.info(
+        "[planificación] Pendientes: "
+        + ", ".join(f"{g} ({h:%H:%M})" for g, h in pendientes.items())
+    )
+    ejecutar_scrapping(grupos=tuple(pendientes), origen="programada")
+
+
+def estado_planificacion():
+    """Modo, última decisión y capturas de las últimas 24h de cada grupo (para ajustar el modo adaptativo)."""
+    ahora_ts = int(time.time())
+    grupos = {}
+    conn = _db_connect()
+    try:
+        for grupo, cfg in REGISTRO["grupos"].items():
+            # Del registro de capturas, no del histórico: la compresión borra lecturas
+            capturas = conn.execute(
+                """
+                SELECT COUNT(*) FROM capturas_desglose
+                WHERE ok = 1 AND inicio >= ? AND ',' || grupos || ',' LIKE ?
+                """,
+                (ahora_ts - 86400, f"%,{grupo},%"),
+            ).fetchone()[0]
+            adapt = _adaptativo(grupo)
+            grupos[grupo] = {
+                "modo": "adaptativo" if adapt else "cron",
+                "cron": adapt.get("cron_fijo") if adapt else cfg["cron"],
+                "adaptativo": adapt,
+                "capturas_24h": capturas,
+                "decision": _decisiones.get(grupo),
+            }
+    finally:
+        conn.close()
+    return {"grupos": grupos, "historial": list(_historial_decisiones)[-50:]}
+
+
+# -------------------
+# CAPTURAS FORZADAS (cola de trabajos)
+# -------------------
+# Un único hilo ejecuta los trabajos en orden; la petición HTTP solo encola y devuelve el id.
+CAPTURA_TRABAJOS_MAX = 50  # trabajos terminados que se conservan para consultar su estado
+CAPTURA_LOG_LINEAS = 500
+
+_trabajos = OrderedDict()
+_trabajos_lock = threading.Lock()
+_cola_capturas = queue.Queue()
+_hilo_capturas = None
+
+# Ids de los trabajos que reciben el log del contexto actual. Los hilos de lectura de displays
+# lo heredan (copy_context en SeleniumBackend.leer), así que sus líneas también llegan al trabajo.
+_log_trabajos = contextvars.ContextVar("log_trabajos", default=frozenset())
+
+
+class _LogTrabajo(logging.Handler):
+    """Guarda en el trabajo las líneas de log emitidas en su contexto (_log_trabajos)."""
+
+    def __init__(self, trabajo):
+        super().__init__(logging.INFO)
+        self.trabajo = trabajo
+        formato = logging.Formatter("%(asctime)s %(levelname)s %(message)s", "%H:%M:%S")
+        formato.converter = lambda t: datetime.fromtimestamp(t, TZ).timetuple()
+        self.setFormatter(formato)
+
+    def emit(self, record):
+        if self.trabajo["id"] not in _log_trabajos.get():
+            return
+        linea = self.format(record)
+        with _trabajos_lock:
+            self.trabajo["logs"].append(linea)
+            del self.trabajo["logs"][:-CAPTURA_LOG_LINEAS]
+            self.trabajo["progreso"] = record.getMessage()
+
+
+def _anexar_log_trabajos(destinos, ids, origen):
+    """Añade los trabajos `ids` a `destinos` (el log de una captura en marcha) y les copia lo que ya lleva `origen`."""
+    with _trabajos_lock:
+        destinos |= ids
+        for trabajo_id in ids:
+            t = _trabajos.get(trabajo_id)
+            if t is not None:
+                t["logs"].extend(origen["logs"])
+                del t["logs"][:-CAPTURA_LOG_LINEAS]
+
+
+def encolar_captura(grupos=None, captura_debug=False):
+    """
+    Encola una captura (por defecto de todos los grupos) y devuelve (trabajo, nuevo). Si ya hay
+    una en cola o en curso se reutiliza esa (nuevo=False) en lugar de abrir otro navegador; si
+    aún no ha empezado, hereda lo que pida la nueva petición (grupos, captura de depuración).
+    """
+    grupos = list(grupos or GRUPOS)
+    global _hilo_capturas
+    with _trabajos_lock:
+        for t in _trabajos.values():
+            if t["estado"] in ("en_cola", "ejecutando"):
+                if t["estado"] == "en_cola":
+                    t["grupos"] = [g for g in GRUPOS if g in t["grupos"] or g in grupos]
+                    t["captura_debug"] |= captura_debug
+                t["peticiones"] += 1
+                return t, False
+
+        t = {
+            "id": uuid.uuid4().hex[:12],
+            "estado": "en_cola",
+            "grupos": grupos,
+            "captura_debug": captura_debug,
+            "creado": time.time(),
+            "inicio": None,
+            "fin": None,
+            "progreso": "En cola",
+            "peticiones": 1,
+            "logs": [],
+        }
+        _trabajos[t["id"]] = t
+        terminados = [k for k, v in _trabajos.items() if v["estado"] in ("ok", "error")]
+        for k in terminados[: max(0, len(terminados) - CAPTURA_TRABAJOS_MAX)]:
+            del _trabajos[k]
+
+        if _hilo_capturas is None or not _hilo_capturas.is_alive():
+            _hilo_capturas = threading.Thread(target=_procesar_capturas, name="capturas", daemon=True)
+            _hilo_capturas.start()
+    _cola_capturas.put(t["id"])
+    return t, True
+
+
+def _procesar_capturas():
+    while True:
+        trabajo_id = _cola_capturas.get()
+        with _trabajos_lock:
+            t = _trabajos.get(trabajo_id)
+            if t is None:
+                continue
+            t["estado"] = "ejecutando"
+            t["inicio"] = time.time()
+
+        handler = _LogTrabajo(t)
+        log.addHandler(handler)
+        token = _log_trabajos.set({trabajo_id})
+        try:
+            log.info(f"--- Captura forzada {trabajo_id} ({', '.join(t['grupos'])}) ---")
+            ok = ejecutar_scrapping(grupos=t["grupos"], captura_debug=t["captura_debug"], origen="forzada")
+        except Exception as e:
+            log.error(f"Captura forzada {trabajo_id} abortada: {e}")
+            ok = False
+        finally:
+            _log_trabajos.reset(token)
+            log.removeHandler(handler)
+
+        with _trabajos_lock:
+            t["estado"] = "ok" if ok else "error"
+            t["fin"] = time.time()
+            t["progreso"] = "Finalizada" if ok else "Finalizada con error"
+
+
+def obtener_trabajo(trabajo_id):
+    """Copia serializable del estado de un trabajo (None si no existe o ya se descartó)."""
+    with _trabajos_lock:
+        t = _trabajos.get(trabajo_id)
+        if t is None:
+            return None
+        vista = dict(t, logs=list(t["logs"]))
+    fin = vista["fin"] or time.time()
+    vista["duracion_s"] = round(fin - vista["inicio"], 1) if vista["inicio"] else None
+    vista["espera_s"] = round((vista["inicio"] or fin) - vista["creado"], 1)
+    for k in ("creado", "inicio", "fin"):
+        if vista[k]:
+            vista[k] = epoch_a_dt(vista[k]).isoformat()
+    return vista
 
 
 # -------------------
@@ -302,8 +2634,35 @@ def parse_float(valor_texto: str):
         return None
 
 
-def make_sparkline_svg(values, width=120, height=28, padding=2):
-    if not values or len(values) < 2:
+def lttb(x, y, umbral):
+    """
+    Largest-Triangle-Three-Buckets: reduce (x, y) a `umbral` puntos conservando la forma.
+    x, y: ndarrays ordenados por x. Devuelve (x, y) reducidos (o los originales si ya caben).
+    """
+    n = len(x)
+    if umbral >= n or umbral < 3:
+        return x, y
+
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    idx = np.empty(umbral, dtype=np.int64)
+    idx[0], idx[-1] = 0, n - 1
+    cada = (n - 2) / (umbral - 2)
+    a = 0
+    for i in range(umbral - 2):
+        ini = int(i * cada) + 1
+        fin = int((i + 1) * cada) + 1
+        sig_fin = min(int((i + 2) * cada) + 1, n)
+        mx, my = x[fin:sig_fin].mean(), y[fin:sig_fin].mean()
+        areas = np.abs((x[a] - mx) * (y[ini:fin] - y[a]) - (x[a] - x[ini:fin]) * (my - y[a]))
+        a = ini + int(np.argmax(areas))
+        idx[i + 1] = a
+    return x[idx], y[idx]
+
+
+def make_sparkline_svg(values, width=120, height=28, padding=2, xs=None):
+    """xs opcional (p.ej. ts_epoch): posiciona los puntos por tiempo en vez de por índice."""
+    if values is None or len(values) < 2:
         return (
             f'<svg class="sparkline" viewBox="0 0 {width} {height}" xmlns="http://www.w3.org/2000/svg">'
             f'<path d="M {padding} {height/2:.2f} L {width-padding} {height/2:.2f}" class="sparkline-path sparkline-flat"/>'
@@ -322,11 +2681,15 @@ def make_sparkline_svg(values, width=120, height=28, padding=2):
 
     usable_w = width - 2 * padding
     usable_h = height - 2 * padding
-    step = usable_w / (len(values) - 1)
+    if xs is not None and xs[-1] > xs[0]:
+        posiciones = [(xv - xs[0]) / (xs[-1] - xs[0]) * usable_w for xv in xs]
+    else:
+        step = usable_w / (len(values) - 1)
+        posiciones = [i * step for i in range(len(values))]
 
     pts = []
-    for i, val in enumerate(values):
-        x = padding + i * step
+    for pos, val in zip(posiciones, values):
+        x = padding + pos
         t = (val - vmin) / (vmax - vmin)
         y = padding + (1.0 - t) * usable_h
         pts.append((x, y))
@@ -342,46 +2705,114 @@ def make_sparkline_svg(values, width=120, height=28, padding=2):
     )
 
 
-def build_trends(df_24h: pd.DataFrame):
+def calcular_tendencias(df: pd.DataFrame, etiqueta="24h", puntos=None):
     """
-    Devuelve dict: tag -> {svg, text, cls}
+    Motor de tendencias vectorizado (una pasada para todos los tags).
+
+    df: columnas tag, ts_epoch, valor_num (valor_num puede ser NULL).
+    puntos: presupuesto de puntos de la sparkline (LTTB), por defecto SPARKLINE_PUNTOS.
+    Devuelve dict: tag -> {delta, n, ts, valores (ndarrays ordenados por ts), cls, text, svg}
     """
-    trends = {}
-    if df_24h.empty:
-        return trends
+    if df.empty:
+        return {}
+    puntos = SPARKLINE_PUNTOS if puntos is None else puntos
+
+    df = df[df["valor_num"].notna()]
+    codigos, tags = pd.factorize(df["tag"].to_numpy())
+    ts = df["ts_epoch"].to_numpy(dtype=np.int64)
+    vals = df["valor_num"].to_numpy(dtype=float)
+
+    orden = np.lexsort((ts, codigos))
+    codigos, ts, vals = codigos[orden], ts[orden], vals[orden]
+
+    cortes = np.flatnonzero(np.diff(codigos)) + 1
+    inicios = np.concatenate(([0], cortes))
+    fines = np.concatenate((cortes, [len(codigos)]))
+    n = fines - inicios
+    delta = np.where(n >= 2, vals[fines - 1] - vals[inicios], np.nan)
+    cls = np.select(
+        [np.isnan(delta) | (np.abs(delta) < 0.01), delta > 0],
+        ["trend-flat", "trend-up"],
+        "trend-down",
+    )
 
-    df = df_24h.copy()
-    df["dt"] = df["ts"].apply(lambda s: datetime.fromisoformat(s))
-    df["num"] = df["valor"].apply(parse_float)
-    df = df.dropna(subset=["num"]).sort_values(["tag", "dt"])
+    res = {}
+    for i, codigo in enumerate(codigos[inicios]):
+        serie_ts = ts[inicios[i]:fines[i]]
+        serie = vals[inicios[i]:fines[i]]
+        d = None if np.isnan(delta[i]) else float(delta[i])
+        if d is not None:
+            xs, ys = lttb(serie_ts, serie, puntos)
+            svg = make_sparkline_svg(ys.tolist(), xs=xs.tolist())
+        else:
+            svg = make_sparkline_svg([])
+        res[tags[codigo]] = {
+            "delta": d,
+            "n": int(n[i]),
+            "ts": serie_ts,
+            "valores": serie,
+            "cls": str(cls[i]),
+            "text": f"{etiqueta}: {d:+.2f} m" if d is not None else f"{etiqueta}: —",
+            "svg": svg,
+        }
+    return res
+
+
+_tendencias_cache = {}
+_tendencias_lock = threading.Lock()
 
-    for tag, g in df.groupby("tag"):
-        vals = g["num"].tolist()
-        if len(vals) < 2:
-            trends[tag] = {"svg": make_sparkline_svg([]), "text": "24h: —", "cls": "trend-flat"}
-            continue
 
-        delta = vals[-1] - vals[0]
-        if abs(delta) < 0.01:
-            cls = "trend-flat"
-        elif delta > 0:
-            cls = "trend-up"
+def tendencias(ventana="24h"):
+    """
+    Tendencias de la ventana indicada (clave de VENTANAS), compartidas por el panel y el email.
+    Se recalculan solo cuando hay una captura nueva.
+    """
+    id_captura = _id_ultima_captura()
+    with _tendencias_lock:
+        cache = _tendencias_cache.get(ventana)
+        if cache and cache["id_captura"] == id_captura:
+            return cache["datos"]
+
+        conn = _db_connect()
+        ahora = int(datetime.now(TZ).timestamp())
+        segundos = VENTANAS[ventana]
+        if segundos > 86400:
+            # Ventanas largas: agregados horarios (una captura cada 2h -> sin pérdida para la sparkline)
+            df = consultar_serie(conn, "lecturas", None, ahora - segundos, ahora + 1, paso=3600)
         else:
-            cls = "trend-down"
+            df = pd.read_sql_query(
+                "SELECT tag, ts_epoch, valor_num FROM lecturas WHERE ts_epoch >= ? AND valor_num IS NOT NULL",
+                conn,
+                params=(ahora - segundos,),
+            )
+        conn.close()
+
+        datos = calcular_tendencias(df, etiqueta=ventana)
+        _tendencias_cache[ventana] = {"id_captura": id_captura, "datos": datos}
+        return datos
 
-        trends[tag] = {
-            "svg": make_sparkline_svg(vals[-96:]),  # 24h a 15 min
-            "text": f"24h: {delta:+.2f} m",
-            "cls": cls,
-        }
 
-    return trends
+def tendencias_24h():
+    return tendencias("24h")
 
 
 # -------------------
 # BREVO API (EMAIL)
 # -------------------
-def enviar_email_brevo_api(subject: str, text_content: str, html_content: str, recipients: list = None):
+class ErrorBrevo(RuntimeError):
+    def __init__(self, status, texto, reintentable=None):
+        super().__init__(f"Brevo(API) error {status}: {texto}")
+        self.status = status
+        # 429 y 5xx se reintentan; el resto de 4xx no se arreglan reintentando
+        self.reintentable = (status == 429 or (status or 0) >= 500) if reintentable is None else reintentable
+
+
+# Conexiones HTTP reutilizadas entre envíos (keep-alive)
+_brevo_session = requests.Session()
+
+
+def enviar_email_brevo_api(subject: str, text_content: str, html_content: str, recipients: list = None, clave: str = None):
+    """Envío directo (síncrono). Lo normal es usar encolar_email. True si Brevo lo aceptó."""
     api_key = os.getenv("BREVO_API_KEY", "").strip()
     mail_from = os.getenv("MAIL_FROM", "").strip()
     mail_from_name = os.getenv("MAIL_FROM_NAME", "").strip()
@@ -392,14 +2823,14 @@ def enviar_email_brevo_api(subject: str, text_content: str, html_content: str, r
         mail_to = [x.strip() for x in os.getenv("MAIL_TO", "").split(",") if x.strip()]
 
     if not api_key:
-        print("Brevo(API): falta BREVO_API_KEY")
-        return
+        log.error("Brevo(API): falta BREVO_API_KEY")
+        return False
     if not mail_from:
-        print("Brevo(API): falta MAIL_FROM")
-        return
+        log.error("Brevo(API): falta MAIL_FROM")
+        return False
     if not mail_to:
-        print("Brevo(API): falta MAIL_TO")
-        return
+        log.error("Brevo(API): falta MAIL_TO")
+        return False
 
     payload = {
         "sender": {"email": mail_from, **({"name": mail_from_name} if mail_from_name else {})},
@@ -415,12 +2846,205 @@ def enviar_email_brevo_api(subject: str, text_content: str, html_content: str, r
         "api-key": api_key,
     }
 
-    url = "https://api.brevo.com/v3/smtp/email"
-    r = requests.post(url, json=payload, headers=headers, timeout=30)
+    if clave:
+        headers["Idempotency-Key"] = clave
+        payload["headers"] = {"X-Idempotency-Key": clave}
+
+    r = _brevo_session.post(BREVO_API_URL, json=payload, headers=headers, timeout=(5, 30))
     if r.status_code >= 300:
-        raise RuntimeError(f"Brevo(API) error {r.status_code}: {r.text}")
+        raise ErrorBrevo(r.status_code, r.text)
+
+    log.info("Brevo(API): email enviado OK")
+    return True
+
+
+# -------------------
+# COLA DE EMAILS (outbox)
+# -------------------
+# Los emails se guardan en email_outbox y los envía un hilo aparte: una API lenta no alarga
+# la captura y un envío fallido se reintenta con backoff exponencial en vez de perderse.
+_outbox_despertar = threading.Event()
+_hilo_outbox = None
+_outbox_lock = threading.Lock()
+
+
+def _destinatarios_env(var):
+    return [x.strip() for x in os.getenv(var, "").split(",") if x.strip()]
+
+
+def _arrancar_outbox():
+    global _hilo_outbox
+    with _outbox_lock:
+        if _hilo_outbox is None or not _hilo_outbox.is_alive():
+            _hilo_outbox = threading.Thread(target=_procesar_outbox, name="outbox", daemon=True)
+            _hilo_outbox.start()
+    _outbox_despertar.set()
+
+
+def encolar_email(subject, text_content, html_content, recipients=None, clave=None, tipo="email"):
+    """
+    Encola un email para enviarlo en segundo plano. `clave` es la clave de idempotencia:
+    encolar dos veces la misma clave no duplica el envío (p. ej. "resumen:2024-05-01T12").
+    Devuelve True si se encoló, False si la clave ya existía.
+    """
+    clave = clave or f"{tipo}:{uuid.uuid4().hex}"
+    ahora = int(time.time())
+    conn = _db_connect()
+    try:
+        cur = conn.execute(
+            """
+            INSERT OR IGNORE INTO email_outbox
+                (clave, tipo, asunto, texto, html, destinatarios, proximo_intento, creado)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            """,
+            (clave, tipo, subject, text_content, html_content,
+             json.dumps(recipients) if recipients else None, ahora, ahora),
+        )
+        conn.commit()
+        nuevo = cur.rowcount == 1
+    finally:
+        conn.close()
+    if nuevo:
+        _arrancar_outbox()
+    else:
+        log.info(f"Email: '{clave}' ya estaba en la cola, se ignora")
+    return nuevo
+
+
+def encolar_alerta(mensaje):
+    """
+    Añade una alerta al resumen pendiente de MAIL_ALERT. Las alertas que llegan dentro de
+    ALERTA_VENTANA_S desde la primera se envían juntas en un único email al cerrar la ventana.
+    """
+    destinatarios = _destinatarios_env("MAIL_ALERT")
+    if not destinatarios:
+        log.error("ALERTA FALLIDA: No hay MAIL_ALERT configurado para enviar el aviso de error.")
+        return
+    ahora = int(time.time())
+    alerta = {"ts": ahora, "mensaje": mensaje}
+    conn = _db_connect()
+    try:
+        with conn:
+            fila = conn.execute(
+                """
+                SELECT id, alertas FROM email_outbox
+                WHERE tipo = 'alerta' AND estado = 'pendiente' AND intentos = 0 AND proximo_intento > ?
+                """,
+                (ahora,),
+            ).fetchone()
+            if fila:
+                conn.execute(
+                    "UPDATE email_outbox SET alertas = ? WHERE id = ?",
+                    (json.dumps(json.loads(fila[1]) + [alerta]), fila[0]),
+                )
+            else:
+                conn.execute(
+                    """
+                    INSERT INTO email_outbox
+                        (clave, tipo, asunto, texto, html, destinatarios, alertas, proximo_intento, creado)
+                    VALUES (?, 'alerta', '', '', '', ?, ?, ?, ?)
+                    """,
+                    (f"alerta:{ahora}:{uuid.uuid4().hex[:8]}", json.dumps(destinatarios),
+                     json.dumps([alerta]), ahora + ALERTA_VENTANA_S, ahora),
+                )
+    finally:
+        conn.close()
+    _arrancar_outbox()
+
+
+def _componer_alertas(alertas):
+    """Asunto, texto y HTML del resumen de alertas."""
+    n = len(alertas)
+    asunto = "\u26a0\ufe0f ALERTA: Fallo Scrapping Niveles" + (f" ({n} fallos)" if n > 1 else "")
+    lineas = [f"{_fmt_dt_local(epoch_a_dt(a['ts']))} - {a['mensaje']}" for a in alertas]
+    texto = "\n".join(lineas)
+    html = (
+        "<h3>Error en el Scrapping</h3>"
+        f"<p>Se {'han' if n > 1 else 'ha'} detectado {n} error{'es' if n > 1 else ''} "
+        "al intentar capturar los datos:</p>"
+        + "".join(f"<pre>{html_lib.escape(l)}</pre>" for l in lineas)
+    )
+    return asunto, texto, html
+
+
+def _backoff(intentos):
+    return min(EMAIL_BACKOFF_S * 2 ** (intentos - 1), EMAIL_BACKOFF_MAX_S)
+
+
+def _enviar_pendiente(conn, fila):
+    id_, clave, tipo, asunto, texto, html, destinatarios, alertas, intentos = fila
+    if alertas:
+        asunto, texto, html = _componer_alertas(json.loads(alertas))
+    ahora = int(time.time())
+    try:
+        enviado = enviar_email_brevo_api(
+            asunto, texto, html, recipients=json.loads(destinatarios) if destinatarios else None, clave=clave
+        )
+        if not enviado:
+            raise ErrorBrevo(None, "configuración incompleta", reintentable=False)
+    except Exception as e:
+        intentos += 1
+        definitivo = intentos >= EMAIL_MAX_INTENTOS or (isinstance(e, ErrorBrevo) and not e.reintentable)
+        conn.execute(
+            "UPDATE email_outbox SET estado = ?, intentos = ?, proximo_intento = ?, ultimo_error = ? WHERE id = ?",
+            ("error" if definitivo else "pendiente", intentos, ahora + _backoff(intentos), str(e)[:500], id_),
+        )
+        conn.commit()
+        M_EMAILS.inc(tipo=tipo, resultado="descartado" if definitivo else "fallido")
+        if definitivo:
+            log.error(f"Email: '{clave}' descartado tras {intentos} intento(s): {e}")
+        else:
+            log.warning(f"Email: '{clave}' falló ({e}), reintento en {_backoff(intentos)}s")
+        return
+    conn.execute(
+        "UPDATE email_outbox SET estado = 'enviado', intentos = ?, enviado = ?, ultimo_error = NULL WHERE id = ?",
+        (intentos + 1, ahora, id_),
+    )
+    conn.commit()
+    M_EMAILS.inc(tipo=tipo, resultado="enviado")
 
-    print("Brevo(API): email enviado OK")
+
+def _procesar_outbox():
+    while True:
+        _outbox_despertar.clear()
+        espera = 60
+        try:
+            conn = _db_connect()
+            try:
+                ahora = int(time.time())
+                for fila in conn.execute(
+                    """
+                    SELECT id, clave, tipo, asunto, texto, html, destinatarios, alertas, intentos
+                    FROM email_outbox WHERE estado = 'pendiente' AND proximo_intento <= ?
+                    ORDER BY proximo_intento, id
+                    """,
+                    (ahora,),
+                ).fetchall():
+                    _enviar_pendiente(conn, fila)
+                siguiente = conn.execute(
+                    "SELECT MIN(proximo_intento) FROM email_outbox WHERE estado = 'pendiente'"
+                ).fetchone()[0]
+            finally:
+                conn.close()
+            if siguiente is not None:
+                espera = max(1, min(espera, siguiente - int(time.time())))
+        except Exception as e:
+            log.error(f"Email: error en la cola de envío: {e}")
+        _outbox_despertar.wait(espera)
+
+
+@app.cli.command("outbox")
+def cli_outbox():
+    """Resumen de la cola de emails y últimos errores."""
+    init_db()
+    conn = _db_connect()
+    for estado, n in conn.execute("SELECT estado, COUNT(*) FROM email_outbox GROUP BY estado"):
+        print(f"{estado}: {n}")
+    for clave, intentos, error in conn.execute(
+        "SELECT clave, intentos, ultimo_error FROM email_outbox WHERE ultimo_error IS NOT NULL ORDER BY id DESC LIMIT 10"
+    ):
+        print(f"  {clave} ({intentos} intentos): {error}")
+    conn.close()
 
 
 def _fmt_dt_local(dt: datetime) -> str:
@@ -456,70 +3080,46 @@ def _delta_badge(delta):
 def obtener_latest_y_deltas_24h():
     """
     Devuelve:
-      - latest_map: tag -> {descripcion, valor(str), dt(datetime), nivel_max}
+      - latest_map: tag -> {descripcion, valor(str), valor_num, estado, dt(datetime), nivel_max}
       - deltas: tag -> delta(float) (numérico) o None
       - capture_dt: datetime (la última ts entre latest)
     """
     conn = _db_connect()
 
     df_latest = pd.read_sql_query(
-        """
-        SELECT l.tag, l.descripcion, l.valor, l.ts, l.nivel_max
-        FROM lecturas l
-        JOIN (
-            SELECT tag, MAX(ts) AS max_ts
-            FROM lecturas
-            GROUP BY tag
-        ) m ON l.tag = m.tag AND l.ts = m.max_ts
-        """,
+        "SELECT tag, descripcion, valor, valor_num, estado, ts_epoch, nivel_max FROM lecturas_latest",
         conn,
     )
 
-    ts_min = (datetime.now(TZ) - timedelta(hours=24)).isoformat(timespec="seconds")
-    df_24h = pd.read_sql_query(
-        "SELECT tag, ts, valor FROM lecturas WHERE ts >= ?",
-        conn,
-        params=(ts_min,),
-    )
-
     conn.close()
 
-    # deltas
-    deltas = {}
-    if not df_24h.empty:
-        df = df_24h.copy()
-        df["dt"] = df["ts"].apply(lambda s: datetime.fromisoformat(s))
-        df["num"] = df["valor"].apply(parse_float)
-        df = df.dropna(subset=["num"]).sort_values(["tag", "dt"])
-        for tag, g in df.groupby("tag"):
-            vals = g["num"].tolist()
-            deltas[tag] = (vals[-1] - vals[0]) if len(vals) >= 2 else None
+    deltas = {tag: t["delta"] for tag, t in tendencias_24h().items()}
 
     latest_map = {}
     capture_dt = None
 
     if not df_latest.empty:
         for _, r in df_latest.iterrows():
-            try:
-                dt = datetime.fromisoformat(str(r["ts"]))
-                if dt.tzinfo is None:
-                    dt = dt.replace(tzinfo=TZ)
-            except Exception:
-                dt = None
-
+            dt = epoch_a_dt(r["ts_epoch"])
             latest_map[r["tag"]] = {
                 "descripcion": str(r["descripcion"]),
                 "valor": str(r["valor"]),
+                "valor_num": (None if pd.isna(r["valor_num"]) else float(r["valor_num"])),
+                "estado": int(r["estado"]),
                 "dt": dt,
                 "nivel_max": float(r["nivel_max"]),
             }
 
-            if dt and (capture_dt is None or dt > capture_dt):
+            if capture_dt is None or dt > capture_dt:
                 capture_dt = dt
 
     return latest_map, deltas, capture_dt
 
 
+# Cabecera de cada planta en el email si el registro no le da "color"
+_COLORES_PLANTA = ("#2563eb", "#16a34a", "#7c3aed", "#0891b2", "#db2777")
+
+
 def construir_email_resumen():
     """
     Construye el HTML para el email, compatible con Outlook Desktop (VML + Tablas).
@@ -560,7 +3160,7 @@ def construir_email_resumen():
             raw = rec["valor"] if rec else "---"
             max_m = float(rec["nivel_max"]) if rec else float(nivel_max)
 
-            vnum = parse_float(raw) if rec else None
+            vnum = rec["valor_num"] if rec else None
             pct = None
             cls = "error"
             if vnum is not None and max_m > 0:
@@ -583,8 +3183,13 @@ def construir_email_resumen():
             )
         return rows
 
-    rows_b = build_rows(BARRANCO_TAGS)
-    rows_j = build_rows(JINAMAR_TAGS)
+    # Una sección por planta del registro con tags de combustible, como en el panel
+    secciones = []
+    for i, (clave, planta) in enumerate(REGISTRO["plantas"].items()):
+        rows = build_rows(set(tags_de("combustible", clave)))
+        if rows:
+            color = planta.get("color") or _COLORES_PLANTA[i % len(_COLORES_PLANTA)]
+            secciones.append((planta.get("central", clave.capitalize()), color, rows))
 
     # -------------------
     # TEXTO (fallback)
@@ -594,16 +3199,12 @@ def construir_email_resumen():
     txt_lines.append(f"Lectura: {captura_str}")
     if dashboard_url:
         txt_lines.append(f"Panel: {dashboard_url}")
-    txt_lines.append("")
-    txt_lines.append("CENTRAL BARRANCO")
-    for r in rows_b:
-        lvl = f"{r['vnum_str']} m" if r["vnum_str"] is not None else r["raw"]
-        txt_lines.append(f"- {r['name']}: {lvl} | {r['pct_str']}")
-    txt_lines.append("")
-    txt_lines.append("CENTRAL JINAMAR")
-    for r in rows_j:
-        lvl = f"{r['vnum_str']} m" if r["vnum_str"] is not None else r["raw"]
-        txt_lines.append(f"- {r['name']}: {lvl} | {r['pct_str']}")
+    for central, _, rows in secciones:
+        txt_lines.append("")
+        txt_lines.append(f"CENTRAL {central.upper()}")
+        for r in rows:
+            lvl = f"{r['vnum_str']} m" if r["vnum_str"] is not None else r["raw"]
+            txt_lines.append(f"- {r['name']}: {lvl} | {r['pct_str']}")
 
     text_content = "\n".join(txt_lines)
 
@@ -778,8 +3379,7 @@ def construir_email_resumen():
         <tr>
           <td style="padding:18px;">
             {panel_line}
-            {render_table(rows_b, "#2563eb", "Barranco")}
-            {render_table(rows_j, "#16a34a", "Jinamar")}
+            {"".join(render_table(rows, color, central) for central, color, rows in secciones)}
 
             <div style="margin:14px 0 4px 0;color:#94a3b8;font-size:12px;line-height:1.35;font-family:Arial,sans-serif;">
               Nota: El porcentaje se calcula sobre el máximo configurado en la aplicación.
@@ -808,49 +3408,102 @@ def enviar_resumen_programado(only_admin=False):
         subject, text_content, html_content = construir_email_resumen()
         
         recipients = None
+        # Un resumen por franja horaria: si el job se repite (misfire, reinicio) no se duplica
+        clave = f"resumen:{datetime.now(TZ):%Y-%m-%dT%H}"
         if only_admin:
-            alert_mails = [x.strip() for x in os.getenv("MAIL_ALERT", "").split(",") if x.strip()]
+            alert_mails = _destinatarios_env("MAIL_ALERT")
             if alert_mails:
                 recipients = alert_mails
                 subject = f"[DEPLOY] {subject}"
             else:
-                print("DEPLOY EMAIL: No hay MAIL_ALERT configurado, enviando a todos los destinatarios.")
-        
-        enviar_email_brevo_api(subject, text_content, html_content, recipients=recipients)
+                log.warning("DEPLOY EMAIL: No hay MAIL_ALERT configurado, enviando a todos los destinatarios.")
+            clave = f"deploy:{uuid.uuid4().hex}"
+
+        encolar_email(subject, text_content, html_content, recipients=recipients, clave=clave, tipo="resumen")
     except Exception as e:
-        print(f"Email: error enviando resumen: {e}")
+        log.error(f"Email: error enviando resumen: {e}")
 
 
 # -------------------
 # WEB
 # -------------------
-@app.route("/")
-def index():
+# Latencia por ruta (la regla, no la URL: /debug/<nombre> cuenta como una sola serie)
+@app.before_request
+def _inicio_peticion():
+    g_peticion.t0_peticion = time.monotonic()
+
+
+@app.after_request
+def _medir_peticion(resp):
+    t0 = g_peticion.pop("t0_peticion", None)
+    if t0 is not None:
+        ruta = request.url_rule.rule if request.url_rule is not None else "<sin ruta>"
+        M_HTTP_S.observar(time.monotonic() - t0, ruta=ruta, metodo=request.method)
+        M_HTTP.inc(ruta=ruta, metodo=request.method, codigo=resp.status_code)
+    return resp
+
+
+# Recursos estáticos con huella en el nombre (dashboard.<hash>.css) -> caché de un año
+_huellas_assets = {}
+
+
+def _huella_asset(nombre):
+    if nombre not in _huellas_assets:
+        with open(os.path.join(app.static_folder, nombre), "rb") as fh:
+            _huellas_assets[nombre] = hashlib.sha256(fh.read()).hexdigest()[:12]
+    return _huellas_assets[nombre]
+
+
+@app.template_global()
+def asset_url(nombre):
+    base, ext = os.path.splitext(nombre)
+    return f"/assets/{base}.{_huella_asset(nombre)}{ext}"
+
+
+@app.route("/assets/<path:nombre>")
+def assets(nombre):
+    base, ext = os.path.splitext(nombre)
+    original, _, huella = base.rpartition(".")
+    if original and re.fullmatch(r"[0-9a-f]{12}", huella):
+        try:
+            if _huella_asset(original + ext) == huella:
+                resp = send_from_directory(app.static_folder, original + ext, max_age=365 * 24 * 3600)
+                resp.headers["Cache-Control"] = "public, max-age=31536000, immutable"
+                return resp
+        except FileNotFoundError:
+            pass
+        return "Recurso no encontrado", 404
+    # Sin huella (p.ej. fuentes referenciadas desde inter.css): caché corta
+    return send_from_directory(app.static_folder, nombre, max_age=24 * 3600)
+
+
+def _nivel_card(valor, valor_num, nivel_max, unidad="m"):
+    """Campos de presentación de una tarjeta a partir del valor ya tipado."""
+    if valor_num is None:
+        return {"valor": valor, "valor_txt": valor, "unidad": "", "porcentaje": None, "clase_nivel": "level-error"}
+    porcentaje = round(valor_num / float(nivel_max) * 100, 1) if float(nivel_max) > 0 else None
+    return {
+        "valor": valor,
+        "valor_txt": _fmt_level(valor_num),
+        "unidad": unidad,
+        "porcentaje": porcentaje,
+        "clase_nivel": "level-" + _level_class_from_pct(porcentaje) if porcentaje is not None else "level-error",
+    }
+
+
+def render_dashboard(ventana="24h"):
+    """Renderiza el HTML completo del panel a partir de la BD (sparklines de la ventana indicada)."""
     conn = _db_connect()
 
     df_latest = pd.read_sql_query(
-        """
-        SELECT l.tag, l.descripcion, l.valor, l.ts, l.nivel_max
-        FROM lecturas l
-        JOIN (
-            SELECT tag, MAX(ts) AS max_ts
-            FROM lecturas
-            GROUP BY tag
-        ) m ON l.tag = m.tag AND l.ts = m.max_ts
-        """,
-        conn,
-    )
-
-    ts_min = (datetime.now(TZ) - timedelta(hours=24)).isoformat(timespec="seconds")
-    df_24h = pd.read_sql_query(
-        "SELECT tag, ts, valor FROM lecturas WHERE ts >= ?",
+        "SELECT tag, descripcion, valor, valor_num, ts_epoch, nivel_max FROM lecturas_latest",
         conn,
-        params=(ts_min,),
     )
 
     conn.close()
 
-    trends = build_trends(df_24h)
+    trends = tendencias(ventana)
+    sin_tendencia = f"{ventana}: —"
 
     latest_by_tag = {}
     if not df_latest.empty:
@@ -859,7 +3512,8 @@ def index():
                 "tag": r["tag"],
                 "descripcion": r["descripcion"],
                 "valor": r["valor"],
-                "ts": r["ts"],
+                "valor_num": (None if pd.isna(r["valor_num"]) else float(r["valor_num"])),
+                "ts_epoch": int(r["ts_epoch"]),
                 "nivel_max": r["nivel_max"],
             }
 
@@ -867,17 +3521,12 @@ def index():
     ultima_captura_dt = None
 
     for tag, descripcion, nivel_max in DATOS_A_BUSCAR:
+        unidad = REGISTRO_POR_TAG[tag]["unidad"]
         rec = latest_by_tag.get(tag)
         if rec:
-            try:
-                dt = datetime.fromisoformat(str(rec["ts"]))
-                if dt.tzinfo is None:
-                    dt = dt.replace(tzinfo=TZ)
-            except Exception:
-                dt = None
-
-            time_str = dt.astimezone(TZ).strftime("%H:%M") if dt else "--:--"
-            if dt and (ultima_captura_dt is None or dt > ultima_captura_dt):
+            dt = epoch_a_dt(rec["ts_epoch"])
+            time_str = dt.strftime("%H:%M")
+            if ultima_captura_dt is None or dt > ultima_captura_dt:
                 ultima_captura_dt = dt
 
             t = trends.get(tag)
@@ -885,12 +3534,13 @@ def index():
                 {
                     "tag": tag,
                     "descripcion": rec["descripcion"],
-                    "valor": rec["valor"],
                     "hora": time_str,
                     "nivel_max": rec["nivel_max"],
+                    "unidad_max": unidad,
                     "spark_svg": (t["svg"] if t else make_sparkline_svg([])),
-                    "trend_text": (t["text"] if t else "24h: —"),
+                    "trend_text": (t["text"] if t else sin_tendencia),
                     "trend_cls": (t["cls"] if t else "trend-flat"),
+                    **_nivel_card(rec["valor"], rec["valor_num"], rec["nivel_max"], unidad),
                 }
             )
         else:
@@ -898,299 +3548,164 @@ def index():
                 {
                     "tag": tag,
                     "descripcion": descripcion,
-                    "valor": "---",
                     "hora": "--:--",
                     "nivel_max": float(nivel_max),
+                    "unidad_max": unidad,
                     "spark_svg": make_sparkline_svg([]),
-                    "trend_text": "24h: —",
+                    "trend_text": sin_tendencia,
                     "trend_cls": "trend-flat",
+                    **_nivel_card("---", None, nivel_max),
                 }
             )
 
-    data_barranco = [c for c in cards if c["tag"] in BARRANCO_TAGS]
-    data_jinamar = [c for c in cards if c["tag"] in JINAMAR_TAGS]
+    # Una sección por planta del registro (en su orden), solo si tiene tags de combustible
+    plantas = []
+    for clave, planta in REGISTRO["plantas"].items():
+        tags_planta = set(tags_de("combustible", clave))
+        rows = [c for c in cards if c["tag"] in tags_planta]
+        if rows:
+            plantas.append({"clase": clave, "icono": planta.get("icono", ""), "titulo": planta.get("titulo", clave), "rows": rows})
 
     ultima_captura_str = (
         ultima_captura_dt.astimezone(TZ).strftime("%d/%m/%Y %H:%M") if ultima_captura_dt else "—"
     )
 
-    html = """
-<!DOCTYPE html>
-<html lang="es">
-<head>
-    <meta charset="UTF-8">
-    <meta name="viewport" content="width=device-width, initial-scale=1.0">
-    <title>Monitor Niveles Combustible - PI Vision</title>
-    <link href="https://fonts.googleapis.com/css2?family=Inter:wght@400;600;700&display=swap" rel="stylesheet">
-    <style>
-        * { margin: 0; padding: 0; box-sizing: border-box; }
-        body {
-            font-family: 'Inter', -apple-system, BlinkMacSystemFont, 'Segoe UI', sans-serif;
-            background: linear-gradient(135deg, #0f2027 0%, #203a43 50%, #2c5364 100%);
-            color: #e0e0e0;
-            padding: 12px;
-            min-height: 100vh;
-            overflow-y: auto;
-            display: flex;
-            flex-direction: column;
-            align-items: center;
-        }
-        .dashboard-header {
-            text-align: center;
-            margin-bottom: 15px;
-            padding: 12px;
-            background: rgba(255, 255, 255, 0.05);
-            border-radius: 10px;
-            backdrop-filter: blur(10px);
-            box-shadow: 0 3px 15px rgba(0, 0, 0, 0.3);
-            width: 80%;
-        }
-        .dashboard-header h1 {
-            font-size: 1.6em;
-            font-weight: 700;
-            color: #ffffff;
-            margin-bottom: 4px;
-            text-shadow: 0 2px 8px rgba(0, 0, 0, 0.5);
-        }
-        .dashboard-header .subtitle {
-            font-size: 0.8em;
-            color: #a0aec0;
-            letter-spacing: 0.4px;
-        }
-        .plant-container {
-            background: rgba(255, 255, 255, 0.08);
-            border-radius: 12px;
-            padding: 15px;
-            margin-bottom: 15px;
-            box-shadow: 0 6px 25px rgba(0, 0, 0, 0.3);
-            backdrop-filter: blur(10px);
-            border: 1px solid rgba(255, 255, 255, 0.1);
-            width: 80%;
-        }
-        .plant-title {
-            font-size: 1.2em;
-            font-weight: 700;
-            color: #ffffff;
-            margin-bottom: 12px;
-            padding-bottom: 8px;
-            border-bottom: 3px solid;
-            display: flex;
-            align-items: center;
-            gap: 10px;
-        }
-        .plant-container.barranco .plant-title { border-color: #4299e1; }
-        .plant-container.jinamar .plant-title { border-color: #48bb78; }
-        .plant-icon {
-            width: 28px; height: 28px; border-radius: 6px;
-            display: flex; align-items: center; justify-content: center;
-            font-size: 1.1em; font-weight: bold;
-        }
-        .plant-container.barranco .plant-icon {
-            background: linear-gradient(135deg, #4299e1, #3182ce); color: white;
-        }
-        .plant-container.jinamar .plant-icon {
-            background: linear-gradient(135deg, #48bb78, #38a169); color: white;
-        }
-        .widgets-grid {
-            display: grid;
-            grid-template-columns: repeat(4, 1fr);
-            gap: 12px;
-        }
-        .widget {
-            background: rgba(255, 255, 255, 0.06);
-            border-radius: 10px;
-            padding: 14px;
-            border: 1px solid rgba(255, 255, 255, 0.08);
-            transition: all 0.3s ease;
-            box-shadow: 0 3px 12px rgba(0, 0, 0, 0.2);
-        }
-        .widget:hover {
-            transform: translateY(-3px);
-            box-shadow: 0 6px 20px rgba(0, 0, 0, 0.4);
-            border-color: rgba(255, 255, 255, 0.15);
-        }
-        .widget-header {
-            display: flex; justify-content: space-between; align-items: flex-start;
-            margin-bottom: 10px;
-        }
-        .tank-name {
-            font-weight: 700; font-size: 0.85em; color: #ffffff;
-            line-height: 1.2; flex: 1;
-        }
-        .timestamp {
-            font-size: 0.65em; color: #718096; white-space: nowrap;
-            margin-left: 8px; padding: 3px 7px;
-            background: rgba(0, 0, 0, 0.2); border-radius: 5px;
-        }
-        .value-display {
-            display: flex; align-items: baseline; gap: 6px;
-            margin-bottom: 6px;
-        }
-        .value-number { font-size: 2em; font-weight: 700; color: #ffffff; line-height: 1; }
-        .value-unit { font-size: 0.9em; color: #a0aec0; font-weight: 600; }
-        .max-indicator { font-size: 0.7em; color: #4299e1; font-weight: 600; margin-bottom: 8px; }
-        .level-indicator {
-            position: relative; height: 22px;
-            background: rgba(0, 0, 0, 0.3);
-            border-radius: 11px; overflow: hidden;
-            box-shadow: inset 0 2px 6px rgba(0, 0, 0, 0.3);
-        }
-        .level-fill {
-            height: 100%; border-radius: 11px;
-            transition: width 0.8s ease, background 0.3s ease;
-            display: flex; align-items: center; justify-content: flex-end;
-            padding-right: 10px; font-size: 0.68em; font-weight: 700; color: white;
-            text-shadow: 0 1px 3px rgba(0, 0, 0, 0.5);
-        }
-        .level-low { background: linear-gradient(90deg, #f56565, #e53e3e); }
-        .level-medium { background: linear-gradient(90deg, #ed8936, #dd6b20); }
-        .level-high { background: linear-gradient(90deg, #48bb78, #38a169); }
-        .level-error { background: linear-gradient(90deg, #718096, #4a5568); }
-
-        .trend {
-            margin-top: 10px;
-            display: flex; align-items: center; justify-content: space-between;
-            gap: 10px;
-        }
-        .sparkline { width: 120px; height: 28px; display: block; }
-        .sparkline-path {
-            fill: none; stroke-width: 2.2;
-            stroke: rgba(255, 255, 255, 0.75);
-            stroke-linecap: round; stroke-linejoin: round;
-        }
-        .sparkline-flat { stroke: rgba(255, 255, 255, 0.35); }
-        .trend-meta {
-            font-size: 0.72em;
-            color: #cbd5e0;
-            padding: 3px 8px;
-            background: rgba(0,0,0,0.18);
-            border-radius: 6px;
-            white-space: nowrap;
-        }
-        .trend-up { color: #9ae6b4; }
-        .trend-down { color: #feb2b2; }
-        .trend-flat { color: #cbd5e0; }
-
-        @media (max-width: 1600px) { .widgets-grid { grid-template-columns: repeat(3, 1fr); } }
-        @media (max-width: 1200px) {
-            .widgets-grid { grid-template-columns: repeat(2, 1fr); }
-            .dashboard-header, .plant-container { width: 90%; }
-        }
-        @media (max-width: 768px) {
-            .widgets-grid { grid-template-columns: 1fr; }
-            .dashboard-header, .plant-container { width: 95%; }
-            .dashboard-header h1 { font-size: 1.3em; }
-            .value-number { font-size: 1.8em; }
-        }
-    </style>
-</head>
-<body>
-    <div class="dashboard-header">
-        <h1>🏭 Monitor de Niveles de Combustible</h1>
-        <div class="subtitle">Sistema PI Vision · Última captura: {{ ultima_captura }}</div>
-        <div class="subtitle" style="margin-top:6px;">Persistencia: {{ data_dir }}</div>
-    </div>
-
-    <div class="plant-container barranco">
-        <div class="plant-title">
-            <div class="plant-icon">B</div> PLANTA BARRANCO
-        </div>
-        <div class="widgets-grid">
-            {% for row in data_barranco %}
-            <div class="widget">
-                <div class="widget-header">
-                    <div class="tank-name">{{ row.descripcion }}</div>
-                    <div class="timestamp">{{ row.hora }}</div>
-                </div>
-
-                <div class="value-display">
-                    {% set valor_limpio = row.valor.replace('m', '').replace('³', '').strip() %}
-                    <div class="value-number">{{ valor_limpio if valor_limpio not in ['Error', '---'] else row.valor }}</div>
-                    <div class="value-unit">{% if valor_limpio not in ['Error', '---'] %}m{% endif %}</div>
-                </div>
-
-                <div class="max-indicator">Máximo: {{ row.nivel_max }} m</div>
-
-                <div class="level-indicator">
-                    {% set v = row.valor.replace('m', '').replace('³', '').replace(',', '.').strip() %}
-                    {% if v.replace('.', '', 1).isdigit() %}
-                        {% set nivel_actual = v|float %}
-                        {% set nivel_max = row.nivel_max|float %}
-                        {% set porcentaje = (nivel_actual / nivel_max * 100)|round(1) %}
-                        {% set clase_nivel = 'level-high' if porcentaje >= 60 else ('level-medium' if porcentaje >= 30 else 'level-low') %}
-                        <div class="level-fill {{ clase_nivel }}" style="width: {{ porcentaje }}%">{{ porcentaje }}%</div>
-                    {% else %}
-                        <div class="level-fill level-error" style="width: 100%">{{ row.valor }}</div>
-                    {% endif %}
-                </div>
-
-                <div class="trend">
-                    <div class="spark-wrap">{{ row.spark_svg | safe }}</div>
-                    <div class="trend-meta {{ row.trend_cls }}">{{ row.trend_text }}</div>
-                </div>
-            </div>
-            {% endfor %}
-        </div>
-    </div>
-
-    <div class="plant-container jinamar">
-        <div class="plant-title">
-            <div class="plant-icon">J</div> PLANTA JINAMAR
-        </div>
-        <div class="widgets-grid">
-            {% for row in data_jinamar %}
-            <div class="widget">
-                <div class="widget-header">
-                    <div class="tank-name">{{ row.descripcion }}</div>
-                    <div class="timestamp">{{ row.hora }}</div>
-                </div>
-
-                <div class="value-display">
-                    {% set valor_limpio = row.valor.replace('m', '').replace('³', '').strip() %}
-                    <div class="value-number">{{ valor_limpio if valor_limpio not in ['Error', '---'] else row.valor }}</div>
-                    <div class="value-unit">{% if valor_limpio not in ['Error', '---'] %}m{% endif %}</div>
-                </div>
-
-                <div class="max-indicator">Máximo: {{ row.nivel_max }} m</div>
-
-                <div class="level-indicator">
-                    {% set v = row.valor.replace('m', '').replace('³', '').replace(',', '.').strip() %}
-                    {% if v.replace('.', '', 1).isdigit() %}
-                        {% set nivel_actual = v|float %}
-                        {% set nivel_max = row.nivel_max|float %}
-                        {% set porcentaje = (nivel_actual / nivel_max * 100)|round(1) %}
-                        {% set clase_nivel = 'level-high' if porcentaje >= 60 else ('level-medium' if porcentaje >= 30 else 'level-low') %}
-                        <div class="level-fill {{ clase_nivel }}" style="width: {{ porcentaje }}%">{{ porcentaje }}%</div>
-                    {% else %}
-                        <div class="level-fill level-error" style="width: 100%">{{ row.valor }}</div>
-                    {% endif %}
-                </div>
-
-                <div class="trend">
-                    <div class="spark-wrap">{{ row.spark_svg | safe }}</div>
-                    <div class="trend-meta {{ row.trend_cls }}">{{ row.trend_text }}</div>
-                </div>
-            </div>
-            {% endfor %}
-        </div>
-    </div>
-</body>
-</html>
-"""
-    return render_template_string(
-        html,
-        data_barranco=data_barranco,
-        data_jinamar=data_jinamar,
+    return render_template(
+        "index.html",
+        plantas=plantas,
         ultima_captura=ultima_captura_str,
         data_dir=DATA_DIR,
+        fuentes=FUENTES,
+        ventana=ventana,
+        ventanas=list(VENTANAS),
     )
 
 
+# Caché del panel renderizado: solo cambia cuando se confirma una captura, así que se guarda
+# el HTML (y sus variantes gzip/br) por id de captura y se sirve con ETag fuerte / 304.
+_dashboard_cache = {}
+_dashboard_lock = threading.Lock()
+
+
+def _id_ultima_captura():
+    """Id de la última captura confirmada: el mayor ts_epoch de lecturas_latest (0 si no hay)."""
+    conn = _db_connect()
+    try:
+        return conn.execute("SELECT COALESCE(MAX(ts_epoch), 0) FROM lecturas_latest").fetchone()[0]
+    finally:
+        conn.close()
+
+
+def invalidar_cache_dashboard():
+    with _dashboard_lock:
+        _dashboard_cache.clear()
+
+
+def _comprimir_variantes(cuerpo):
+    variantes = {"identity": cuerpo, "gzip": gzip.compress(cuerpo, compresslevel=9, mtime=0)}
+    if brotli is not None:
+        variantes["br"] = brotli.compress(cuerpo, quality=11)
+    return variantes
+
+
+def _entrada_dashboard(ventana):
+    id_captura = _id_ultima_captura()
+    with _dashboard_lock:
+        entrada = _dashboard_cache.get(ventana)
+        if entrada and entrada["id_captura"] == id_captura:
+            return entrada
+
+        cuerpo = render_dashboard(ventana).encode("utf-8")
+        entrada = {
+            "id_captura": id_captura,
+            "etag": hashlib.sha256(cuerpo).hexdigest()[:32],
+            "last_modified": epoch_a_dt(id_captura) if id_captura else datetime.now(TZ),
+            "variantes": _comprimir_variantes(cuerpo),
+        }
+        _dashboard_cache[ventana] = entrada
+        return entrada
+
+
+def _elegir_codificacion(disponibles):
+    mejor, q_mejor = "identity", 0.0
+    for cod in ("br", "gzip"):
+        q = request.accept_encodings[cod]
+        if cod in disponibles and q > q_mejor:
+            mejor, q_mejor = cod, q
+    return mejor
+
+
+@app.route("/")
+def index():
+    ventana = request.args.get("ventana", "24h")
+    if ventana not in VENTANAS:
+        ventana = "24h"
+    entrada = _entrada_dashboard(ventana)
+    cod = _elegir_codificacion(entrada["variantes"])
+    # ETag fuerte distinto por representación (cada codificación son bytes distintos)
+    etag = entrada["etag"] if cod == "identity" else f"{entrada['etag']}-{cod}"
+
+    resp = Response(mimetype="text/html")
+    resp.set_etag(etag)
+    resp.last_modified = entrada["last_modified"]
+    resp.headers["Cache-Control"] = "no-cache"
+    resp.vary.add("Accept-Encoding")
+
+    if request.if_none_match.contains(etag) or (
+        not request.if_none_match and request.if_modified_since
+        and request.if_modified_since >= entrada["last_modified"].replace(microsecond=0)
+    ):
+        resp.status_code = 304
+        return resp
+
+    resp.set_data(entrada["variantes"][cod])
+    if cod != "identity":
+        resp.headers["Content-Encoding"] = cod
+    return resp
+
+
 @app.route("/debug")
 def debug():
-    if os.path.exists(SCREENSHOT_PATH):
-        return send_file(SCREENSHOT_PATH, mimetype="image/png")
-    return "Captura no disponible", 404
+    """Lista las capturas de depuración del buffer circular (más reciente primero)."""
+    capturas = listar_capturas_debug()
+    if request.args.get("formato") == "json":
+        return jsonify([
+            {"nombre": n, "bytes": b, "url": f"/debug/{n}"} for n, b, _ in capturas
+        ])
+    if not capturas:
+        return "Captura no disponible", 404
+
+    filas = "".join(
+        f'<li><a href="/debug/{html_lib.escape(n)}">{html_lib.escape(n)}</a> '
+        f"({b / 1024:.0f} KB)</li>"
+        for n, b, _ in capturas
+    )
+    total = sum(c[1] for c in capturas) / 1024 / 1024
+    return f"""
+    <html>
+        <body style="font-family: monospace; background: #1a1a1a; color: #e0e0e0; padding: 20px;">
+            <h2>Capturas de depuración ({len(capturas)}, {total:.1f} MB)</h2>
+            <p><img src="/debug/{html_lib.escape(capturas[0][0])}" style="max-width: 960px; width: 100%;"></p>
+            <ul>{filas}</ul>
+        </body>
+    </html>
+    """
+
+
+@app.route("/debug/<nombre>")
+def debug_captura(nombre):
+    """Sirve una captura; el nombre es único e inmutable, así que admite caché larga y GET condicional."""
+    if nombre == "ultima":
+        capturas = listar_capturas_debug()
+        if not capturas:
+            return "Captura no disponible", 404
+        return redirect(f"/debug/{capturas[0][0]}")
+
+    ext = nombre.rsplit(".", 1)[-1]
+    ruta = os.path.join(DEBUG_DIR, os.path.basename(nombre))
+    if ext not in _DEBUG_MIME or not os.path.exists(ruta):
+        return "Captura no disponible", 404
+    return send_file(ruta, mimetype=_DEBUG_MIME[ext], conditional=True, etag=True, max_age=7 * 24 * 3600)
 
 
 @app.route("/test-email")
@@ -1200,6 +3715,9 @@ def test_email():
     from contextlib import redirect_stdout
     
     f = io.StringIO()
+    # Los mensajes de enviar_email_brevo_api van al log: también a la respuesta
+    handler = logging.StreamHandler(f)
+    log.addHandler(handler)
     try:
         with redirect_stdout(f):
             print("--- Iniciando prueba de email ---")
@@ -1224,6 +3742,8 @@ def test_email():
         return f"Proceso finalizado. Logs:\n{f.getvalue()}", 200
     except Exception as e:
         return f"EXCEPCIÓN: {e}\nLogs parciales:\n{f.getvalue()}", 500
+    finally:
+        log.removeHandler(handler)
 
 
 @app.route("/api/agua/ultimo")
@@ -1231,17 +3751,9 @@ def api_agua_ultimo():
     """Retorna el último registro de cada punto de agua en formato JSON."""
     try:
         conn = _db_connect()
-        # Query para obtener la última lectura de cada tag en lecturas_agua
+        # Última lectura de cada tag (tabla mantenida en cada captura)
         df = pd.read_sql_query(
-            """
-            SELECT l.tag, l.descripcion, l.valor, l.ts
-            FROM lecturas_agua l
-            JOIN (
-                SELECT tag, MAX(ts) AS max_ts
-                FROM lecturas_agua
-                GROUP BY tag
-            ) m ON l.tag = m.tag AND l.ts = m.max_ts
-            """,
+            "SELECT tag, descripcion, valor, valor_num, estado, ts FROM lecturas_agua_latest",
             conn
         )
         conn.close()
@@ -1255,6 +3767,8 @@ def api_agua_ultimo():
                 "tag": row["tag"],
                 "descripcion": row["descripcion"],
                 "valor": row["valor"],
+                "valor_num": (None if pd.isna(row["valor_num"]) else float(row["valor_num"])),
+                "estado": ESTADOS.get(int(row["estado"]), "error"),
                 "ts": row["ts"]
             })
         
@@ -1267,42 +3781,378 @@ def api_agua_ultimo():
         return jsonify({"status": "error", "message": str(e)}), 500
 
 
+_UNIDADES_PASO = {"s": 1, "m": 60, "h": 3600, "d": 86400}
+_FORMATOS_SERIE = {
+    "json": "application/json",
+    "ndjson": "application/x-ndjson",
+    "csv": "text/csv; charset=utf-8",
+}
+SERIE_LIMITE_MAX = 100000
+
+
+def _parse_instante(txt, defecto):
+    """Epoch en segundos o fecha ISO (sin offset = hora de Canarias)."""
+    if not txt:
+        return defecto
+    return int(txt) if txt.lstrip("-").isdigit() else ts_a_epoch(txt)
+
+
+def _parse_paso(txt):
+    """'900', '15m', '1h', '1d' -> segundos (None si no se pide paso)."""
+    if not txt:
+        return None
+    m = re.fullmatch(r"(\d+)([smhd]?)", txt.strip().lower())
+    if not m or int(m.group(1)) <= 0:
+        raise ValueError(f"paso no válido: {txt!r}")
+    return int(m.group(1)) * _UNIDADES_PASO[m.group(2) or "s"]
+
+
+def _codificar_cursor(tag, ts_epoch):
+    return base64.urlsafe_b64encode(json.dumps([tag, ts_epoch]).encode("utf-8")).decode("ascii").rstrip("=")
+
+
+def _decodificar_cursor(token):
+    if not token:
+        return None
+    try:
+        tag, ts = json.loads(base64.urlsafe_b64decode(token + "=" * (-len(token) % 4)))
+        return str(tag), int(ts)
+    except Exception:
+        raise ValueError("cursor no válido")
+
+
+def _serializar_serie(filas, formato, con_paso, siguiente):
+    """Generador de la respuesta en el formato pedido; `filas` es un iterable de dicts."""
+    columnas = ["tag", "ts", "ts_epoch", "valor_num"]
+    columnas += ["vmin", "vmax", "avg", "n", "n_error"] if con_paso else ["estado"]
+
+    if formato == "csv":
+        yield ",".join(columnas) + "\n"
+    elif formato == "json":
+        yield '{"status": "ok", "data": ['
+    n = 0
+    for fila in filas:
+        fila["ts"] = epoch_a_dt(fila["ts_epoch"]).isoformat()
+        if formato == "csv":
+            yield ",".join("" if fila[c] is None else str(fila[c]) for c in columnas) + "\n"
+        elif formato == "json":
+            yield ("," if n else "") + json.dumps({c: fila[c] for c in columnas})
+        else:
+            yield json.dumps({c: fila[c] for c in columnas}) + "\n"
+        n += 1
+    if formato == "json":
+        yield f'], "count": {n}, "next": {json.dumps(siguiente)}}}'
+
+
+def _respuesta_serie(tabla):
+    """
+    Histórico de `tabla` en streaming. Parámetros:
+      tag (repetible o separado por comas), desde / hasta (epoch o ISO; por defecto últimas 24h),
+      paso (segundos o 15m / 1h / 1d), formato (json | ndjson | csv),
+      limite + cursor para paginar (keyset sobre (tag, ts); el siguiente cursor va en
+      la cabecera X-Next-Cursor / Link y, en JSON, en "next").
+    """
+    try:
+        tags = [t for v in request.args.getlist("tag") for t in v.split(",") if t.strip()]
+        ahora = int(time.time())
+        hasta = _parse_instante(request.args.get("hasta"), ahora)
+        desde = _parse_instante(request.args.get("desde"), hasta - 86400)
+        paso = _parse_paso(request.args.get("paso"))
+        formato = request.args.get("formato", "json").lower()
+        if formato not in _FORMATOS_SERIE:
+            raise ValueError(f"formato no válido: {formato!r} ({', '.join(_FORMATOS_SERIE)})")
+        limite = request.args.get("limite", type=int)
+        if limite is not None and not 0 < limite <= SERIE_LIMITE_MAX:
+            raise ValueError(f"limite debe estar entre 1 y {SERIE_LIMITE_MAX}")
+        cursor = _decodificar_cursor(request.args.get("cursor"))
+    except ValueError as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
+
+    conn = _db_connect()
+    filas = iterar_serie(conn, tabla, tags, desde, hasta, paso=paso, cursor=cursor)
+    headers = {}
+    siguiente = None
+    if limite:
+        # Página acotada: se lee entera (como mucho `limite` + 1 filas) para saber si hay más
+        pagina = []
+        for fila in filas:
+            if len(pagina) == limite:
+                siguiente = _codificar_cursor(pagina[-1]["tag"], pagina[-1]["ts_epoch"])
+                break
+            pagina.append(fila)
+        filas.close()
+        conn.close()
+        filas = pagina
+        if siguiente:
+            args = request.args.to_dict()
+            args["cursor"] = siguiente
+            headers["X-Next-Cursor"] = siguiente
+            headers["Link"] = f'<{request.path}?{urlencode(args)}>; rel="next"'
+
+    def generar():
+        try:
+            yield from _serializar_serie(filas, formato, bool(paso), siguiente)
+        finally:
+            if not limite:
+                conn.close()
+
+    if formato == "csv":
+        headers["Content-Disposition"] = f'inline; filename="{tabla}.csv"'
+    return Response(generar(), mimetype=_FORMATOS_SERIE[formato], headers=headers)
+
+
+@app.route("/api/lecturas")
+def api_lecturas():
+    """Histórico de niveles de combustible (ver _respuesta_serie)."""
+    return _respuesta_serie("lecturas")
+
+
+@app.route("/api/agua/lecturas")
+def api_agua_lecturas():
+    """Histórico de puntos de agua (ver _respuesta_serie)."""
+    return _respuesta_serie("lecturas_agua")
+
+
+# -------------------
+# EXPORTACIÓN
+# -------------------
+PLANTAS_EXPORT = {
+    **{p: ("lecturas", set(tags_de("combustible", p))) for p in REGISTRO["plantas"]},
+    "agua": ("lecturas_agua", set(tags_de("agua"))),
+}
+_HOJAS_EXPORT = {"lecturas": "Combustible", "lecturas_agua": "Agua"}
+_EXPORT_CHUNK = 64 * 1024
+# Filas por hoja en Excel (con la cabecera); lo que no cabe sigue en "Combustible (2)", ...
+EXPORT_XLSX_FILAS_HOJA = 1_048_576
+
+
+def _planta_de(tag):
+    return next((p for p, (_, tags) in PLANTAS_EXPORT.items() if tag in tags), "")
+
+
+_DESCRIPCIONES = {t[0]: t[1] for t in DATOS_A_BUSCAR + DATOS_AGUA}
+
+
+def _parametros_export():
+    """
+    Filtros comunes de /export.*: planta (barranco | jinamar | agua, repetible), tag, desde / hasta
+    y paso como en /api/lecturas. Devuelve [(tabla, tags)] y el rango; tags None = toda la tabla.
+    """
+    plantas = [p for v in request.args.getlist("planta") for p in v.lower().split(",") if p.strip()]
+    for p in plantas:
+        if p not in PLANTAS_EXPORT:
+            raise ValueError(f"planta no válida: {p!r} ({', '.join(PLANTAS_EXPORT)})")
+    tags = {t for v in request.args.getlist("tag") for t in v.split(",") if t.strip()}
+    ahora = int(time.time())
+    hasta = _parse_instante(request.args.get("hasta"), ahora)
+    desde = _parse_instante(request.args.get("desde"), hasta - 30 * 86400)
+    paso = _parse_paso(request.args.get("paso"))
+
+    consultas = []
+    for tabla in _HOJAS_EXPORT:
+        if plantas:
+            permitidos = set().union(*(PLANTAS_EXPORT[p][1] for p in plantas if PLANTAS_EXPORT[p][0] == tabla))
+        else:
+            permitidos = None
+        if tags:
+            permitidos = tags if permitidos is None else permitidos & tags
+        if permitidos is None or permitidos:
+            consultas.append((tabla, sorted(permitidos) if permitidos else None))
+    return consultas, desde, hasta, paso
+
+
+def _columnas_export(paso):
+    return ["fecha", "planta", "tag", "descripcion", "valor_num"] + (
+        ["vmin", "vmax", "avg", "n", "n_error"] if paso else ["estado"]
+    )
+
+
+def _filas_export(conn, tabla, tags, desde, hasta, paso):
+    """Filas (listas) de una tabla leídas por bloques con iterar_serie; fecha en hora local sin zona."""
+    columnas = _columnas_export(paso)[4:]
+    for fila in iterar_serie(conn, tabla, tags, desde, hasta, paso=paso):
+        yield [
+            epoch_a_dt(fila["ts_epoch"]).replace(tzinfo=None),
+            _planta_de(fila["tag"]),
+            fila["tag"],
+            _DESCRIPCIONES.get(fila["tag"], ""),
+        ] + [fila[c] for c in columnas]
+
+
+def _nombre_export(desde, hasta, extension):
+    return f"niveles_{epoch_a_dt(desde):%Y%m%d}_{epoch_a_dt(hasta):%Y%m%d}.{extension}"
+
+
+def _hoja_export(wb, titulo, paso):
+    """Hoja nueva con la cabecera en negrita y fija, y anchos de columna."""
+    ws = wb.create_sheet(titulo)
+    ws.freeze_panes = "A2"
+    for letra, ancho in zip("ABCDE", (18, 10, 38, 26, 12)):
+        ws.column_dimensions[letra].width = ancho
+    negrita = Font(bold=True)
+    cabecera = []
+    for c in _columnas_export(paso):
+        celda = WriteOnlyCell(ws, value=c)
+        celda.font = negrita
+        cabecera.append(celda)
+    ws.append(cabecera)
+    return ws
+
+
+@app.route("/export.xlsx")
+def export_xlsx():
+    """
+    Excel con una hoja por tabla (Combustible / Agua); si una pasa de EXPORT_XLSX_FILAS_HOJA filas
+    (el máximo de Excel) sigue en "Combustible (2)", "Combustible (3)"... Se escribe con openpyxl
+    en modo write-only (las filas van a disco según llegan de la BD, por bloques) a un fichero
+    temporal que después se envía por trozos y se borra al cerrar la respuesta.
+    """
+    try:
+        consultas, desde, hasta, paso = _parametros_export()
+    except ValueError as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
+
+    wb = Workbook(write_only=True)
+    conn = _db_connect()
+    try:
+        for tabla, tags in consultas:
+            ws, hojas, filas = _hoja_export(wb, _HOJAS_EXPORT[tabla], paso), 1, 1
+            for fila in _filas_export(conn, tabla, tags, desde, hasta, paso):
+                if filas >= EXPORT_XLSX_FILAS_HOJA:
+                    hojas += 1
+                    ws, filas = _hoja_export(wb, f"{_HOJAS_EXPORT[tabla]} ({hojas})", paso), 1
+                ws.append(fila)
+                filas += 1
+        if not consultas:
+            wb.create_sheet("Sin datos")
+        tmp = tempfile.NamedTemporaryFile(prefix="export_", suffix=".xlsx", delete=False)
+        tmp.close()
+        try:
+            wb.save(tmp.name)
+        except Exception:
+            os.remove(tmp.name)
+            raise
+    finally:
+        conn.close()
+
+    def enviar():
+        with open(tmp.name, "rb") as f:
+            while True:
+                trozo = f.read(_EXPORT_CHUNK)
+                if not trozo:
+                    break
+                yield trozo
+
+    resp = Response(
+        enviar(),
+        mimetype="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+        headers={
+            "Content-Disposition": f'attachment; filename="{_nombre_export(desde, hasta, "xlsx")}"',
+            "Content-Length": str(os.path.getsize(tmp.name)),
+        },
+    )
+    # Al cerrar la respuesta, también si el cliente se desconecta antes de leer nada
+    # (el generador no llegaría a ejecutarse y un finally dentro de él no borraría el fichero)
+    resp.call_on_close(lambda: os.remove(tmp.name))
+    return resp
+
+
+@app.route("/export.csv")
+def export_csv():
+    """Mismos filtros y columnas que /export.xlsx, en un único CSV generado en streaming."""
+    try:
+        consultas, desde, hasta, paso = _parametros_export()
+    except ValueError as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
+
+    def generar():
+        buf = io.StringIO()
+        w = csv.writer(buf)
+        # BOM para que Excel abra el fichero como UTF-8
+        yield "\ufeff"
+        w.writerow(_columnas_export(paso))
+        conn = _db_connect()
+        try:
+            for tabla, tags in consultas:
+                for fila in _filas_export(conn, tabla, tags, desde, hasta, paso):
+                    fila[0] = fila[0].isoformat(sep=" ")
+                    w.writerow(fila)
+                    if buf.tell() >= _EXPORT_CHUNK:
+                        yield buf.getvalue()
+                        buf.seek(0)
+                        buf.truncate()
+            yield buf.getvalue()
+        finally:
+            conn.close()
+
+    return Response(
+        generar(),
+        mimetype="text/csv; charset=utf-8",
+        headers={"Content-Disposition": f'attachment; filename="{_nombre_export(desde, hasta, "csv")}"'},
+    )
+
+
 @app.route("/api/agua/force")
 def api_agua_force():
-    """Ruta para forzar una captura de niveles (incluyendo agua) y ver logs."""
-    import io
-    from contextlib import redirect_stdout
-    
-    f = io.StringIO()
+    """
+    Encola una captura de niveles (incluyendo agua) y responde al momento con el id del trabajo.
+    Si ya hay una en marcha se devuelve esa. ?debug=1 guarda captura de pantalla.
+    El progreso y el log se consultan en /api/agua/force/<id>.
+    """
+    trabajo, nuevo = encolar_captura(captura_debug=request.args.get("debug") == "1")
+    url = f"/api/agua/force/{trabajo['id']}"
+    return (
+        jsonify({"status": "queued" if nuevo else "attached", "job": obtener_trabajo(trabajo["id"]), "url": url}),
+        202,
+        {"Location": url},
+    )
+
+
+@app.route("/api/planificacion")
+def api_planificacion():
+    """Planificación de capturas por grupo: decisiones del modo adaptativo y capturas en 24h."""
+    return jsonify({"status": "ok", "adaptativa": CAPTURA_ADAPTATIVA, **estado_planificacion()})
+
+
+@app.route("/metrics")
+def metrics():
+    """Métricas del proceso en formato de texto de Prometheus."""
+    return Response(exponer_metricas(), mimetype="text/plain; version=0.0.4")
+
+
+@app.route("/api/capturas")
+def api_capturas():
+    """Desglose por fases de las últimas capturas (?limite=, por defecto 20)."""
+    limite = max(1, min(request.args.get("limite", 20, type=int), CAPTURAS_DESGLOSE_N))
+    conn = _db_connect()
     try:
-        with redirect_stdout(f):
-            print("--- Iniciando captura FORZADA (con agua) ---")
-            ejecutar_scrapping(incluir_agua=True)
-            print("--- Captura finalizada con éxito ---")
-        
-        # Mostramos los logs y permitimos ir al endpoint de datos
-        logs = f.getvalue()
-        return f"""
-        <html>
-            <body style="font-family: monospace; background: #1a1a1a; color: #00ff00; padding: 20px;">
-                <h2>Captura Forzada Finalizada</h2>
-                <pre>{logs}</pre>
-                <hr>
-                <p>Ver resultados en JSON: <a href="/api/agua/ultimo" style="color: #4da6ff;">/api/agua/ultimo</a></p>
-                <p><a href="/" style="color: #4da6ff;">Volver al Inicio</a></p>
-            </body>
-        </html>
-        """, 200
-    except Exception as e:
-        return f"ERROR: {e}<br><pre>{f.getvalue()}</pre>", 500
+        filas = conn.execute(
+            """
+            SELECT inicio, grupos, backend, ok, duracion_s, tags, tags_error, filas, fases, error
+            FROM capturas_desglose ORDER BY id DESC LIMIT ?
+            """,
+            (limite,),
+        ).fetchall()
+    finally:
+        conn.close()
+    capturas = [
+        {
+            "inicio": datetime.fromtimestamp(inicio, TZ).isoformat(), "grupos": grupos.split(","),
+            "backend": backend, "ok": bool(ok), "duracion_s": duracion_s, "tags": tags,
+            "tags_error": tags_error, "filas": n_filas, "fases": json.loads(fases), "error": error,
+        }
+        for inicio, grupos, backend, ok, duracion_s, tags, tags_error, n_filas, fases, error in filas
+    ]
+    return jsonify({"status": "ok", "capturas": capturas})
 
 
-def job_captura_niveles():
-    """Wrapper para decidir si incluimos agua basándonos en la hora."""
-    now = datetime.now(TZ)
-    # Incluimos agua si son las 12h (captura de las 12:00)
-    incluir_agua = (now.hour == 12 and now.minute == 0)
-    ejecutar_scrapping(incluir_agua=incluir_agua)
+@app.route("/api/agua/force/<trabajo_id>")
+def api_agua_force_estado(trabajo_id):
+    """Estado, progreso y log de una captura forzada."""
+    trabajo = obtener_trabajo(trabajo_id)
+    if trabajo is None:
+        return jsonify({"status": "error", "message": "trabajo no encontrado"}), 404
+    return jsonify({"status": "ok", "job": trabajo})
 
 
 # -------------------
@@ -1310,37 +4160,39 @@ def job_captura_niveles():
 # -------------------
 if __name__ == "__main__":
     init_db()
+    _arrancar_outbox()  # envía lo que quedara pendiente del arranque anterior
 
     scheduler = BackgroundScheduler(timezone=TZ)
 
-    # Captura cada 2h en horas pares (00, 02, 04 ... 22)
-    # Cubre las capturas previas a los emails de las 04:01 y 12:01
-    scheduler.add_job(
-        func=job_captura_niveles,
-        trigger="cron",
-        hour="0,2,4,6,8,10,12,14,16,18,20,22",
-        minute=0,
-        second=0,
-        max_instances=1,
-        coalesce=True,
-        misfire_grace_time=300,
-        replace_existing=True,
-        id="captura_niveles_2h",
-    )
+    # Capturas según el cron de cada grupo (tags.json): combustible cada 2h en horas pares y a
+    # las 21:00 (previas a los emails de las 04:01, 12:01 y 21:01), agua a las 12:00
+    trigger = trigger_capturas()
+    gracia = max((s for _, s in _disparadores_grupos().values()), default=CAPTURA_GRACIA_S)
+    if trigger is None:
+        log.warning("[planificación] %s no tiene tags en ningún grupo: sin capturas programadas", TAGS_FILE)
+    else:
+        scheduler.add_job(
+            func=job_captura_programada,
+            trigger=trigger,
+            max_instances=1,
+            coalesce=True,
+            misfire_grace_time=gracia,
+            replace_existing=True,
+            id="captura_programada",
+        )
 
-    # Captura fija a las 21:00 (previa al email de las 21:01)
-    # Las 21h son impares y no quedan cubiertas por el job anterior
+    # Retención y compactación de la BD a diario a las 03:30 (fuera de las capturas)
     scheduler.add_job(
-        func=job_captura_niveles,
+        func=job_retencion,
         trigger="cron",
-        hour=21,
-        minute=0,
+        hour=3,
+        minute=30,
         second=0,
         max_instances=1,
         coalesce=True,
-        misfire_grace_time=300,
+        misfire_grace_time=3600,
         replace_existing=True,
-        id="captura_niveles_21h",
+        id="retencion_bd",
     )
 
     # Email a las 04:01, 12:01 y 21:01 (hora Canarias)
@@ -1359,8 +4211,8 @@ if __name__ == "__main__":
 
     scheduler.start()
 
-    # Primera captura al arrancar
-    ejecutar_scrapping()
+    # Primera captura al arrancar (más los grupos que tocaran dentro de su ventana de gracia)
+    ejecutar_scrapping(grupos=("combustible", *grupos_pendientes()), origen="arranque")
 
     # Envío inmediato al arrancar (solo admin)
     enviar_resumen_programado(only_admin=True)
@@ -0,0 +1,20 @@
+import os
+import sys
+import tempfile
+
+# app.py lee DATA_DIR al importarse: BD temporal para toda la sesión de tests
+os.environ.setdefault("DATA_DIR", tempfile.mkdtemp(prefix="tests_niveles_"))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest  # noqa: E402
+
+import app as app_module  # noqa: E402
+
+
+@pytest.fixture
+def app(tmp_path, monkeypatch):
+    """app.py con una BD vacía propia en tmp_path."""
+    monkeypatch.setattr(app_module, "DB_NAME", str(tmp_path / "niveles.db"))
+    app_module.init_db()
+    app_module.invalidar_cache_dashboard()
+    return app_module
@@ -0,0 +1,86 @@
+import logging
+import threading
+import time
+
+
+def _trabajo(id_):
+    return {"id": id_, "logs": [], "progreso": None}
+
+
+def test_log_del_trabajo_incluye_los_hilos_de_lectura(app, monkeypatch):
+    leidos = []
+
+    def leer_uno(self, display, tags, captura_debug):
+        app.log.info(f"leyendo {display}")
+        leidos.append(display)
+        return {t: {"valor": "1", "estado": "ok"} for t in tags}
+
+    monkeypatch.setattr(app.SeleniumBackend, "_leer_uno", leer_uno)
+    monkeypatch.setattr(app, "REGISTRO_POR_TAG", {"A": {"display": "d1"}, "B": {"display": "d2"}})
+    t = _trabajo("t1")
+    handler = app._LogTrabajo(t)
+    app.log.addHandler(handler)
+    nivel = app.log.level
+    app.log.setLevel(logging.INFO)
+    try:
+        app.log.info("fuera del trabajo")
+        token = app._log_trabajos.set({"t1"})
+        try:
+            app.SeleniumBackend(pool=None, paralelo=2).leer(["A", "B"])
+        finally:
+            app._log_trabajos.reset(token)
+    finally:
+        app.log.removeHandler(handler)
+        app.log.setLevel(nivel)
+
+    assert sorted(leidos) == ["d1", "d2"]
+    lineas = " | ".join(t["logs"])
+    assert "leyendo d1" in lineas and "leyendo d2" in lineas
+    assert "fuera del trabajo" not in lineas
+
+
+def test_peticion_unida_en_vuelo_espera_hasta_el_final_y_recibe_su_log(app, tmp_path, monkeypatch):
+    empezada, seguir = threading.Event(), threading.Event()
+
+    def captura(grupos, captura_debug):
+        app.log.info("captura: primera línea")
+        empezada.set()
+        seguir.wait(5)
+        app.log.info("captura: última línea")
+        return True
+
+    monkeypatch.setattr(app, "_ejecutar_captura", captura)
+    coord = app.CoordinadorCapturas(str(tmp_path / "captura.lock"))
+    nivel = app.log.level
+    app.log.setLevel(logging.INFO)
+    lider = threading.Thread(target=coord.ejecutar, kwargs={"origen": "programada"})
+    lider.start()
+    assert empezada.wait(5)
+
+    t = _trabajo("forzada1")
+    monkeypatch.setitem(app._trabajos, "forzada1", t)
+    handler = app._LogTrabajo(t)
+    app.log.addHandler(handler)
+    resultado = []
+
+    def forzada():
+        app._log_trabajos.set({"forzada1"})
+        resultado.append(coord.ejecutar(origen="forzada"))
+
+    unida = threading.Thread(target=forzada)
+    try:
+        unida.start()
+        time.sleep(0.3)
+        seguir.set()
+        lider.join(5)
+        unida.join(5)
+    finally:
+        app.log.removeHandler(handler)
+        app.log.setLevel(nivel)
+
+    assert resultado == [True]
+    esperas = dict(coord.historial[-1]["peticiones"])
+    assert esperas["programada"] == 0.0
+    assert esperas["forzada"] >= 0.2
+    lineas = " | ".join(t["logs"])
+    assert "captura: primera línea" in lineas and "captura: última línea" in lineas
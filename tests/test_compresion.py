@@ -0,0 +1,73 @@
+import numpy as np
+import pytest
+
+import app as app_module
+
+OK = app_module.ESTADO_OK
+ESCALON = [0, 0, 0, 0, 1, 1, 1, 1, 0.5, 0.5]
+
+
+def _puntos(valores, paso=7200, t0=0):
+    return [(t0 + i * paso, float(v), OK) for i, v in enumerate(valores)]
+
+
+def _error_lineal(puntos, guardados):
+    """Error máximo al redibujar con rectas entre los puntos guardados (como sparklines y LTTB)."""
+    x, y = np.array([(t, v) for t, v, _ in puntos], dtype=float).T
+    bx, by = np.array([(t, v) for t, v, _ in guardados], dtype=float).T
+    return float(np.max(np.abs(np.interp(x, bx, by) - y)))
+
+
+def _paseo(n=2000, semilla=3):
+    rng = np.random.default_rng(semilla)
+    v = np.cumsum(rng.normal(0, 0.03, n)) + 10
+    v[500:] += 2.0  # escalón
+    v[1200:1300] = 7.5  # meseta
+    return _puntos(v.round(3), paso=900)
+
+
+@pytest.mark.parametrize("metodo", app_module.METODOS_COMPRESION)
+def test_escalon_se_redibuja_con_rectas_dentro_de_tolerancia(metodo):
+    c = app_module.Compresor(metodo, 0.05, heartbeat_s=10 ** 9)
+    puntos = _puntos(ESCALON)
+    guardados = app_module.simular_compresion(c, puntos)
+    assert _error_lineal(puntos, guardados) <= 0.05
+    assert len(guardados) < len(puntos)
+
+
+@pytest.mark.parametrize("metodo", app_module.METODOS_COMPRESION)
+@pytest.mark.parametrize("tolerancia", [0.01, 0.05, 0.2])
+def test_error_lineal_acotado_en_paseo_aleatorio(metodo, tolerancia):
+    c = app_module.Compresor(metodo, tolerancia, heartbeat_s=6 * 3600)
+    puntos = _paseo()
+    guardados = app_module.simular_compresion(c, puntos)
+    assert _error_lineal(puntos, guardados) <= tolerancia + 1e-9
+    assert app_module.error_reconstruccion(c, puntos, guardados) == pytest.approx(_error_lineal(puntos, guardados))
+    # heartbeat: nunca más de heartbeat_s entre puntos conservados
+    assert max(b[0] - a[0] for a, b in zip(guardados, guardados[1:])) <= 6 * 3600
+
+
+@pytest.mark.parametrize("metodo", app_module.METODOS_COMPRESION)
+def test_insercion_en_bd_reproduce_el_escalon(app, monkeypatch, metodo):
+    tag = app.tags_de("agua")[0]
+    c = app.Compresor(metodo, 0.05, heartbeat_s=10 ** 9)
+    monkeypatch.setattr(app, "_compresor_de", lambda t: c if t == tag else None)
+    puntos = _puntos(ESCALON, t0=1_700_000_000)
+
+    conn = app._db_connect()
+    for ts, v, estado in puntos:
+        fila = {
+            "tag": tag, "descripcion": "x", "valor": f"{v:.2f}", "ts": str(ts),
+            "valor_num": v, "ts_epoch": ts, "estado": estado,
+        }
+        app._insertar_lecturas(conn.cursor(), "lecturas_agua", [fila])
+        conn.commit()
+    guardados = conn.execute(
+        "SELECT ts_epoch, valor_num, estado FROM lecturas_agua WHERE tag = ? ORDER BY ts_epoch", (tag,)
+    ).fetchall()
+    rollup = conn.execute("SELECT SUM(n), SUM(suma) FROM rollup_dia WHERE tag = ?", (tag,)).fetchone()
+    conn.close()
+
+    assert _error_lineal(puntos, guardados) <= 0.05
+    # Los agregados ven todas las lecturas, también las descartadas
+    assert rollup == (len(ESCALON), pytest.approx(sum(ESCALON)))
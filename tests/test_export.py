@@ -0,0 +1,49 @@
+import io
+import tempfile
+
+from openpyxl import load_workbook
+
+
+def _temporales(tmp_path):
+    return sorted(p.name for p in tmp_path.glob("export_*.xlsx"))
+
+
+def test_xlsx_borra_el_temporal_aunque_no_se_lea_la_respuesta(app, tmp_path, monkeypatch):
+    monkeypatch.setattr(tempfile, "tempdir", str(tmp_path))
+
+    # Respuesta cerrada por el servidor sin llegar a iterarla (cliente desconectado)
+    with app.app.test_request_context("/export.xlsx"):
+        resp = app.export_xlsx()
+    assert len(_temporales(tmp_path)) == 1
+    resp.close()
+    assert _temporales(tmp_path) == []
+
+    resp = app.app.test_client().get("/export.xlsx")
+    assert resp.data[:2] == b"PK"
+    resp.close()
+    assert _temporales(tmp_path) == []
+
+
+def test_xlsx_sigue_en_otra_hoja_al_llegar_al_limite_de_filas(app, monkeypatch):
+    monkeypatch.setattr(app, "EXPORT_XLSX_FILAS_HOJA", 4)  # cabecera + 3 filas
+    tag = app.tags_de("combustible")[0]
+    conn = app._db_connect()
+    filas = [
+        {"tag": tag, "descripcion": "x", "valor": f"{i},00", "ts": str(ts), "nivel_max": 18.0,
+         "valor_num": float(i), "ts_epoch": ts, "estado": app.ESTADO_OK}
+        for i, ts in enumerate(range(1_700_000_000, 1_700_000_000 + 8 * 900, 900))
+    ]
+    app._insertar_lecturas(conn.cursor(), "lecturas", filas)
+    conn.commit()
+    conn.close()
+
+    planta = app.REGISTRO_POR_TAG[tag]["planta"]
+    resp = app.app.test_client().get(f"/export.xlsx?planta={planta}&tag={tag}&desde=1699990000&hasta=1700100000")
+    wb = load_workbook(io.BytesIO(resp.data), read_only=True)
+    resp.close()
+
+    assert wb.sheetnames == ["Combustible", "Combustible (2)", "Combustible (3)"]
+    por_hoja = [list(wb[n].iter_rows(values_only=True)) for n in wb.sheetnames]
+    assert [len(h) for h in por_hoja] == [4, 4, 3]
+    assert all(h[0][0] == "fecha" for h in por_hoja)
+    assert [f[-2] for h in por_hoja for f in h[1:]] == [float(i) for i in range(8)]
@@ -0,0 +1,63 @@
+import json
+
+import pytest
+
+
+def _registro(tmp_path, **extra):
+    reg = {
+        "displays": {"d1": {"hash": "#/Displays/1"}},
+        "plantas": {"p1": {"titulo": "Planta"}},
+        "tags": [
+            {"tag": "T1", "descripcion": "Tanque", "display": "d1", "planta": "p1", "grupo": "combustible",
+             "nivel_max": 100},
+            {"tag": "A1", "descripcion": "Agua", "display": "d1", "planta": "p1", "grupo": "agua"},
+        ],
+        **extra,
+    }
+    ruta = tmp_path / "tags.json"
+    ruta.write_text(json.dumps(reg), encoding="utf-8")
+    return str(ruta)
+
+
+def test_registro_sin_grupos_usa_el_cron_por_defecto(app, tmp_path, monkeypatch):
+    reg = app.cargar_registro(_registro(tmp_path))
+    assert {g: cfg["cron"] for g, cfg in reg["grupos"].items()} == {
+        "combustible": app.CAPTURA_CRON_DEFECTO,
+        "agua": app.CAPTURA_CRON_DEFECTO,
+    }
+
+    monkeypatch.setattr(app, "REGISTRO", reg)
+    assert app.trigger_capturas() is not None
+    assert set(app.estado_planificacion()["grupos"]) == {"combustible", "agua"}
+
+
+def test_grupo_sin_cron_toma_el_de_defecto(app, tmp_path):
+    reg = app.cargar_registro(_registro(tmp_path, grupos={"agua": {"gracia_s": 900}}))
+    assert reg["grupos"]["agua"] == {"gracia_s": 900, "cron": app.CAPTURA_CRON_DEFECTO}
+    assert reg["grupos"]["combustible"]["cron"] == app.CAPTURA_CRON_DEFECTO
+
+
+def test_cron_no_valido(app, tmp_path):
+    with pytest.raises(ValueError, match="cron no válido en el grupo 'agua'"):
+        app.cargar_registro(_registro(tmp_path, grupos={"agua": {"cron": "cada hora"}}))
+
+
+def test_sin_grupos_no_hay_trigger(app, monkeypatch):
+    monkeypatch.setattr(app, "REGISTRO", {**app.REGISTRO, "grupos": {}})
+    assert app.trigger_capturas() is None
+
+
+def test_email_con_una_seccion_por_planta_del_registro(app, tmp_path, monkeypatch):
+    reg = app.cargar_registro(_registro(tmp_path))
+    reg["plantas"]["p2"] = {"titulo": "Otra", "central": "Salinetas"}
+    reg["tags"].append({"tag": "T2", "descripcion": "Tanque 2", "display": "d1", "planta": "p2",
+                        "grupo": "combustible", "nivel_max": 50, "unidad": "m"})
+    monkeypatch.setattr(app, "REGISTRO", reg)
+    monkeypatch.setattr(app, "DATOS_A_BUSCAR", (("T1", "Tanque", 100), ("T2", "Tanque 2", 50)))
+
+    _, texto, html = app.construir_email_resumen()
+
+    assert "CENTRAL P1\n- Tanque: ---" in texto
+    assert "CENTRAL SALINETAS\n- Tanque 2: ---" in texto
+    assert "CENTRAL BARRANCO" not in texto
+    assert "CENTRAL SALINETAS" in html
@@ -0,0 +1,90 @@
+from datetime import datetime, timedelta
+
+
+def _insertar(app, tag, epochs):
+    conn = app._db_connect()
+    filas = [
+        {"tag": tag, "descripcion": "x", "valor": f"{i % 7},00", "ts": str(ts),
+         "valor_num": float(i % 7), "ts_epoch": ts, "estado": app.ESTADO_OK}
+        for i, ts in enumerate(epochs)
+    ]
+    app._insertar_lecturas(conn.cursor(), "lecturas_agua", filas)
+    conn.commit()
+    conn.close()
+
+
+def _por_dia(app, tag):
+    conn = app._db_connect()
+    dias = {}
+    for (ts,) in conn.execute("SELECT ts_epoch FROM lecturas_agua WHERE tag = ? ORDER BY ts_epoch", (tag,)):
+        dias.setdefault(app.bucket_de(ts, 86400), []).append(ts)
+    conn.close()
+    return dias
+
+
+def test_conserva_la_ultima_lectura_de_cada_dia(app, monkeypatch):
+    monkeypatch.setattr(app, "RETENCION_PAUSA_S", 0)
+    tag = app.tags_de("agua")[0]
+    inicio = int((datetime.now(app.TZ) - timedelta(days=40)).timestamp())
+    epochs = list(range(inicio, inicio + 40 * 86400, 3 * 3600))
+    _insertar(app, tag, epochs)
+    antes = _por_dia(app, tag)
+
+    app.aplicar_retencion(dias=30, lote=7)
+
+    corte = int(datetime.now(app.TZ).timestamp()) - 30 * 86400
+    despues = _por_dia(app, tag)
+    for dia, lecturas in antes.items():
+        if lecturas[-1] < corte:
+            assert despues[dia] == [lecturas[-1]]
+        elif lecturas[0] >= corte:
+            assert despues[dia] == lecturas
+
+
+def test_dia_sin_la_lectura_de_rollup_dia_conserva_su_ultima_superviviente(app, monkeypatch):
+    # La compresión puede haber borrado la lectura que rollup_dia tiene como last_ts
+    monkeypatch.setattr(app, "RETENCION_PAUSA_S", 0)
+    tag = app.tags_de("agua")[0]
+    dia = app.bucket_de(int((datetime.now(app.TZ) - timedelta(days=50)).timestamp()), 86400)
+    _insertar(app, tag, [dia + 3600, dia + 7200, dia + 10800])
+    conn = app._db_connect()
+    conn.execute("DELETE FROM lecturas_agua WHERE tag = ? AND ts_epoch = ?", (tag, dia + 10800))
+    conn.commit()
+    conn.close()
+
+    app.aplicar_retencion(dias=30)
+
+    assert _por_dia(app, tag) == {dia: [dia + 7200]}
+
+
+def test_bd_nueva_con_auto_vacuum_incremental(app):
+    conn = app._db_connect()
+    assert conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 2
+    conn.close()
+
+
+def test_retencion_no_hace_vacuum_completo_en_una_bd_antigua(app, monkeypatch):
+    monkeypatch.setattr(app, "RETENCION_PAUSA_S", 0)
+    conn = app._db_connect()
+    conn.execute("PRAGMA journal_mode=DELETE")
+    conn.execute("PRAGMA auto_vacuum = NONE")
+    conn.execute("VACUUM")
+    assert conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 0
+    conn.close()
+    sentencias = []
+    conectar = app._db_connect
+
+    def espiar():
+        c = conectar()
+        c.set_trace_callback(sentencias.append)
+        return c
+
+    monkeypatch.setattr(app, "_db_connect", espiar)
+    app.aplicar_retencion(dias=30)
+    assert not any(s.strip().upper() == "VACUUM" for s in sentencias)
+
+    monkeypatch.setattr(app, "_db_connect", conectar)
+    app.compactar_bd()
+    conn = app._db_connect()
+    assert conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 2
+    conn.close()
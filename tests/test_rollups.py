@@ -0,0 +1,95 @@
+import random
+
+import pytest
+
+
+def _insertar(app, tabla, filas):
+    conn = app._db_connect()
+    app._insertar_lecturas(conn.cursor(), tabla, filas)
+    conn.commit()
+    conn.close()
+
+
+def _lectura(app, tag, ts, valor_num, estado):
+    return {"tag": tag, "descripcion": "x", "valor": "---" if valor_num is None else str(valor_num),
+            "ts": str(ts), "valor_num": valor_num, "ts_epoch": ts, "estado": estado, "nivel_max": 18.0}
+
+
+def test_n_error_del_crudo_coincide_con_el_de_los_rollups(app):
+    tag = app.tags_de("agua")[0]
+    estados = [app.ESTADO_OK, app.ESTADO_ERROR, app.ESTADO_MISSING, app.ESTADO_OK] * 6
+    filas = [
+        _lectura(app, tag, 3600 * 1000 + i * 600, 1.0 if e == app.ESTADO_OK else None, e)
+        for i, e in enumerate(estados)
+    ]
+    _insertar(app, "lecturas_agua", filas)
+
+    conn = app._db_connect()
+    desde, hasta = 3600 * 1000, 3600 * 1004
+    crudo = list(app.iterar_serie(conn, "lecturas_agua", [tag], desde, hasta, paso=1800))
+    hora = list(app.iterar_serie(conn, "lecturas_agua", [tag], desde, hasta, paso=3600))
+    conn.close()
+
+    assert sum(f["n_error"] for f in crudo) == sum(f["n_error"] for f in hora) == 12
+
+
+def _rollups(app):
+    conn = app._db_connect()
+    res = {
+        nombre: conn.execute(
+            f"SELECT tag, bucket, n, n_error, n_ok, vmin, vmax, ROUND(suma, 6), first_ts, first_val, last_ts, last_val"
+            f" FROM {nombre} ORDER BY tag, bucket"
+        ).fetchall()
+        for nombre in app.ROLLUPS
+    }
+    conn.close()
+    return res
+
+
+def _historico(app, dias=3, paso=900):
+    rng = random.Random(7)
+    tags = app.tags_de("combustible")[:2]
+    filas = []
+    for i in range(dias * 86400 // paso):
+        for tag in tags:
+            ts = 1_700_000_000 + i * paso
+            r = rng.random()
+            if r < 0.05:
+                filas.append(_lectura(app, tag, ts, None, app.ESTADO_ERROR))
+            elif r < 0.1:
+                filas.append(_lectura(app, tag, ts, None, app.ESTADO_MISSING))
+            else:
+                filas.append(_lectura(app, tag, ts, round(rng.uniform(0, 18), 2), app.ESTADO_OK))
+    return filas
+
+
+def test_rollups_incrementales_coinciden_con_la_reconstruccion(app):
+    filas = _historico(app)
+    for i in range(0, len(filas), 37):  # capturas de varios tamaños, como llegan del scheduler
+        _insertar(app, "lecturas", filas[i:i + 37])
+    incrementales = _rollups(app)
+
+    conn = app._db_connect()
+    app.reconstruir_rollups(conn)
+    conn.close()
+
+    assert _rollups(app) == incrementales
+    assert sum(f[2] for f in incrementales["rollup_dia"]) == len(filas)
+
+
+def test_no_reconstruye_si_el_historico_ya_no_cubre_los_rollups(app):
+    _insertar(app, "lecturas", _historico(app, dias=2))
+    antes = _rollups(app)
+    conn = app._db_connect()
+    conn.execute("DELETE FROM lecturas WHERE ts_epoch < ?", (1_700_000_000 + 86400,))
+    conn.commit()
+    try:
+        assert set(app.rollups_sin_cobertura(conn)) == {"lecturas"}
+        with pytest.raises(ValueError, match="ya no cubre"):
+            app.reconstruir_rollups(conn)
+        assert _rollups(app) == antes
+
+        app.reconstruir_rollups(conn, forzar=True)
+        assert app.rollups_sin_cobertura(conn) == {}
+    finally:
+        conn.close()
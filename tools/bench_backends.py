@@ -0,0 +1,82 @@
+# tools/bench_backends.py
+"""
+Compara los backends de captura (webapi vs selenium) contra tools/stub_pi.py.
+
+    python tools/bench_backends.py --runs 20
+    python tools/bench_backends.py --runs 5 --backend selenium   # requiere Chromium
+
+Muestra tiempo medio/p50/máx por lectura de todos los tags y comprueba que
+ambos backends devuelven los mismos valores.
+"""
+import argparse
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+os.environ.setdefault("DATA_DIR", tempfile.mkdtemp(prefix="bench_backends_"))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import stub_pi  # noqa: E402  (importa app con DATA_DIR temporal)
+
+app = stub_pi.app
+
+
+def medir(backend, tags, runs):
+    tiempos = []
+    valores = None
+    for _ in range(runs):
+        t0 = time.perf_counter()
+        valores = backend.leer(tags)
+        tiempos.append(time.perf_counter() - t0)
+    return tiempos, valores
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--runs", type=int, default=10)
+    ap.add_argument("--backend", choices=["webapi", "selenium", "ambos"], default="ambos")
+    args = ap.parse_args()
+
+    srv, base = stub_pi.arrancar()
+    app.PI_BASE_URL = base + "/PIVision/"
+    tags = [t[0] for t in app.DATOS_A_BUSCAR] + [t[0] for t in app.DATOS_AGUA]
+    # Sin la limpieza de Chromium huérfanos del arranque: haría pkill -f chrome en la máquina
+    # donde se mide (navegador del usuario, otros tests)
+    app.DRIVER_POOL._limpieza_hecha = True
+
+    backends = []
+    if args.backend in ("webapi", "ambos"):
+        backends.append(app.PiWebApiBackend(base + "/piwebapi/", app.USERNAME, app.PASSWORD1, app.PI_WEBAPI_SERVIDOR))
+    if args.backend in ("selenium", "ambos"):
+        backends.append(app.SELENIUM_BACKEND)
+
+    resultados = {}
+    for b in backends:
+        try:
+            tiempos, valores = medir(b, tags, args.runs)
+        except Exception as e:
+            print(f"{b.nombre:9s} no disponible: {e}")
+            continue
+        ok = sum(1 for v in valores.values() if v["estado"] == "ok")
+        resultados[b.nombre] = valores
+        print(
+            f"{b.nombre:9s} runs={args.runs} media={statistics.mean(tiempos) * 1000:8.1f} ms "
+            f"p50={statistics.median(tiempos) * 1000:8.1f} ms max={max(tiempos) * 1000:8.1f} ms "
+            f"tags_ok={ok}/{len(tags)}"
+        )
+
+    if len(resultados) == 2:
+        dif = [
+            t for t in tags
+            if app.parse_float(resultados["webapi"][t]["valor"]) != app.parse_float(resultados["selenium"][t]["valor"])
+        ]
+        print("Valores idénticos en ambos backends" if not dif else f"Valores distintos en: {dif}")
+
+    app.DRIVER_POOL.cerrar()
+    srv.shutdown()
+
+
+if __name__ == "__main__":
+    main()
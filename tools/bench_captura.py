@@ -0,0 +1,175 @@
+# tools/bench_captura.py
+"""
+Mide ejecutar_scrapping() de punta a punta contra displays grabados (tools/replay_pi.py),
+con Selenium y sin VPN.
+
+    python tools/bench_captura.py --runs 10                       # frío y caliente
+    python tools/bench_captura.py --runs 20 --variante caliente --estable-ms 800 --rafagas 3
+    python tools/bench_captura.py --grabaciones tools/grabaciones --json resultados.json
+
+- frío: cada captura abre Chromium de cero (build_driver + login + espera)
+- caliente: una captura de calentamiento y después las sesiones del pool se reutilizan
+
+Por cada variante muestra la duración total y la de cada fase (del desglose que guarda
+cada captura, ver medir_fase en app.py) y comprueba que los valores guardados coinciden
+con los de la grabación. Sin --grabaciones usa grabaciones sintéticas de tags.json.
+Requiere Chromium y chromedriver (o CHROME_BIN).
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+os.environ.setdefault("DATA_DIR", tempfile.mkdtemp(prefix="bench_captura_"))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import replay_pi  # noqa: E402  (importa app con DATA_DIR temporal)
+
+app = replay_pi.app
+
+
+def percentil(valores, p):
+    """Percentil por rango más cercano (valores no vacíos)."""
+    orden = sorted(valores)
+    return orden[min(len(orden) - 1, max(0, int(round(p / 100 * len(orden))) - 1))]
+
+
+def _resumen(valores):
+    return {
+        "media": sum(valores) / len(valores),
+        "p50": percentil(valores, 50),
+        "p95": percentil(valores, 95),
+        "max": max(valores),
+    }
+
+
+def _ultimo_desglose():
+    conn = app._db_connect()
+    try:
+        fila = conn.execute("SELECT fases, tags, tags_error FROM capturas_desglose ORDER BY id DESC LIMIT 1").fetchone()
+    finally:
+        conn.close()
+    return json.loads(fila[0]), fila[1], fila[2]
+
+
+def _diferencias(grabaciones):
+    """Tags cuyo último valor guardado no coincide con el de la grabación."""
+    esperados = {t: v for g in grabaciones.values() for t, v in g["valores"].items()}
+    conn = app._db_connect()
+    try:
+        guardados = dict(conn.execute("SELECT tag, valor FROM lecturas_latest"))
+        guardados.update(conn.execute("SELECT tag, valor FROM lecturas_agua_latest"))
+    finally:
+        conn.close()
+    return [t for t, v in esperados.items() if t in guardados and guardados[t] != (v or "---")]
+
+
+def medir(variante, runs, grupos, grabaciones):
+    app.DRIVER_POOL.cerrar()
+    if variante == "caliente":
+        app.ejecutar_scrapping(grupos=grupos, origen="bench-calentamiento")
+
+    totales, fases, fallos, diferencias = [], {}, 0, set()
+    for i in range(runs):
+        if variante == "frio":
+            app.DRIVER_POOL.cerrar()
+        t0 = time.perf_counter()
+        ok = app.ejecutar_scrapping(grupos=grupos, origen="bench")
+        totales.append(time.perf_counter() - t0)
+        desglose, tags, tags_error = _ultimo_desglose()
+        if not ok or tags_error:
+            fallos += 1
+        for fase, s in desglose.items():
+            fases.setdefault(fase, []).append(s)
+        if ok:
+            diferencias.update(_diferencias(grabaciones))
+        print(f"  {variante} #{i + 1}: {totales[-1]:.2f}s {'ok' if ok else 'ERROR'} ({tags - tags_error}/{tags} tags)")
+
+    return {
+        "runs": runs,
+        "fallos": fallos,
+        "total_s": _resumen(totales),
+        "fases_s": {f: {**_resumen(v), "n": len(v)} for f, v in sorted(fases.items())},
+        "valores_distintos": sorted(diferencias),
+    }
+
+
+def imprimir(variante, res):
+    print(f"\n{variante}: {res['runs']} capturas, {res['fallos']} con fallo")
+    print(f"  {'fase':34s} {'media':>8s} {'p50':>8s} {'p95':>8s} {'max':>8s} {'n':>4s}")
+    filas = [("TOTAL", {**res["total_s"], "n": res["runs"]})] + list(res["fases_s"].items())
+    for fase, r in filas:
+        print(f"  {fase:34s} {r['media']:8.2f} {r['p50']:8.2f} {r['p95']:8.2f} {r['max']:8.2f} {r['n']:4d}")
+    if res["fallos"] == res["runs"]:
+        print("  Sin capturas correctas con las que comparar valores")
+    elif res["valores_distintos"]:
+        print(f"  Valores distintos de la grabación: {res['valores_distintos']}")
+    else:
+        print("  Valores guardados idénticos a la grabación")
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    replay_pi._argumentos_servidor(ap)
+    ap.set_defaults(grabaciones=None)
+    ap.add_argument("--runs", type=int, default=5)
+    ap.add_argument("--variante", choices=["frio", "caliente", "ambas"], default="ambas")
+    ap.add_argument("--grupos", default=",".join(app.GRUPOS), help="grupos capturados (coma)")
+    ap.add_argument("--estable-ms", type=int, help="CAPTURE_ESTABLE_MS para la prueba")
+    ap.add_argument("--json", help="guarda los resultados en este fichero")
+    args = ap.parse_args()
+
+    directorio = args.grabaciones
+    if directorio is None:
+        directorio = tempfile.mkdtemp(prefix="grabaciones_")
+        replay_pi.generar_sinteticas(directorio)
+    srv, base = replay_pi.arrancar(
+        directorio, retardo_ms=args.retardo_ms, jitter_ms=args.jitter_ms, rafagas=args.rafagas
+    )
+    grabaciones = srv.RequestHandlerClass.grabaciones
+
+    app.PI_BASE_URL = base + "/PIVision/"
+    app.CAPTURE_BACKEND = "selenium"
+    # Sin la limpieza de Chromium huérfanos del arranque: haría pkill -f chrome en la máquina
+    # donde se mide (navegador del usuario, otros tests)
+    app.DRIVER_POOL._limpieza_hecha = True
+    app.CAPTURAS_DESGLOSE_N = max(app.CAPTURAS_DESGLOSE_N, 2 * args.runs + 2)
+    if args.estable_ms is not None:
+        app.CAPTURE_ESTABLE_MS = args.estable_ms
+    app.init_db()
+    grupos = tuple(g.strip() for g in args.grupos.split(",") if g.strip())
+
+    variantes = ["frio", "caliente"] if args.variante == "ambas" else [args.variante]
+    resultados = {
+        "grabaciones": directorio,
+        "retardo_ms": args.retardo_ms,
+        "jitter_ms": args.jitter_ms,
+        "rafagas": args.rafagas,
+        "estable_ms": app.CAPTURE_ESTABLE_MS,
+        "variantes": {},
+    }
+    try:
+        for v in variantes:
+            resultados["variantes"][v] = medir(v, args.runs, grupos, grabaciones)
+    finally:
+        app.DRIVER_POOL.cerrar()
+        estado = {
+            "peticiones": srv.RequestHandlerClass.peticiones,
+            "rechazadas": srv.RequestHandlerClass.rechazadas,
+        }
+        srv.shutdown()
+
+    for v, res in resultados["variantes"].items():
+        imprimir(v, res)
+    print(f"\nServidor: {estado['peticiones']} peticiones, {estado['rechazadas']} rechazadas por auth")
+    resultados["servidor"] = estado
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(resultados, f, indent=1)
+        print(f"Resultados en {args.json}")
+
+
+if __name__ == "__main__":
+    main()
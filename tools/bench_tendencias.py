@@ -0,0 +1,94 @@
+# tools/bench_tendencias.py
+"""
+Micro-benchmark del motor de tendencias sobre un histórico sintético de varios años.
+
+Compara la implementación anterior (apply(fromisoformat) + apply(parse_float) + groupby().tolist(),
+hecha dos veces: panel y email) con calcular_tendencias() (vectorizada, una vez para ambos).
+
+    python tools/bench_tendencias.py --anios 3 --cada-min 15
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+os.environ.setdefault("DATA_DIR", tempfile.mkdtemp(prefix="bench_tendencias_"))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np  # noqa: E402
+import pandas as pd  # noqa: E402
+
+import app  # noqa: E402
+
+
+def generar(anios, cada_min, semilla=1):
+    """DataFrame con tag, ts (ISO local), valor (texto), ts_epoch, valor_num para todos los tags."""
+    rng = np.random.default_rng(semilla)
+    fin = int(datetime.now(app.TZ).timestamp())
+    epochs = np.arange(fin - int(anios * 365 * 86400), fin, cada_min * 60, dtype=np.int64)
+    tags = [t[0] for t in app.DATOS_A_BUSCAR] + [t[0] for t in app.DATOS_AGUA]
+    partes = []
+    for tag in tags:
+        v = np.clip(8 + np.cumsum(rng.normal(0, 0.05, len(epochs))), 0, 18).round(2)
+        partes.append(pd.DataFrame({"tag": tag, "ts_epoch": epochs, "valor_num": v}))
+    df = pd.concat(partes, ignore_index=True)
+    ts_local = pd.to_datetime(df["ts_epoch"], unit="s", utc=True).dt.tz_convert(app.TZ)
+    df["ts"] = ts_local.map(lambda d: d.isoformat())
+    df["valor"] = df["valor_num"].map(lambda x: f"{x:.2f} m".replace(".", ","))
+    return df
+
+
+def legado(df_24h):
+    """Versión anterior de build_trends() / deltas de obtener_latest_y_deltas_24h()."""
+    df = df_24h.copy()
+    df["dt"] = df["ts"].apply(lambda s: datetime.fromisoformat(s))
+    df["num"] = df["valor"].apply(app.parse_float)
+    df = df.dropna(subset=["num"]).sort_values(["tag", "dt"])
+    res = {}
+    for tag, g in df.groupby("tag"):
+        vals = g["num"].tolist()
+        res[tag] = (vals[-1] - vals[0]) if len(vals) >= 2 else None
+        if len(vals) >= 2:
+            app.make_sparkline_svg(vals[-96:])
+    return res
+
+
+def cronometrar(fn, repeticiones):
+    tiempos = []
+    for _ in range(repeticiones):
+        t0 = time.perf_counter()
+        r = fn()
+        tiempos.append(time.perf_counter() - t0)
+    return min(tiempos), r
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--anios", type=float, default=3)
+    ap.add_argument("--cada-min", type=int, default=15)
+    ap.add_argument("--repeticiones", type=int, default=3)
+    args = ap.parse_args()
+
+    t0 = time.perf_counter()
+    df = generar(args.anios, args.cada_min)
+    print(f"Histórico sintético: {len(df):,} filas, {df['tag'].nunique()} tags ({time.perf_counter() - t0:.1f}s)")
+
+    desde_24h = int((datetime.now(app.TZ) - timedelta(hours=24)).timestamp())
+    ventanas = {"24h": df[df["ts_epoch"] >= desde_24h], "completo": df}
+    for nombre, sub in ventanas.items():
+        # El código anterior lo calculaba dos veces por petición de panel + email
+        t_leg, r_leg = cronometrar(lambda: (legado(sub), legado(sub))[0], args.repeticiones)
+        t_new, r_new = cronometrar(lambda: app.calcular_tendencias(sub), args.repeticiones)
+        dif = max(
+            abs((r_leg[t] or 0) - (r_new[t]["delta"] or 0)) for t in r_leg
+        )
+        print(
+            f"{nombre:9s} filas={len(sub):>10,}  legado(x2)={t_leg * 1000:10.1f} ms  "
+            f"vectorizado={t_new * 1000:8.1f} ms  x{t_leg / t_new:6.1f}  max|Δdelta|={dif:.2e}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,236 @@
+# tools/bench_web.py
+"""
+Carga y consultas de la web sobre un histórico grande: latencia p50/p95/p99 y peticiones/s
+de cada escenario a varios niveles de concurrencia.
+
+    python tools/bench_web.py --anios 3 --concurrencia 1,4,16 --peticiones 200 --json base.json
+    DATA_DIR=/tmp/niveles_5a python tools/bench_web.py --servidor --json rama.json --comparar base.json
+
+Sin DATA_DIR (o con una BD vacía) genera antes el histórico (tools/generar_historico.py).
+Por defecto usa el cliente de pruebas de Flask en hilos; con --servidor levanta un servidor
+HTTP local (werkzeug, con hilos) y las peticiones van por sockets.
+
+Escenarios:
+    panel            GET /                      (caché del panel ya construida)
+    panel_sin_cache  GET / vaciando antes las cachés del panel y de tendencias (todo desde la BD)
+    panel_90d        GET /?ventana=90d          (sin caché, como panel_sin_cache)
+    agua_ultimo      GET /api/agua/ultimo
+    serie_30d        GET /api/lecturas          (30 días de todos los tags, paso 1h)
+    email_resumen    construir_email_resumen()  (llamada directa, sin HTTP)
+
+Los resultados (con los parámetros y el tamaño de la BD) se guardan en JSON; --comparar
+muestra la variación de p50/p95 y peticiones/s respecto a otro fichero.
+"""
+import argparse
+import json
+import os
+import platform
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+os.environ.setdefault("DATA_DIR", tempfile.mkdtemp(prefix="bench_web_"))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import generar_historico  # noqa: E402  (importa app con DATA_DIR temporal)
+
+app = generar_historico.app
+
+
+def percentil(valores, p):
+    """Percentil por rango más cercano (valores no vacíos)."""
+    orden = sorted(valores)
+    return orden[min(len(orden) - 1, max(0, int(round(p / 100 * len(orden))) - 1))]
+
+
+def sin_cache():
+    """Vacía la caché del panel y la de tendencias: cada petición recalcula todo desde la BD."""
+    app.invalidar_cache_dashboard()
+    with app._tendencias_lock:
+        app._tendencias_cache.clear()
+
+
+def escenarios():
+    """nombre -> (ruta o None, preparar antes de cada petición, llamada directa)."""
+    desde = int(time.time()) - 30 * 86400
+    return {
+        "panel": ("/", None, None),
+        "panel_sin_cache": ("/", sin_cache, None),
+        "panel_90d": ("/?ventana=90d", sin_cache, None),
+        "agua_ultimo": ("/api/agua/ultimo", None, None),
+        "serie_30d": (f"/api/lecturas?desde={desde}&paso=1h", None, None),
+        "email_resumen": (None, None, app.construir_email_resumen),
+    }
+
+
+class _ClienteFlask:
+    """Un cliente de pruebas por hilo; lee la respuesta entera (también las de streaming)."""
+
+    def __init__(self):
+        self._local = threading.local()
+
+    def get(self, ruta):
+        cliente = getattr(self._local, "cliente", None)
+        if cliente is None:
+            cliente = self._local.cliente = app.app.test_client()
+        r = cliente.get(ruta, headers={"Accept-Encoding": "gzip"})
+        r.get_data()
+        return r.status_code
+
+
+class _ClienteHttp:
+    """Servidor werkzeug local con hilos y una requests.Session por hilo."""
+
+    def __init__(self):
+        import requests
+        from werkzeug.serving import WSGIRequestHandler, make_server
+
+        class SinLog(WSGIRequestHandler):
+            def log_request(self, *args, **kwargs):
+                pass
+
+        self._requests = requests
+        self._srv = make_server("127.0.0.1", 0, app.app, threaded=True, request_handler=SinLog)
+        self.base = f"http://127.0.0.1:{self._srv.server_port}"
+        threading.Thread(target=self._srv.serve_forever, daemon=True).start()
+        self._local = threading.local()
+
+    def get(self, ruta):
+        sesion = getattr(self._local, "sesion", None)
+        if sesion is None:
+            sesion = self._local.sesion = self._requests.Session()
+        r = sesion.get(self.base + ruta, headers={"Accept-Encoding": "gzip"})
+        return r.status_code
+
+    def cerrar(self):
+        self._srv.shutdown()
+
+
+def medir(cliente, escenario, concurrencia, peticiones):
+    ruta, preparar, directa = escenario
+
+    def una(_):
+        if preparar is not None:
+            preparar()
+        t0 = time.perf_counter()
+        try:
+            ok = directa() is not None if directa is not None else cliente.get(ruta) < 400
+        except Exception:
+            ok = False
+        return time.perf_counter() - t0, ok
+
+    una(None)  # calentamiento (caché del panel, conexiones)
+    t0 = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrencia) as ex:
+        resultados = list(ex.map(una, range(peticiones)))
+    total = time.perf_counter() - t0
+    tiempos = [t for t, _ in resultados]
+    return {
+        "n": peticiones,
+        "errores": sum(1 for _, ok in resultados if not ok),
+        "media_ms": sum(tiempos) / len(tiempos) * 1000,
+        "p50_ms": percentil(tiempos, 50) * 1000,
+        "p95_ms": percentil(tiempos, 95) * 1000,
+        "p99_ms": percentil(tiempos, 99) * 1000,
+        "max_ms": max(tiempos) * 1000,
+        "rps": peticiones / total,
+    }
+
+
+def _info_bd():
+    conn = app._db_connect()
+    try:
+        filas = {t: conn.execute(f"SELECT COUNT(*) FROM {t}").fetchone()[0] for t in app.GRUPOS.values()}
+        rango = conn.execute("SELECT MIN(ts_epoch), MAX(ts_epoch) FROM lecturas").fetchone()
+    finally:
+        conn.close()
+    dias = (rango[1] - rango[0]) / 86400 if rango[0] is not None else 0
+    return {"filas": filas, "dias": round(dias, 1), "mb": round(app._tamano_bd() / 1e6, 1)}
+
+
+def _variacion(actual, base, clave):
+    """Variación relativa (%) de `clave` respecto a la base."""
+    return (actual[clave] - base[clave]) / base[clave] * 100 if base[clave] else float("nan")
+
+
+def comparar(actual, ruta_base):
+    with open(ruta_base, encoding="utf-8") as f:
+        base = {(r["escenario"], r["concurrencia"]): r for r in json.load(f)["resultados"]}
+    print(f"\nComparación con {ruta_base} (variación relativa; negativo en latencia = mejor)")
+    for r in actual:
+        b = base.get((r["escenario"], r["concurrencia"]))
+        if b is None:
+            continue
+        print(
+            f"  {r['escenario']:16s} c={r['concurrencia']:<3d} p50 {_variacion(r, b, 'p50_ms'):+6.1f}%  "
+            f"p95 {_variacion(r, b, 'p95_ms'):+6.1f}%  rps {_variacion(r, b, 'rps'):+6.1f}%"
+        )
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--anios", type=float, default=3, help="años de histórico si hay que generarlo")
+    ap.add_argument("--cada-min", type=int, default=15)
+    ap.add_argument("--concurrencia", default="1,4,16", help="niveles de concurrencia (coma)")
+    ap.add_argument("--peticiones", type=int, default=100, help="peticiones por escenario y nivel")
+    ap.add_argument("--escenarios", default=",".join(escenarios()), help="escenarios (coma)")
+    ap.add_argument("--servidor", action="store_true", help="peticiones HTTP reales a un servidor local")
+    ap.add_argument("--json", help="guarda los resultados en este fichero")
+    ap.add_argument("--comparar", metavar="JSON", help="resultados anteriores con los que comparar")
+    args = ap.parse_args()
+
+    app.init_db()
+    if not _info_bd()["dias"]:
+        t0 = time.perf_counter()
+        generar_historico.generar(args.anios, args.cada_min)
+        print(f"Histórico generado en {time.perf_counter() - t0:.1f}s")
+    bd = _info_bd()
+    print(f"BD {app.DB_NAME}: {bd['dias']} días, {sum(bd['filas'].values()):,} filas, {bd['mb']} MB")
+
+    todos = escenarios()
+    elegidos = [e.strip() for e in args.escenarios.split(",") if e.strip()]
+    desconocidos = [e for e in elegidos if e not in todos]
+    if desconocidos:
+        raise SystemExit(f"Escenarios desconocidos: {desconocidos} (disponibles: {', '.join(todos)})")
+    niveles = [int(c) for c in args.concurrencia.split(",") if c.strip()]
+
+    cliente = _ClienteHttp() if args.servidor else _ClienteFlask()
+    resultados = []
+    print(f"\n  {'escenario':16s} {'conc':>4s} {'p50 ms':>9s} {'p95 ms':>9s} {'p99 ms':>9s} {'req/s':>8s} {'err':>4s}")
+    try:
+        for nombre in elegidos:
+            for c in niveles:
+                r = {"escenario": nombre, "concurrencia": c, **medir(cliente, todos[nombre], c, args.peticiones)}
+                resultados.append(r)
+                print(
+                    f"  {nombre:16s} {c:4d} {r['p50_ms']:9.1f} {r['p95_ms']:9.1f} {r['p99_ms']:9.1f} "
+                    f"{r['rps']:8.1f} {r['errores']:4d}"
+                )
+    finally:
+        if args.servidor:
+            cliente.cerrar()
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(
+                {
+                    "fecha": datetime.now(app.TZ).isoformat(timespec="seconds"),
+                    "python": platform.python_version(),
+                    "modo": "servidor" if args.servidor else "test_client",
+                    "peticiones": args.peticiones,
+                    "bd": bd,
+                    "resultados": resultados,
+                },
+                f,
+                indent=1,
+            )
+        print(f"\nResultados en {args.json}")
+    if args.comparar:
+        comparar(resultados, args.comparar)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,120 @@
+# tools/generar_historico.py
+"""
+Rellena la base de datos de un DATA_DIR (temporal por defecto) con un histórico sintético de
+varios años para todos los tags de DATOS_A_BUSCAR y DATOS_AGUA, con el esquema real:
+lecturas / lecturas_agua, sus tablas _latest y los agregados rollup_*.
+
+    python tools/generar_historico.py --anios 5 --cada-min 15
+    DATA_DIR=/tmp/niveles_5a python tools/generar_historico.py --anios 5 --retencion
+    DATA_DIR=/tmp/niveles_5a python app.py        # panel sobre el histórico generado
+
+Cada tag es un paseo aleatorio acotado a su nivel máximo con un porcentaje de lecturas
+'Error' y '---'. Con --retencion se aplica después la retención configurada
+(RETENCION_RAW_DIAS), como haría el job nocturno.
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+os.environ.setdefault("DATA_DIR", tempfile.mkdtemp(prefix="historico_"))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np  # noqa: E402
+
+import app  # noqa: E402
+
+
+def _marcas(anios, cada_min):
+    """Epochs alineados a cada_min hasta ahora y su ts ISO local (calculado una vez para todos los tags)."""
+    paso = cada_min * 60
+    fin = int(time.time()) // paso * paso
+    epochs = np.arange(fin - int(anios * 365 * 86400), fin + 1, paso, dtype=np.int64)
+    ts = [datetime.fromtimestamp(int(e), app.TZ).isoformat(timespec="seconds") for e in epochs]
+    return epochs, ts
+
+
+def _serie(rng, n, maximo, pct_error):
+    """Paseo aleatorio entre el 5% y el 95% de `maximo`, con máscaras de lecturas 'Error' y '---'."""
+    paso = maximo * 0.004
+    v = np.empty(n)
+    v[0] = maximo * rng.uniform(0.3, 0.7)
+    ruido = rng.normal(0, paso, n)
+    bajo, alto = maximo * 0.05, maximo * 0.95
+    for i in range(1, n):  # rebote en los límites, no recorte: la serie no se queda pegada
+        x = v[i - 1] + ruido[i]
+        v[i] = 2 * bajo - x if x < bajo else 2 * alto - x if x > alto else x
+    v = v.round(2)
+    fallo = rng.random(n) < pct_error / 100
+    vacio = fallo & (rng.random(n) < 0.5)
+    return v, fallo & ~vacio, vacio
+
+
+def generar(anios=3, cada_min=15, pct_error=0.5, semilla=1):
+    """Genera el histórico en la BD de app.DB_NAME (que debe estar vacía). Devuelve filas por tabla."""
+    app.init_db()
+    conn = app._db_connect()
+    conn.execute("PRAGMA synchronous=OFF")
+    if conn.execute("SELECT EXISTS(SELECT 1 FROM lecturas UNION ALL SELECT 1 FROM lecturas_agua)").fetchone()[0]:
+        conn.close()
+        raise SystemExit(f"{app.DB_NAME} ya tiene lecturas: usa un DATA_DIR vacío")
+
+    rng = np.random.default_rng(semilla)
+    epochs, ts = _marcas(anios, cada_min)
+    filas = {}
+    for t in app.REGISTRO["tags"]:
+        tabla = app.GRUPOS[t["grupo"]]
+        maximo = float(t.get("nivel_max") or 100.0)
+        unidad = f" {t['unidad']}" if t["unidad"] else ""
+        valores, error, vacio = _serie(rng, len(epochs), maximo, pct_error)
+        textos = np.char.add(np.char.replace(np.char.mod("%.2f", valores), ".", ","), unidad)
+        columnas = {
+            "tag": [t["tag"]] * len(epochs),
+            "descripcion": [t["descripcion"]] * len(epochs),
+            "valor": np.where(error, "Error", np.where(vacio, "---", textos)).tolist(),
+            "ts": ts,
+            "nivel_max": [maximo] * len(epochs),
+            "valor_num": [None if e or m else v for v, e, m in zip(valores.tolist(), error, vacio)],
+            "ts_epoch": epochs.tolist(),
+            "estado": np.where(error, app.ESTADO_ERROR, np.where(vacio, app.ESTADO_MISSING, app.ESTADO_OK)).tolist(),
+        }
+        cols = app._COLUMNAS[tabla]
+        conn.executemany(
+            f"INSERT INTO {tabla}({', '.join(cols)}) VALUES ({', '.join('?' for _ in cols)})",
+            zip(*(columnas[c] for c in cols)),
+        )
+        conn.commit()
+        filas[tabla] = filas.get(tabla, 0) + len(epochs)
+
+    for tabla in app.GRUPOS.values():
+        app.reconstruir_latest(conn, tabla)
+    app.reconstruir_rollups(conn)
+    conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    conn.close()
+    app.invalidar_cache_dashboard()
+    return filas
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--anios", type=float, default=3)
+    ap.add_argument("--cada-min", type=int, default=15)
+    ap.add_argument("--pct-error", type=float, default=0.5, help="porcentaje de lecturas 'Error' o '---'")
+    ap.add_argument("--semilla", type=int, default=1)
+    ap.add_argument("--retencion", action="store_true", help="aplica después la retención de RETENCION_RAW_DIAS")
+    args = ap.parse_args()
+
+    t0 = time.perf_counter()
+    filas = generar(args.anios, args.cada_min, args.pct_error, args.semilla)
+    print(f"Histórico sintético en {app.DB_NAME} ({time.perf_counter() - t0:.1f}s)")
+    for tabla, n in filas.items():
+        print(f"  {tabla}: {n:,} filas")
+    if args.retencion:
+        print(f"  retención: {app.aplicar_retencion()}")
+    print(f"  tamaño: {app._tamano_bd() / 1e6:.1f} MB")
+
+
+if __name__ == "__main__":
+    main()
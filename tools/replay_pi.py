@@ -0,0 +1,281 @@
+# tools/replay_pi.py
+"""
+Reproduce displays de PI Vision grabados para probar y medir la captura con Selenium sin VPN.
+
+Cada grabación (<directorio>/<display>.json) guarda el hash del display, el HTML del display
+ya renderizado (sin scripts) y los valores que se extrajeron al grabarlo. El servidor sirve
+una página kiosk que, como la SPA real, carga el display del hash de la URL por fetch(),
+vacía los valores y los va rellenando por JS tras un retardo (en varias ráfagas y con
+jitter); al cambiar el hash (#/Displays/...) carga el display nuevo sin recargar la página.
+
+- /PIVision/                    página kiosk (exige basic auth con las credenciales de app.py)
+- /replay/display?hash=...      HTML del display grabado para ese hash (404 si no hay)
+- /replay/estado                peticiones atendidas y rechazadas por auth (sin auth)
+
+Uso:
+    python tools/replay_pi.py --sinteticas tools/grabaciones      # grabaciones desde tags.json
+    python tools/replay_pi.py --grabar                            # desde PI real (requiere VPN)
+    python tools/replay_pi.py --port 8810 --retardo-ms 3000 --rafagas 3
+    PI_BASE_URL=http://127.0.0.1:8810/PIVision/ CAPTURE_BACKEND=selenium python app.py
+
+Las grabaciones reales contienen datos de planta: tools/grabaciones/ no se versiona.
+"""
+import argparse
+import base64
+import glob
+import html as html_lib
+import json
+import os
+import sys
+import tempfile
+import threading
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+os.environ.setdefault("DATA_DIR", tempfile.mkdtemp(prefix="replay_pi_"))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import stub_pi  # noqa: E402  (importa app con DATA_DIR temporal)
+
+app = stub_pi.app
+
+DIRECTORIO_DEFECTO = os.getenv(
+    "REPLAY_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "grabaciones")
+)
+
+PAGINA_KIOSK = """<!DOCTYPE html>
+<html><head><meta charset="utf-8"><title>PI Vision (replay)</title></head>
+<body>
+<div id="display"></div>
+<script>
+var RETARDO = %(retardo)d, JITTER = %(jitter)d, RAFAGAS = %(rafagas)d;
+var cont = document.getElementById('display');
+var generacion = 0;
+
+function cargar() {
+    var gen = ++generacion;
+    cont.innerHTML = '';
+    if (!location.hash) return;
+    fetch('/replay/display?hash=' + encodeURIComponent(location.hash))
+        .then(function (r) { if (!r.ok) throw new Error('HTTP ' + r.status); return r.json(); })
+        .then(function (j) {
+            if (gen !== generacion) return;
+            cont.innerHTML = j.html;
+            var divs = Array.prototype.slice.call(cont.querySelectorAll('div[title]'));
+            divs.forEach(function (d, i) {
+                var contenido = d.innerHTML;
+                d.innerHTML = '';
+                var espera = RETARDO * ((i %% RAFAGAS) + 1) / RAFAGAS + Math.random() * JITTER;
+                setTimeout(function () { if (gen === generacion) d.innerHTML = contenido; }, espera);
+            });
+        })
+        .catch(function (e) { cont.textContent = 'Error cargando el display: ' + e; });
+}
+
+window.addEventListener('hashchange', cargar);
+cargar();
+</script>
+</body></html>
+"""
+
+# HTML del display renderizado, sin lo que volvería a pedir recursos al servidor real
+_JS_GRABAR = r"""
+var copia = document.body.cloneNode(true);
+copia.querySelectorAll('script, iframe, link, noscript').forEach(function (n) { n.remove(); });
+return copia.innerHTML;
+"""
+
+
+def cargar_grabaciones(directorio):
+    """hash del display -> grabación, de todos los .json del directorio."""
+    grabaciones = {}
+    for ruta in sorted(glob.glob(os.path.join(directorio, "*.json"))):
+        with open(ruta, encoding="utf-8") as f:
+            g = json.load(f)
+        grabaciones[g["hash"]] = g
+    return grabaciones
+
+
+def _guardar(directorio, display, hash_, html, valores):
+    os.makedirs(directorio, exist_ok=True)
+    ruta = os.path.join(directorio, f"{display}.json")
+    with open(ruta, "w", encoding="utf-8") as f:
+        json.dump(
+            {
+                "display": display,
+                "hash": hash_,
+                "grabado": datetime.now(app.TZ).isoformat(timespec="seconds"),
+                "html": html,
+                "valores": valores,
+            },
+            f,
+            ensure_ascii=False,
+            indent=1,
+        )
+    return ruta
+
+
+def generar_sinteticas(directorio):
+    """
+    Grabaciones a partir del registro: un símbolo de valor por tag (div[title] con el valor y
+    la unidad en spans, como PI Vision) entre etiquetas con title que no son tags.
+    """
+    esc = html_lib.escape
+    rutas = []
+    for display, info in app.REGISTRO["displays"].items():
+        titulo = esc(info.get("descripcion", display))
+        partes, valores = [f'<div class="display-title" title="{titulo}">{titulo}</div>'], {}
+        for t in app.REGISTRO["tags"]:
+            if t["display"] != display:
+                continue
+            maximo = float(t.get("nivel_max") or 100.0)
+            valor = f"{stub_pi.valor_actual(t['tag'], maximo):.2f}".replace(".", ",")
+            unidad = t["unidad"] or ""
+            descripcion = esc(t["descripcion"])
+            partes.append(f'<div class="label-symbol" title="{descripcion}">{descripcion}</div>')
+            partes.append(
+                f'<div class="value-symbol" title="{esc(stub_pi.ruta_completa(t["tag"]))}">'
+                f'<span class="value">{valor}</span> <span class="units">{esc(unidad)}</span></div>'
+            )
+            valores[t["tag"]] = f"{valor} {unidad}".strip()
+        html = '<div class="pi-display">' + "".join(partes) + "</div>"
+        rutas.append(_guardar(directorio, display, info["hash"], html, valores))
+    return rutas
+
+
+def grabar(directorio):
+    """Graba todos los displays del registro desde PI_BASE_URL con el pool de app.py."""
+    app.DRIVER_POOL._limpieza_hecha = True  # sin pkill -f chrome en la máquina que graba
+    rutas = []
+    for display, info in app.REGISTRO["displays"].items():
+        tags = app.tags_de(display=display)
+        with app.DRIVER_POOL.sesion() as driver:
+            valores = app._leer_display(driver, display, tags)
+            html = driver.execute_script(_JS_GRABAR)
+        ok = sum(1 for v in valores.values() if v["estado"] == "ok")
+        print(f"[{display}] {ok}/{len(tags)} tags con valor")
+        rutas.append(_guardar(directorio, display, info["hash"], html, {t: v["valor"] for t, v in valores.items()}))
+    app.DRIVER_POOL.cerrar()
+    return rutas
+
+
+class ReplayHandler(BaseHTTPRequestHandler):
+    grabaciones = {}
+    usuario = ""
+    clave = ""
+    retardo_ms = 1500
+    jitter_ms = 0
+    rafagas = 1
+    peticiones = 0
+    rechazadas = 0
+    _lock = threading.Lock()
+
+    def log_message(self, fmt, *args):
+        if os.getenv("STUB_VERBOSE"):
+            super().log_message(fmt, *args)
+
+    def _autorizado(self):
+        if not self.usuario:
+            return True
+        esperado = base64.b64encode(f"{self.usuario}:{self.clave}".encode("utf-8")).decode("ascii")
+        return self.headers.get("Authorization", "") == f"Basic {esperado}"
+
+    def _responder(self, status, cuerpo, tipo="application/json"):
+        data = cuerpo if isinstance(cuerpo, bytes) else json.dumps(cuerpo).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", tipo)
+        self.send_header("Content-Length", str(len(data)))
+        self.send_header("Cache-Control", "no-store")
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        ruta = url.path.rstrip("/").lower()
+        cls = type(self)
+        if ruta == "/replay/estado":
+            with self._lock:
+                return self._responder(200, {"peticiones": cls.peticiones, "rechazadas": cls.rechazadas})
+
+        with self._lock:
+            cls.peticiones += 1
+            if not self._autorizado():
+                cls.rechazadas += 1
+                autorizado = False
+            else:
+                autorizado = True
+        if not autorizado:
+            self.send_response(401)
+            self.send_header("WWW-Authenticate", 'Basic realm="PI"')
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+
+        if ruta == "/pivision" or ruta.startswith("/pivision/"):
+            html = PAGINA_KIOSK % {"retardo": self.retardo_ms, "jitter": self.jitter_ms, "rafagas": max(1, self.rafagas)}
+            return self._responder(200, html.encode("utf-8"), "text/html; charset=utf-8")
+        if ruta == "/replay/display":
+            g = self.grabaciones.get((parse_qs(url.query).get("hash") or [""])[0])
+            if g is None:
+                return self._responder(404, {"error": "display no grabado"})
+            return self._responder(200, {"display": g["display"], "html": g["html"]})
+        return self._responder(404, {"error": "Not found"})
+
+
+def arrancar(directorio, host="127.0.0.1", port=0, usuario=None, clave=None, retardo_ms=1500, jitter_ms=0, rafagas=1):
+    """
+    Arranca el servidor en un hilo; devuelve (servidor, url_base). Por defecto exige las
+    credenciales con las que se autentica app.py (USERNAME / PASSWORD1).
+    """
+    handler = type(
+        "ReplayHandlerConfigurado",
+        (ReplayHandler,),
+        {
+            "grabaciones": cargar_grabaciones(directorio),
+            "usuario": app.USERNAME if usuario is None else usuario,
+            "clave": app.PASSWORD1 if clave is None else clave,
+            "retardo_ms": retardo_ms,
+            "jitter_ms": jitter_ms,
+            "rafagas": rafagas,
+            "peticiones": 0,
+            "rechazadas": 0,
+        },
+    )
+    if not handler.grabaciones:
+        raise SystemExit(f"No hay grabaciones en {directorio} (genera unas con --sinteticas o --grabar)")
+    srv = ThreadingHTTPServer((host, port), handler)
+    threading.Thread(target=srv.serve_forever, daemon=True).start()
+    return srv, f"http://{host}:{srv.server_address[1]}"
+
+
+def _argumentos_servidor(ap):
+    """Opciones del servidor compartidas con tools/bench_captura.py."""
+    ap.add_argument("--grabaciones", default=DIRECTORIO_DEFECTO, help="directorio de grabaciones")
+    ap.add_argument("--retardo-ms", type=int, default=1500, help="tiempo hasta que aparece el último valor")
+    ap.add_argument("--jitter-ms", type=int, default=0, help="retardo aleatorio extra por valor")
+    ap.add_argument("--rafagas", type=int, default=1, help="los valores aparecen en N tandas")
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--host", default="127.0.0.1")
+    ap.add_argument("--port", type=int, default=8810)
+    _argumentos_servidor(ap)
+    ap.add_argument("--sinteticas", metavar="DIR", help="genera grabaciones a partir de tags.json y sale")
+    ap.add_argument("--grabar", action="store_true", help="graba los displays desde PI_BASE_URL y sale")
+    args = ap.parse_args()
+
+    if args.sinteticas:
+        for r in generar_sinteticas(args.sinteticas):
+            print(f"Grabación sintética: {r}")
+    elif args.grabar:
+        for r in grabar(args.grabaciones):
+            print(f"Grabado: {r}")
+    else:
+        srv, base = arrancar(
+            args.grabaciones, args.host, args.port,
+            retardo_ms=args.retardo_ms, jitter_ms=args.jitter_ms, rafagas=args.rafagas,
+        )
+        print(f"Replay PI Vision en {base}/PIVision/ ({len(srv.RequestHandlerClass.grabaciones)} displays)")
+        srv.serve_forever()
@@ -0,0 +1,137 @@
+# tools/stub_brevo.py
+"""
+Servidor local que imita POST /v3/smtp/email de Brevo para probar la cola de emails
+(reintentos, backoff, idempotencia y resumen de alertas) sin enviar correos reales.
+
+- POST /v3/smtp/email    acepta el envío (201) o falla según STUB_FALLOS
+- GET  /mensajes         lista de emails aceptados (JSON)
+
+STUB_FALLOS: lista de códigos HTTP con los que responder a las primeras peticiones,
+p. ej. "500,503,429" -> tres fallos y después 201. Un mismo Idempotency-Key ya aceptado
+no se vuelve a registrar (la respuesta repite el messageId).
+STUB_RETARDO_MS: retardo de cada respuesta.
+
+Uso:
+    python tools/stub_brevo.py --port 8900
+    BREVO_API_URL=http://127.0.0.1:8900/v3/smtp/email BREVO_API_KEY=x MAIL_FROM=a@b.c python app.py
+
+    # o desde Python, cola completa contra el stub:
+    python tools/stub_brevo.py --demo
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit
+
+
+class StubBrevoHandler(BaseHTTPRequestHandler):
+    fallos = [int(x) for x in os.getenv("STUB_FALLOS", "").split(",") if x.strip()]
+    retardo_ms = int(os.getenv("STUB_RETARDO_MS", "0"))
+    mensajes = []
+    por_clave = {}
+    peticiones = 0
+    _lock = threading.Lock()
+
+    def log_message(self, fmt, *args):
+        if os.getenv("STUB_VERBOSE"):
+            super().log_message(fmt, *args)
+
+    def _responder(self, status, cuerpo):
+        data = json.dumps(cuerpo).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if urlsplit(self.path).path.rstrip("/") == "/mensajes":
+            with self._lock:
+                return self._responder(200, {"peticiones": self.peticiones, "mensajes": self.mensajes})
+        return self._responder(404, {"message": "Not found"})
+
+    def do_POST(self):
+        if urlsplit(self.path).path.rstrip("/") != "/v3/smtp/email":
+            return self._responder(404, {"message": "Not found"})
+        cuerpo = json.loads(self.rfile.read(int(self.headers.get("Content-Length", "0"))) or b"{}")
+        if self.retardo_ms:
+            time.sleep(self.retardo_ms / 1000)
+        if not self.headers.get("api-key"):
+            return self._responder(401, {"code": "unauthorized", "message": "Key not found"})
+
+        cls = type(self)
+        with self._lock:
+            cls.peticiones += 1
+            if cls.fallos:
+                status = cls.fallos.pop(0)
+                return self._responder(status, {"code": "stub", "message": f"fallo simulado {status}"})
+            clave = self.headers.get("Idempotency-Key")
+            if clave and clave in cls.por_clave:
+                return self._responder(201, {"messageId": cls.por_clave[clave]})
+            message_id = f"<{uuid.uuid4().hex}@stub>"
+            cls.mensajes.append({"messageId": message_id, "clave": clave, **cuerpo})
+            if clave:
+                cls.por_clave[clave] = message_id
+        return self._responder(201, {"messageId": message_id})
+
+
+def arrancar(host="127.0.0.1", port=0):
+    """Arranca el stub en un hilo; devuelve (servidor, url de /v3/smtp/email)."""
+    srv = ThreadingHTTPServer((host, port), StubBrevoHandler)
+    threading.Thread(target=srv.serve_forever, daemon=True).start()
+    return srv, f"http://{host}:{srv.server_address[1]}/v3/smtp/email"
+
+
+def demo():
+    """Recorre la cola contra el stub: fallos con backoff, idempotencia y resumen de alertas."""
+    os.environ.setdefault("DATA_DIR", tempfile.mkdtemp(prefix="stub_brevo_"))
+    os.environ.setdefault("BREVO_API_KEY", "stub")
+    os.environ.setdefault("MAIL_FROM", "niveles@example.com")
+    os.environ.setdefault("MAIL_TO", "ops@example.com")
+    os.environ.setdefault("MAIL_ALERT", "admin@example.com")
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    import app
+
+    StubBrevoHandler.fallos = [500, 503]
+    _, app.BREVO_API_URL = arrancar()
+    app.EMAIL_BACKOFF_S = 1
+    app.ALERTA_VENTANA_S = 2
+    app.init_db()
+
+    app.encolar_email("Resumen", "texto", "<p>html</p>", clave="resumen:demo", tipo="resumen")
+    app.encolar_email("Resumen", "texto", "<p>html</p>", clave="resumen:demo", tipo="resumen")
+    for i in range(3):
+        app.encolar_alerta(f"fallo simulado {i}")
+
+    limite = time.monotonic() + 15
+    while time.monotonic() < limite:
+        conn = app._db_connect()
+        pendientes = conn.execute("SELECT COUNT(*) FROM email_outbox WHERE estado = 'pendiente'").fetchone()[0]
+        conn.close()
+        if not pendientes:
+            break
+        time.sleep(0.2)
+
+    print(f"Peticiones al stub: {StubBrevoHandler.peticiones}")
+    for m in StubBrevoHandler.mensajes:
+        print(f"  {m['clave']}: {m['subject']} -> {[t['email'] for t in m['to']]}")
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--host", default="127.0.0.1")
+    ap.add_argument("--port", type=int, default=8900)
+    ap.add_argument("--demo", action="store_true", help="prueba la cola de emails de app.py contra el stub")
+    args = ap.parse_args()
+    if args.demo:
+        demo()
+    else:
+        srv = ThreadingHTTPServer((args.host, args.port), StubBrevoHandler)
+        print(f"Stub Brevo escuchando en http://{args.host}:{args.port}/v3/smtp/email")
+        srv.serve_forever()
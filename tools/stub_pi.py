@@ -0,0 +1,211 @@
+# tools/stub_pi.py
+"""
+Servidor local que imita lo justo de PI Vision y PI Web API para probar y
+comparar los backends de captura sin VPN.
+
+- /PIVision/                      página kiosk: un div[title=<ruta del tag>] por tag,
+                                  rellenado por JS tras STUB_RETARDO_MS
+- /piwebapi/points?path=...       -> {"WebId": ...} (404 si el tag no existe)
+- /piwebapi/batch (POST)          sub-peticiones GET a /points
+- /piwebapi/streamsets/value      valor actual de varios WebId
+
+Si STUB_USER/STUB_PASS están definidos exige basic auth con esas credenciales.
+Los valores son una senoide determinista por tag, así que ambos backends leen lo mismo.
+
+Uso:
+    python tools/stub_pi.py --port 8800
+    PI_BASE_URL=http://127.0.0.1:8800/PIVision/ PI_WEBAPI_URL=http://127.0.0.1:8800/piwebapi/ python app.py
+"""
+import argparse
+import base64
+import hashlib
+import json
+import math
+import os
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+os.environ.setdefault("DATA_DIR", tempfile.mkdtemp(prefix="stub_pi_"))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app  # noqa: E402
+
+SERVIDOR_DEFECTO = app.PI_WEBAPI_SERVIDOR
+
+
+def ruta_completa(tag):
+    """Ruta PI (\\\\SERVIDOR\\TAG) tal como aparece en el title del display."""
+    if tag.startswith("\\"):
+        return "\\" + tag
+    return f"\\\\{SERVIDOR_DEFECTO}\\{tag}"
+
+
+def _catalogo():
+    cat = {}
+    for t in app.REGISTRO["tags"]:
+        cat[ruta_completa(t["tag"]).lower()] = {
+            "tag": t["tag"],
+            "max": float(t.get("nivel_max") or 100.0),
+            "unidad": t["unidad"] or "%",
+        }
+    return cat
+
+
+CATALOGO = _catalogo()
+
+
+def webid(ruta):
+    return "P1" + hashlib.sha1(ruta.lower().encode("utf-8")).hexdigest()[:20].upper()
+
+
+POR_WEBID = {webid(r): info for r, info in CATALOGO.items()}
+
+
+def valor_actual(tag, maximo, t=None):
+    """Senoide lenta y determinista entre el 20% y el 80% del máximo."""
+    t = time.time() if t is None else t
+    fase = int(hashlib.md5(tag.encode("utf-8")).hexdigest()[:6], 16) / 0xFFFFFF * 2 * math.pi
+    return round(maximo * (0.5 + 0.3 * math.sin(t / 3600.0 + fase)), 2)
+
+
+PAGINA_KIOSK = """<!DOCTYPE html>
+<html><head><meta charset="utf-8"><title>PI Vision (stub)</title></head>
+<body>
+<div id="display"></div>
+<script>
+var TAGS = %(tags)s;
+var RETARDO = %(retardo)d;
+var cont = document.getElementById('display');
+TAGS.forEach(function (t) {
+    var d = document.createElement('div');
+    d.setAttribute('title', t.ruta);
+    cont.appendChild(d);
+});
+setTimeout(function () {
+    fetch('/piwebapi/streamsets/value?' + TAGS.map(function (t) { return 'webId=' + t.webid; }).join('&'))
+        .then(function (r) { return r.json(); })
+        .then(function (j) {
+            var divs = cont.children;
+            j.Items.forEach(function (it, i) {
+                divs[i].innerText = it.Value.Value.toFixed(2).replace('.', ',') + ' ' + it.Value.UnitsAbbreviation;
+            });
+        });
+}, RETARDO);
+</script>
+</body></html>
+"""
+
+
+class StubPiHandler(BaseHTTPRequestHandler):
+    usuario = os.getenv("STUB_USER", "")
+    clave = os.getenv("STUB_PASS", "")
+    retardo_ms = int(os.getenv("STUB_RETARDO_MS", "1500"))
+
+    def log_message(self, fmt, *args):
+        if os.getenv("STUB_VERBOSE"):
+            super().log_message(fmt, *args)
+
+    def _autorizado(self):
+        if not self.usuario:
+            return True
+        esperado = base64.b64encode(f"{self.usuario}:{self.clave}".encode("utf-8")).decode("ascii")
+        return self.headers.get("Authorization", "") == f"Basic {esperado}"
+
+    def _responder(self, status, cuerpo, tipo="application/json"):
+        data = cuerpo if isinstance(cuerpo, bytes) else json.dumps(cuerpo).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", tipo)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _no_autorizado(self):
+        self.send_response(401)
+        self.send_header("WWW-Authenticate", 'Basic realm="PI"')
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    # --- PI Web API ---
+    def _points(self, qs):
+        ruta = (qs.get("path") or [""])[0]
+        if ruta.lower() not in CATALOGO:
+            return 404, {"Errors": [f"PI Point not found '{ruta}'."]}
+        return 200, {"WebId": webid(ruta), "Name": ruta.rsplit("\\", 1)[-1], "Path": ruta}
+
+    def _streamset_value(self, qs):
+        ahora = time.time()
+        ts = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(ahora))
+        items = []
+        for w in qs.get("webId", []):
+            info = POR_WEBID.get(w)
+            if not info:
+                continue
+            items.append({
+                "WebId": w,
+                "Value": {
+                    "Timestamp": ts,
+                    "Value": valor_actual(info["tag"], info["max"], ahora),
+                    "UnitsAbbreviation": info["unidad"],
+                    "Good": True,
+                },
+            })
+        return 200, {"Items": items}
+
+    def do_GET(self):
+        if not self._autorizado():
+            return self._no_autorizado()
+        url = urlsplit(self.path)
+        qs = parse_qs(url.query)
+        ruta = url.path.rstrip("/").lower()
+
+        if ruta == "/pivision":
+            tags = [{"ruta": r, "webid": webid(r)} for r in _rutas_display()]
+            html = PAGINA_KIOSK % {"tags": json.dumps(tags), "retardo": self.retardo_ms}
+            return self._responder(200, html.encode("utf-8"), "text/html; charset=utf-8")
+        if ruta == "/piwebapi/points":
+            return self._responder(*self._points(qs))
+        if ruta == "/piwebapi/streamsets/value":
+            return self._responder(*self._streamset_value(qs))
+        return self._responder(404, {"Errors": ["Not found"]})
+
+    def do_POST(self):
+        if not self._autorizado():
+            return self._no_autorizado()
+        if urlsplit(self.path).path.rstrip("/").lower() != "/piwebapi/batch":
+            return self._responder(404, {"Errors": ["Not found"]})
+        lote = json.loads(self.rfile.read(int(self.headers.get("Content-Length", "0"))) or b"{}")
+        res = {}
+        for clave, sub in lote.items():
+            url = urlsplit(sub.get("Resource", ""))
+            if sub.get("Method", "GET").upper() == "GET" and url.path.rstrip("/").lower().endswith("/points"):
+                status, content = self._points(parse_qs(url.query))
+            else:
+                status, content = 400, {"Errors": ["Unsupported"]}
+            res[clave] = {"Status": status, "Headers": {}, "Content": content}
+        return self._responder(207, res)
+
+
+def _rutas_display():
+    # El hash del display no llega al servidor: la página incluye los tags de todos los displays
+    return [ruta_completa(t["tag"]) for t in app.REGISTRO["tags"]]
+
+
+def arrancar(host="127.0.0.1", port=0):
+    """Arranca el stub en un hilo; devuelve (servidor, url_base)."""
+    srv = ThreadingHTTPServer((host, port), StubPiHandler)
+    threading.Thread(target=srv.serve_forever, daemon=True).start()
+    return srv, f"http://{host}:{srv.server_address[1]}"
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--host", default="127.0.0.1")
+    ap.add_argument("--port", type=int, default=8800)
+    args = ap.parse_args()
+    srv = ThreadingHTTPServer((args.host, args.port), StubPiHandler)
+    print(f"Stub PI escuchando en http://{args.host}:{args.port} (PIVision/ y piwebapi/)")
+    srv.serve_forever()